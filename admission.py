@@ -0,0 +1,206 @@
+"""Admission control and load shedding for Warbler.
+
+When the database slows down, requests pile up in every worker until the
+whole site times out. `AdaptiveLimiter` caps how many requests a worker
+runs at once (on its threads: gunicorn.conf.py runs gthread workers), and
+moves the cap with the latency it observes (AIMD):
+
+- a request slower than ADMISSION_TARGET_LATENCY cuts the cap by a
+  quarter (at most once per target latency, so one slow burst counts
+  once), never below ADMISSION_MIN_LIMIT;
+- a fast request while the worker is busy raises the cap by 1/cap, i.e.
+  about one per round of requests, up to ADMISSION_MAX_LIMIT.
+
+Requests are admitted by priority class. Writes may use the whole limit,
+logged-in GETs (feeds, profiles) PRIORITY_SHARES['user'] of it and
+anonymous GETs PRIORITY_SHARES['anonymous'], so anonymous listings are
+shed first. A request over its share is rejected at once with a 503 and
+Retry-After, before it touches the database. An anonymous GET of one of
+the public listings in STALE_ENDPOINTS, with no query string, is instead
+answered with the last good rendering of the same path if one is cached
+(kept for ADMISSION_STALE_TTL seconds), marked with a Warning header.
+Pages carrying a CSRF token are never kept: the token belongs to the
+session of whoever rendered the page.
+
+Limiter state is reported as admission_limit, admission_inflight{priority}
+and admission_requests_total{priority, result}.
+"""
+
+import math
+import threading
+import time
+
+from flask import current_app, g, request, session
+
+from cache import LRUCache
+from coalescing import Snapshot
+from metrics import metrics
+
+DEFAULT_INITIAL_LIMIT = 20
+DEFAULT_MIN_LIMIT = 4
+DEFAULT_MAX_LIMIT = 200
+DEFAULT_TARGET_LATENCY = 0.5
+DEFAULT_RETRY_AFTER = 1
+DEFAULT_STALE_TTL = 600
+# A page's stale copy is refreshed at most this often per worker.
+STALE_REFRESH = 10
+BACKOFF = 0.75
+
+PRIORITIES = ('write', 'user', 'anonymous')
+PRIORITY_SHARES = {'write': 1.0, 'user': 0.8, 'anonymous': 0.5}
+
+# Never limited: they don't touch the database.
+EXEMPT_ENDPOINTS = frozenset(['static', 'serve_asset', 'show_metrics'])
+
+# Public listings that may be answered with a stale copy when shedding.
+STALE_ENDPOINTS = frozenset(['homepage', 'list_users', 'users_show', 'users_mentions',
+                             'tags_show', 'messages_show'])
+
+
+class AdaptiveLimiter:
+    """Per-worker concurrency limit that adapts to request latency."""
+
+    def __init__(self, initial=DEFAULT_INITIAL_LIMIT, minimum=DEFAULT_MIN_LIMIT,
+                 maximum=DEFAULT_MAX_LIMIT, target_latency=DEFAULT_TARGET_LATENCY,
+                 clock=time.monotonic):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.target_latency = target_latency
+        self.clock = clock
+        self.inflight = dict.fromkeys(PRIORITIES, 0)
+        self._last_decrease = None
+        self._lock = threading.Lock()
+
+    def capacity(self, priority):
+        """How many requests may be in flight when admitting `priority`."""
+
+        return max(math.ceil(self.limit * PRIORITY_SHARES[priority]), 1)
+
+    def try_acquire(self, priority):
+        """Admit a `priority` request if there's room; True if admitted."""
+
+        with self._lock:
+            if sum(self.inflight.values()) >= self.capacity(priority):
+                return False
+            self.inflight[priority] += 1
+            return True
+
+    def release(self, priority, latency):
+        """Finish an admitted request that took `latency` seconds."""
+
+        with self._lock:
+            running = sum(self.inflight.values())
+            self.inflight[priority] -= 1
+            if latency > self.target_latency:
+                now = self.clock()
+                if (self._last_decrease is None
+                        or now - self._last_decrease >= self.target_latency):
+                    self._last_decrease = now
+                    self.limit = max(self.limit * BACKOFF, self.minimum)
+            elif running * 2 >= self.limit:
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+
+    def report(self):
+        """Copy the limiter's state into the metrics registry."""
+
+        metrics.set('admission_limit', round(self.limit, 2))
+        for priority, count in self.inflight.items():
+            metrics.set('admission_inflight', count, priority=priority)
+
+
+def request_priority(user_key):
+    if request.method not in ('GET', 'HEAD'):
+        return 'write'
+    return 'user' if user_key in session else 'anonymous'
+
+
+def _stale_allowed():
+    # Query strings (searches, cursors, cache busters) would make the
+    # copies unbounded; those pages are shed instead.
+    return request.endpoint in STALE_ENDPOINTS and not request.query_string
+
+
+def _stale_key():
+    return f'stale:{request.path}'
+
+
+def reject():
+    """The response for a request the limiter turned away."""
+
+    if g.admission_priority == 'anonymous' and _stale_allowed():
+        snapshot = current_app.extensions['cache'].get(_stale_key())
+        if snapshot is not None:
+            metrics.inc('admission_requests_total', priority='anonymous', result='stale')
+            g.admission_stale = True
+            response = current_app.response_class(
+                snapshot.body, status=snapshot.status, headers=snapshot.headers)
+            response.headers['Warning'] = '110 - "Response is Stale"'
+            return response
+
+    metrics.inc('admission_requests_total', priority=g.admission_priority,
+                result='rejected')
+    response = current_app.response_class(
+        'Warbler is busy right now; please try again in a moment.\n',
+        status=503, mimetype='text/plain')
+    response.headers['Retry-After'] = str(
+        current_app.config.get('ADMISSION_RETRY_AFTER', DEFAULT_RETRY_AFTER))
+    return response
+
+
+def connect_admission(app, user_key):
+    """Limit concurrent requests per worker; see the module docstring.
+
+    `user_key` is the session key that marks a logged-in user. Register
+    this before any before_request handler that queries the database.
+    Set ADMISSION_ENABLED to False to turn it off.
+    """
+
+    if not app.config.get('ADMISSION_ENABLED', True):
+        return
+
+    limiter = app.extensions['admission'] = AdaptiveLimiter(
+        initial=app.config.get('ADMISSION_INITIAL_LIMIT', DEFAULT_INITIAL_LIMIT),
+        minimum=app.config.get('ADMISSION_MIN_LIMIT', DEFAULT_MIN_LIMIT),
+        maximum=app.config.get('ADMISSION_MAX_LIMIT', DEFAULT_MAX_LIMIT),
+        target_latency=app.config.get('ADMISSION_TARGET_LATENCY',
+                                      DEFAULT_TARGET_LATENCY))
+    metrics.add_collector(limiter.report)
+    recently_stored = LRUCache()
+
+    @app.before_request
+    def admit():
+        if request.endpoint in EXEMPT_ENDPOINTS:
+            return None
+        priority = g.admission_priority = request_priority(user_key)
+        if not limiter.try_acquire(priority):
+            return reject()
+        g.admission_started = time.perf_counter()
+        metrics.inc('admission_requests_total', priority=priority, result='admitted')
+        return None
+
+    @app.after_request
+    def keep_stale_copy(response):
+        # Only anonymous listings: they look the same to everyone.
+        if (g.get('admission_priority') != 'anonymous' or g.get('admission_stale')
+                or not _stale_allowed()
+                or response.status_code != 200 or response.is_streamed
+                or response.mimetype != 'text/html' or '_flashes' in session
+                # Flask-WTF keeps the token it rendered in g
+                or app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token') in g):
+            return response
+        key = _stale_key()
+        if recently_stored.get(key) is None:
+            headers = [(name, value) for name, value in response.headers
+                       if name.lower() != 'set-cookie']
+            current_app.extensions['cache'].set(
+                key, Snapshot(response.get_data(), response.status_code, headers),
+                ttl=current_app.config.get('ADMISSION_STALE_TTL', DEFAULT_STALE_TTL))
+            recently_stored.set(key, True, time.time() + STALE_REFRESH)
+        return response
+
+    @app.teardown_request
+    def release(exc):
+        started = g.pop('admission_started', None)
+        if started is not None:
+            limiter.release(g.admission_priority, time.perf_counter() - started)
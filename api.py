@@ -0,0 +1,453 @@
+"""Versioned JSON API for Warbler.
+
+Mounted at /api/v1. Reads select only the columns they serialize (no ORM
+object hydration), lists are keyset-paginated with opaque cursors, and
+responses carry an ETag so clients can revalidate with If-None-Match.
+Authentication reuses the browser session (`g.user`).
+"""
+
+import base64
+import json
+from datetime import datetime
+
+from flask import Blueprint, g, request, Response
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Follows, Likes
+from notifications import notify, follow_and_notify
+from sharding import message_shards, hydrate
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_BATCH_SIZE = 100
+
+USER_SUMMARY_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+)
+
+
+##############################################################################
+# Encoding, errors and pagination helpers
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def dumps(data):
+    """Serialize `data` to compact JSON bytes, using orjson if available."""
+
+    if orjson:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':'), default=_default).encode('utf-8')
+
+
+def json_response(data, status=200):
+    """JSON response with an ETag, answered with 304 when it still matches."""
+
+    response = Response(dumps(data), status=status, mimetype='application/json')
+    if status == 200 and request.method == 'GET':
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
+def error(status, message):
+    return json_response({'error': message}, status=status)
+
+
+def page_size():
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        limit = DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def encode_cursor(*values):
+    raw = dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by `encode_cursor`; None if absent or invalid."""
+
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) and values else None
+
+
+def cursor_id(cursor):
+    """The message id a decoded cursor points at, or None.
+
+    Cursors used to be (timestamp, id); the id is last in both forms.
+    """
+
+    try:
+        return int(cursor[-1]) if cursor else None
+    except (ValueError, TypeError):
+        return None
+
+
+def paginate_messages(user_ids):
+    """Keyset-paginate messages by any of `user_ids`, newest first.
+
+    Message ids are time-ordered, so the cursor is just the last id seen.
+    Pages come from the shards' feed, which reads the archive once a page
+    reaches past its horizon. Returns (messages, next_cursor).
+    """
+
+    limit = page_size()
+    before = cursor_id(decode_cursor(request.args.get('cursor')))
+    rows = message_shards().feed(user_ids, limit + 1, before=before)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].id)
+    return visible_messages(rows), next_cursor
+
+
+def batch_ids(name):
+    """Parse a list of ids from query arg `name` ("1,2,3") or JSON body.
+
+    Returns (ids, error_response); at most MAX_BATCH_SIZE ids are accepted.
+    """
+
+    if request.method == 'GET':
+        raw = [part for part in request.args.get(name, '').split(',') if part]
+    else:
+        raw = (request.get_json(silent=True) or {}).get(name)
+        if not isinstance(raw, list):
+            return None, error(400, f"Expected a JSON list in '{name}'.")
+
+    try:
+        ids = list(dict.fromkeys(int(value) for value in raw))
+    except (ValueError, TypeError):
+        return None, error(400, f"'{name}' must contain integer ids.")
+
+    if len(ids) > MAX_BATCH_SIZE:
+        return None, error(400, f"At most {MAX_BATCH_SIZE} ids per request.")
+    return ids, None
+
+
+def login_required_json():
+    if not g.user:
+        return error(401, "Authentication required.")
+    return None
+
+
+##############################################################################
+# Serializers and queries
+
+
+def serialize_message(row, liked_ids=()):
+    return {
+        'id': row.id,
+        # 64-bit ids lose precision as JavaScript numbers
+        'id_str': str(row.id),
+        'text': row.text,
+        'timestamp': row.timestamp,
+        'user': {
+            'id': row.user_id,
+            'username': row.user.username,
+            'image_url': row.user.image_url,
+        },
+        'liked': row.id in liked_ids,
+    }
+
+
+def serialize_user_summary(row):
+    return {'id': row.id, 'username': row.username, 'image_url': row.image_url}
+
+
+def serialize_profile(row, message_count):
+    return {
+        'id': row.id,
+        'username': row.username,
+        'image_url': row.image_url,
+        'header_image_url': row.header_image_url,
+        'bio': row.bio,
+        'location': row.location,
+        'counts': {
+            'messages': message_count,
+            'following': row.following,
+            'followers': row.followers,
+            'likes': row.likes,
+        },
+    }
+
+
+def visible_messages(rows):
+    """Shard rows with their authors attached, minus those by deleted users."""
+
+    return [message for message in hydrate(rows) if not message.user.deleted_at]
+
+
+def liked_message_ids(message_ids):
+    """Which of `message_ids` does the current user like? One query."""
+
+    if not g.user or not message_ids:
+        return set()
+    rows = (db.session.query(Likes.message_id)
+            .filter(Likes.user_id == g.user.id,
+                    Likes.message_id.in_(message_ids)))
+    return {message_id for (message_id,) in rows}
+
+
+def message_page(rows, next_cursor):
+    liked_ids = liked_message_ids([row.id for row in rows])
+    return {
+        'messages': [serialize_message(row, liked_ids) for row in rows],
+        'next_cursor': next_cursor,
+    }
+
+
+##############################################################################
+# Read endpoints
+
+
+@api.route('/timeline')
+def timeline():
+    """Home timeline: messages by followed users and the current user."""
+
+    denied = login_required_json()
+    if denied:
+        return denied
+
+    followed = (db.session.query(Follows.user_being_followed_id)
+                .join(User, User.id == Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == g.user.id,
+                        User.deleted_at.is_(None)))
+    return json_response(message_page(*paginate_messages(
+        [user_id for (user_id,) in followed] + [g.user.id])))
+
+
+@api.route('/users/<int:user_id>')
+def user_profile(user_id):
+    """Profile fields plus message/follow/like counts; messages are
+    counted on the user's shard."""
+
+    def count(column, condition):
+        return (db.session.query(func.count(column))
+                .filter(condition)
+                .correlate(User)
+                .scalar_subquery())
+
+    row = (db.session.query(
+        User.id, User.username, User.image_url, User.header_image_url,
+        User.bio, User.location,
+        count(Follows.user_being_followed_id,
+              Follows.user_following_id == User.id).label('following'),
+        count(Follows.user_following_id,
+              Follows.user_being_followed_id == User.id).label('followers'),
+        count(Likes.id, Likes.user_id == User.id).label('likes'))
+        .filter(User.id == user_id, User.deleted_at.is_(None))
+        .first())
+
+    if row is None:
+        return error(404, "User not found.")
+
+    data = serialize_profile(row, message_shards().count_for_user(user_id))
+    if g.user:
+        data['is_following'] = db.session.query(
+            db.session.query(Follows)
+            .filter_by(user_following_id=g.user.id, user_being_followed_id=user_id)
+            .exists()).scalar()
+
+    return json_response(data)
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """Messages posted by one user, newest first."""
+
+    return json_response(message_page(*paginate_messages([user_id])))
+
+
+@api.route('/messages/<int:message_id>')
+def message_detail(message_id):
+    row = message_shards().get(message_id)
+    messages = visible_messages([row]) if row else []
+    if not messages:
+        return error(404, "Message not found.")
+    return json_response(serialize_message(messages[0], liked_message_ids([message_id])))
+
+
+@api.route('/users/search')
+def search_users():
+    """Users whose username contains `q`, ordered by id."""
+
+    limit = page_size()
+    query = db.session.query(*USER_SUMMARY_COLUMNS).filter(User.deleted_at.is_(None))
+
+    search = request.args.get('q')
+    if search:
+        query = query.filter(User.username.like(f"%{search}%"))
+
+    cursor = decode_cursor(request.args.get('cursor'))
+    if cursor and isinstance(cursor[0], int):
+        query = query.filter(User.id > cursor[0])
+
+    rows = query.order_by(User.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].id)
+
+    return json_response({
+        'users': [serialize_user_summary(row) for row in rows],
+        'next_cursor': next_cursor,
+    })
+
+
+##############################################################################
+# Batch endpoints: one query per request (per shard), at most MAX_BATCH_SIZE ids
+
+
+@api.route('/messages')
+def messages_batch():
+    """Hydrate `ids`, in the order given; unknown ids are left out."""
+
+    ids, failed = batch_ids('ids')
+    if failed:
+        return failed
+
+    rows = message_shards().get_many(ids).values()
+    by_id = {message.id: message for message in visible_messages(rows)}
+    liked_ids = liked_message_ids(list(by_id))
+    return json_response({
+        'messages': [serialize_message(by_id[i], liked_ids)
+                     for i in ids if i in by_id],
+    })
+
+
+@api.route('/likes')
+def likes_batch():
+    """Which of `message_ids` does the current user like?"""
+
+    denied = login_required_json()
+    if denied:
+        return denied
+    ids, failed = batch_ids('message_ids')
+    if failed:
+        return failed
+
+    return json_response({'liked': sorted(liked_message_ids(ids))})
+
+
+@api.route('/following', methods=['GET', 'POST'])
+def following_batch():
+    """GET: which of `user_ids` does the current user follow?
+
+    POST: follow every user in the JSON body's `user_ids` (e.g. onboarding).
+    """
+
+    denied = login_required_json()
+    if denied:
+        return denied
+    ids, failed = batch_ids('user_ids')
+    if failed:
+        return failed
+
+    if request.method == 'POST':
+        added = follow_and_notify(g.user.id, ids) if ids else 0
+        db.session.commit()
+        return json_response({'followed': added})
+
+    followed = Follows.followed_among(g.user.id, ids) if ids else set()
+    return json_response({'following': sorted(followed)})
+
+
+##############################################################################
+# Write endpoints
+
+
+@api.route('/users/<int:user_id>/follow', methods=['POST', 'DELETE'])
+def follow(user_id):
+    """POST follows `user_id`; DELETE unfollows. Both are idempotent."""
+
+    denied = login_required_json()
+    if denied:
+        return denied
+    if user_id == g.user.id:
+        return error(400, "You can't follow yourself.")
+    if not (db.session.query(User.id)
+            .filter(User.id == user_id, User.deleted_at.is_(None))
+            .first()):
+        return error(404, "User not found.")
+
+    existing = (Follows.query
+                .filter_by(user_following_id=g.user.id,
+                           user_being_followed_id=user_id))
+
+    if request.method == 'POST':
+        if not existing.first():
+            db.session.add(Follows(user_following_id=g.user.id,
+                                   user_being_followed_id=user_id))
+            try:
+                # Flush first: a concurrent duplicate fails here, not in
+                # notify()'s autoflush outside this try
+                db.session.flush()
+                notify(user_id, 'follow', g.user.id)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+        return json_response({'following': True})
+
+    existing.delete(synchronize_session=False)
+    db.session.commit()
+    return json_response({'following': False})
+
+
+@api.route('/messages/<int:message_id>/like', methods=['POST', 'DELETE'])
+def like(message_id):
+    """POST likes `message_id`; DELETE unlikes. Both are idempotent."""
+
+    denied = login_required_json()
+    if denied:
+        return denied
+
+    row = message_shards().get(message_id)
+    author_id = row and (db.session.query(User.id)
+                         .filter(User.id == row.user_id, User.deleted_at.is_(None))
+                         .scalar())
+    if author_id is None:
+        return error(404, "Message not found.")
+    if author_id == g.user.id:
+        return error(400, "You can't like your own message.")
+
+    existing = Likes.query.filter_by(user_id=g.user.id, message_id=message_id)
+
+    if request.method == 'POST':
+        if not existing.first():
+            db.session.add(Likes(user_id=g.user.id, message_id=message_id))
+            try:
+                db.session.flush()
+                notify(author_id, 'like', g.user.id, message_id)
+                db.session.commit()
+            except IntegrityError:
+                # A concurrent request liked it first
+                db.session.rollback()
+        return json_response({'liked': True})
+
+    existing.delete(synchronize_session=False)
+    db.session.commit()
+    return json_response({'liked': False})
@@ -1,42 +1,148 @@
+import gc
 import os
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g, abort
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (Flask, render_template, request, flash, redirect, session, g, abort,
+                   send_from_directory)
 from sqlalchemy.exc import IntegrityError
 
+from admission import connect_admission
+from api import api, MAX_BATCH_SIZE
+from assets import connect_assets
+from cache import connect_cache, app_cache
+from coalescing import connect_coalescing, coalesced
+from compression import connect_compression
+from db_pool import connect_pool_metrics, dispose_pools_before_fork
+from db_routing import connect_replicas, primary_reads
+from entity_cache import connect_entity_cache, entity_cache, expire
+from exports import connect_exports, request_export, export_dir, FORMATS
 from forms import UserAddForm, UserEditForm, LoginForm, MessageForm
-from models import db, connect_db, User, Message
+from images import connect_images, save_upload, ImageError
+from jobs import connect_jobs
+from message_ids import connect_message_ids
+from message_index import (connect_message_index, index_message, unindex_messages,
+                           tag_feed, mention_feed)
+from metrics import connect_metrics
+from models import db, connect_db, User, Message, Follows, Likes, Export
+from notifications import (connect_notifications, notify, follow_and_notify,
+                           inbox_page, mark_all_read)
+from profiling import connect_profiler
+from pubsub import connect_pubsub
+from sharding import connect_shards, message_shards, messages_tag, hydrate
+from tasks import message_posted, user_deleted
+from templating import connect_templates
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
-
-connect_db(app)
+def config_from_env():
+    """App config from environment variables (with development defaults)."""
+
+    config = {}
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
+
+    # Optional read replicas, comma-separated; GET requests read from them.
+    config['SQLALCHEMY_REPLICA_URIS'] = [
+        uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if uri]
+
+    # Connection pool sizing; see db_pool.py.
+    for key in ('DB_POOL_SIZE', 'DB_MAX_OVERFLOW', 'DB_POOL_TIMEOUT',
+                'DB_POOL_RECYCLE', 'DB_POOL_PRE_PING'):
+        if key in os.environ:
+            config[key] = int(os.environ[key])
+
+    # bcrypt cost factor; tests turn this down (see testing.py).
+    if os.environ.get('BCRYPT_LOG_ROUNDS'):
+        config['BCRYPT_LOG_ROUNDS'] = int(os.environ['BCRYPT_LOG_ROUNDS'])
+
+    # Optional message shards, comma-separated; see sharding.py.
+    config['MESSAGE_SHARD_URIS'] = [
+        uri for uri in os.environ.get('MESSAGE_SHARD_URLS', '').split(',') if uri]
+
+    # This process's message id worker (0-1023); leased from the database
+    # when unset. See message_ids.py.
+    if os.environ.get('MESSAGE_ID_WORKER'):
+        config['MESSAGE_ID_WORKER'] = int(os.environ['MESSAGE_ID_WORKER'])
+
+    # Messages older than this many days move to the archive; see sharding.py.
+    if os.environ.get('ARCHIVE_AFTER_DAYS'):
+        config['ARCHIVE_AFTER_DAYS'] = int(os.environ['ARCHIVE_AFTER_DAYS'])
+
+    config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    config['SQLALCHEMY_ECHO'] = False
+    config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+    config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+    config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+    config['PUBSUB_URL'] = os.environ.get('PUBSUB_URL')
+    config['CACHE_URL'] = os.environ.get('CACHE_URL')
+    for key in ('CACHE_MAX_ENTRIES', 'CACHE_TTL', 'CACHE_LOCAL_TTL', 'ENTITY_CACHE_TTL'):
+        if key in os.environ:
+            config[key] = int(os.environ[key])
+    config['COALESCE_MAX_WAIT'] = float(os.environ.get('COALESCE_MAX_WAIT', 2))
+    config['COALESCE_SHARED'] = os.environ.get('COALESCE_SHARED') == '1'
+    config['JINJA_CACHE_DIR'] = os.environ.get('JINJA_CACHE_DIR')
+    config['IMAGE_CACHE_DIR'] = os.environ.get('IMAGE_CACHE_DIR')
+    config['IMAGE_UPLOAD_DIR'] = os.environ.get('IMAGE_UPLOAD_DIR')
+    if os.environ.get('IMAGE_CACHE_MAX_BYTES'):
+        config['IMAGE_CACHE_MAX_BYTES'] = int(os.environ['IMAGE_CACHE_MAX_BYTES'])
+    config['STREAM_URL'] = os.environ.get('STREAM_URL')
+    config['EXPORT_DIR'] = os.environ.get('EXPORT_DIR')
+    if os.environ.get('EXPORT_RETENTION_DAYS'):
+        config['EXPORT_RETENTION_DAYS'] = int(os.environ['EXPORT_RETENTION_DAYS'])
+
+    # Threads running the Flask views when served through asgi.py.
+    if os.environ.get('ASGI_WSGI_THREADS'):
+        config['ASGI_WSGI_THREADS'] = int(os.environ['ASGI_WSGI_THREADS'])
+
+    # On-demand sampling profiler; see profiling.py.
+    config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR')
+    config['PROFILER_TOKEN'] = os.environ.get('PROFILER_TOKEN')
+    for key in ('PROFILER_INTERVAL_MS', 'PROFILER_MAX_OVERHEAD', 'PROFILER_SIGNAL_RATE',
+                'PROFILER_SIGNAL_SECONDS'):
+        if key in os.environ:
+            config[key] = float(os.environ[key])
+
+    # Per-worker admission control; see admission.py.
+    config['ADMISSION_ENABLED'] = os.environ.get('ADMISSION_ENABLED', '1') == '1'
+    for key in ('ADMISSION_INITIAL_LIMIT', 'ADMISSION_MIN_LIMIT', 'ADMISSION_MAX_LIMIT',
+                'ADMISSION_RETRY_AFTER', 'ADMISSION_STALE_TTL'):
+        if key in os.environ:
+            config[key] = int(os.environ[key])
+    if os.environ.get('ADMISSION_TARGET_LATENCY'):
+        config['ADMISSION_TARGET_LATENCY'] = float(os.environ['ADMISSION_TARGET_LATENCY'])
+    return config
+
+
+# Routes, registered on each app by create_app(); see `route` below.
+ROUTES = []
+
+
+def route(rule, **options):
+    """Like @app.route, but for the app(s) create_app() builds."""
+
+    def decorator(view):
+        ROUTES.append((rule, view, options))
+        return view
+
+    return decorator
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global.
     g is an object provided by Flask for holding any data during a single app context.
     A before_request handle set g.user, which will be accessible to the route and other functions."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = User.visible().filter_by(id=session[CURR_USER_KEY]).first()
 
     else:
         g.user = None
@@ -55,7 +161,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -92,7 +198,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -112,7 +218,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     """Handle logout of user."""
     do_logout()
@@ -123,7 +229,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -133,31 +239,60 @@ def list_users():
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users = User.visible().all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = User.visible().filter(User.username.like(f"%{search}%")).all()
 
     return render_template('users/index.html', users=users)
 
 
-@app.route('/users/<int:user_id>')
+@route('/users/<int:user_id>')
+@coalesced
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
-
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    user = entity_cache().get(User, user_id)
+    if user is None or user.deleted_at:
+        abort(404)
+
+    # newest first, from the shard holding this user's messages; cached, so
+    # read from the primary rather than a lagging replica
+    with primary_reads(db.session):
+        messages = app_cache().get_or_set(
+            f'messages:user:{user_id}',
+            lambda: message_shards().for_user(user_id, limit=100),
+            tags=[messages_tag(user_id)])
     return render_template('users/show.html', user=user, messages=messages)
 
 
-@app.route('/users/<int:user_id>/following')
+@route('/users/<int:user_id>/mentions')
+def users_mentions(user_id):
+    """Show messages mentioning this user, newest first."""
+
+    user = User.visible().filter_by(id=user_id).first_or_404()
+    messages, next_cursor = mention_feed(user_id, request.args.get('cursor'))
+    return render_template('messages/feed.html', title=f'Mentioning @{user.username}',
+                           messages=messages, next_cursor=next_cursor)
+
+
+@route('/notifications')
+def notifications_index():
+    """Show the current user's notifications; the first page marks them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    cursor = request.args.get('cursor')
+    entries, next_cursor = inbox_page(g.user.id, cursor)
+    if not cursor:
+        mark_all_read(g.user.id)
+        db.session.commit()
+    return render_template('users/notifications.html', entries=entries,
+                           next_cursor=next_cursor)
+
+
+@route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -165,11 +300,11 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = User.visible().filter_by(id=user_id).first_or_404()
     return render_template('users/following.html', user=user)
 
 
-@app.route('/users/<int:user_id>/followers')
+@route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -177,11 +312,11 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = User.visible().filter_by(id=user_id).first_or_404()
     return render_template('users/followers.html', user=user)
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -189,14 +324,32 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = User.visible().filter_by(id=follow_id).first_or_404()
+    if followed_user not in g.user.following:
+        g.user.following.append(followed_user)
+        notify(followed_user.id, 'follow', g.user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@route('/users/follow', methods=['POST'])
+def add_follows():
+    """Follow every user checked in the form (e.g. during onboarding)."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    follow_ids = request.form.getlist('follow_id', type=int)[:MAX_BATCH_SIZE]
+    if follow_ids:
+        follow_and_notify(g.user.id, follow_ids)
+        db.session.commit()
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -211,7 +364,7 @@ def stop_following(follow_id):
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -228,10 +381,20 @@ def profile():
             user.username = form.username.data
             user.email = form.email.data
             user.image_url = form.image_url.data or User.image_url.default.arg
-            user.header_image_url = form.header_image_url.data or User.header_image_url.arg
+            user.header_image_url = form.header_image_url.data or User.header_image_url.default.arg
             user.bio = form.bio.data
             user.location = form.location.data
 
+            try:
+                if form.image_file.data:
+                    user.image_url = save_upload(form.image_file.data)
+                if form.header_image_file.data:
+                    user.header_image_url = save_upload(form.header_image_file.data)
+            except ImageError as exc:
+                db.session.rollback()
+                flash(f'Could not use that image: {exc}', 'danger')
+                return render_template('users/edit.html', form=form, user=g.user)
+
             db.session.commit()
             flash(f'Profile "{g.user.username}" updated.', 'success')
             
@@ -242,9 +405,13 @@ def profile():
     return render_template('users/edit.html', form=form, user=g.user)
 
 
-@app.route('/users/delete', methods=["POST"])
+@route('/users/delete', methods=["POST"])
 def delete_user():
-    """Delete user."""
+    """Delete user.
+
+    The account is tombstoned right away (hidden everywhere) and its
+    follows, likes and messages are purged in batches by a background job.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -252,13 +419,53 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    g.user.deleted_at = datetime.utcnow()
+    user_deleted(g.user.id)
     db.session.commit()
 
     return redirect("/signup")
 
 
-@app.route('/users/<int:user_id>/likes', methods=['GET'])
+@route('/users/exports', methods=['GET', 'POST'])
+def users_exports():
+    """List the current user's data exports; POST requests a new one."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if request.method == 'POST':
+        fmt = request.form.get('format', 'csv')
+        if fmt not in FORMATS:
+            abort(400)
+        request_export(g.user.id, fmt)
+        db.session.commit()
+        flash("We're preparing your export; it will be listed here when it's ready.",
+              "success")
+        return redirect("/users/exports")
+
+    exports = (Export.query
+               .filter_by(user_id=g.user.id)
+               .order_by(Export.created_at.desc(), Export.id.desc())
+               .all())
+    return render_template('users/exports.html', exports=exports)
+
+
+@route('/users/exports/<int:export_id>/download')
+def users_export_download(export_id):
+    """Download one of the current user's finished exports."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    export = (Export.query
+              .filter_by(id=export_id, user_id=g.user.id, status='done')
+              .first_or_404())
+    return send_from_directory(export_dir(), export.filename, as_attachment=True)
+
+
+@route('/users/<int:user_id>/likes', methods=['GET'])
 def add_like(user_id):
     """Show user's liked warbles."""
 
@@ -266,14 +473,21 @@ def add_like(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user, likes=user.likes)
+    user = User.visible().filter_by(id=user_id).first_or_404()
+    liked_ids = [message_id for (message_id,) in
+                 db.session.query(Likes.message_id)
+                 .filter(Likes.user_id == user_id)
+                 .order_by(Likes.id.desc())]
+    rows = message_shards().get_many(liked_ids)
+    likes = [msg for msg in hydrate([rows[i] for i in liked_ids if i in rows])
+             if not msg.user.deleted_at]
+    return render_template('users/likes.html', user=user, likes=likes)
 
 
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -287,24 +501,42 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = message_shards().add(g.user.id, form.text.data)
+        for user_id in index_message(msg):
+            notify(user_id, 'mention', g.user.id, msg.id)
+        # fan-out and other side effects run in the job workers
+        message_posted(msg.id)
         db.session.commit()
+        app_cache().invalidate_tags(messages_tag(g.user.id))
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@route('/tags/<tag>')
+def tags_show(tag):
+    """Show messages tagged #tag, newest first."""
+
+    messages, next_cursor = tag_feed(tag, request.args.get('cursor'))
+    return render_template('messages/feed.html', title=f'#{tag.lower()}',
+                           messages=messages, next_cursor=next_cursor)
+
+
+@route('/messages/<int:message_id>', methods=["GET"])
+@coalesced
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    row = entity_cache().get(Message, message_id)
+    msg = hydrate([row])[0] if row else None
+    if msg is None or msg.user.deleted_at:
+        abort(404)
+
     return render_template('messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/like', methods=['POST'])
+@route('/messages/<int:message_id>/like', methods=['POST'])
 def toggle_like(message_id):
     """Toggle the like button for a message."""
 
@@ -312,22 +544,30 @@ def toggle_like(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    liked_message = Message.query.get_or_404(message_id)
+    liked_message = message_shards().get(message_id)
+    if (liked_message is None
+            or not User.visible().filter_by(id=liked_message.user_id).first()):
+        abort(404)
     if liked_message.user_id == g.user.id:
         return redirect('/')
-    
-    user_likes = g.user.likes
 
-    if liked_message in user_likes:
-        g.user.likes = [like for like in user_likes if like != liked_message]
+    existing = Likes.query.filter_by(user_id=g.user.id, message_id=message_id)
+    if existing.first():
+        existing.delete(synchronize_session=False)
+        db.session.commit()
     else:
-        g.user.likes.append(liked_message)
-    
-    db.session.commit()
+        db.session.add(Likes(user_id=g.user.id, message_id=message_id))
+        try:
+            db.session.flush()
+            notify(liked_message.user_id, 'like', g.user.id, message_id)
+            db.session.commit()
+        except IntegrityError:
+            # Liked twice at once; the other request already notified
+            db.session.rollback()
     return redirect('/')
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -335,13 +575,16 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    if msg.user_id != g.user.id:
+    msg = message_shards().get(message_id)
+    if msg is None or msg.user_id != g.user.id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    db.session.delete(msg)
+    message_shards().delete(msg.id, g.user.id)
+    unindex_messages([msg.id])
+    expire(Message, [msg.id])
     db.session.commit()
+    app_cache().invalidate_tags(messages_tag(g.user.id))
 
     return redirect(f"/users/{g.user.id}")
 
@@ -350,7 +593,7 @@ def messages_destroy(message_id):
 # Homepage and error pages
 
 
-@app.route('/')
+@route('/')
 def homepage():
     """Show homepage:
 
@@ -360,14 +603,9 @@ def homepage():
 
     if g.user:
         following_ids = [f.id for f in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        messages = hydrate(message_shards().feed(following_ids, limit=100))
         
-        liked_msg_ids = [msg.id for msg in g.user.likes]
+        liked_msg_ids = Likes.liked_among(g.user.id, [msg.id for msg in messages])
 
         return render_template('home.html', messages=messages, likes=liked_msg_ids)
 
@@ -375,7 +613,6 @@ def homepage():
         return render_template('home-anon.html')
 
 
-@app.errorhandler(404)
 def page_not_found(e):
     """404 NOT FOUND page."""
 
@@ -389,12 +626,92 @@ def page_not_found(e):
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+# Views that set their own (far-future) caching headers; see assets.py and images.py.
+SELF_CACHING_ENDPOINTS = frozenset({'serve_asset', 'image_thumbnail', 'image_original'})
+
+
 def add_header(req):
     """Add non-caching headers on every request."""
 
+    # hashed assets and image thumbnails/uploads keep their own caching headers
+    if request.endpoint in SELF_CACHING_ENDPOINTS:
+        return req
+
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
     req.headers['Cache-Control'] = 'public, max-age=0'
     return req
+
+
+##############################################################################
+# App factory
+
+
+def create_app(config=None):
+    """Build the Warbler app: config from the environment, then `config`.
+
+    Creating the app opens no database connections; pools fill on first
+    use and are emptied before any fork (see db_pool).
+    """
+
+    app = Flask(__name__)
+    app.config.update(config_from_env())
+    app.config.update(config or {})
+
+    if app.debug:
+        # Dev-only; importing it costs startup time in production
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    connect_replicas(app, db)
+    connect_cache(app)
+    connect_entity_cache(app)
+    connect_coalescing(app)
+    connect_message_ids(app)
+    connect_shards(app)
+    connect_pool_metrics(app)
+    connect_assets(app)
+    connect_images(app)
+    connect_message_index(app)
+    connect_notifications(app)
+    connect_metrics(app)
+    connect_profiler(app)
+    connect_compression(app)
+    connect_pubsub(app)
+    connect_jobs(app)
+    connect_exports(app)
+    app.register_blueprint(api)
+
+    # Sheds load before add_user_to_g's query
+    connect_admission(app, CURR_USER_KEY)
+    app.before_request(add_user_to_g)
+    for rule, view, options in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.register_error_handler(404, page_not_found)
+    app.add_template_global(User.profile_counts, 'profile_counts')
+    app.after_request(add_header)
+
+    connect_templates(app)
+    dispose_pools_before_fork(app)
+    return app
+
+
+def preload_app(config=None):
+    """create_app() for a pre-forking server, e.g.
+
+        gunicorn -c gunicorn.conf.py --preload 'app:preload_app()'
+
+    Everything is built and templates compiled once in the master; then
+    gc.freeze() keeps the collector from touching those objects, so the
+    workers' copy-on-write pages stay shared.
+    """
+
+    app = create_app(config)
+    gc.collect()
+    gc.freeze()
+    return app
+
+
+app = create_app()
@@ -0,0 +1,625 @@
+"""ASGI entry point, with async database reads on the busiest read paths.
+
+    uvicorn --factory asgi:create_asgi_app --workers 4
+
+Under WSGI a worker thread is pinned for as long as its request waits on
+the database. Here these read paths instead run as coroutines on
+SQLAlchemy's asyncio engine (asyncpg for Postgres, aiosqlite for SQLite),
+so a worker keeps many requests in flight while they wait:
+
+    GET /                        home feed
+    GET /users/<id>              profile
+    GET /messages/<id>           message page
+    GET /api/v1/timeline, /api/v1/users/<id>, /api/v1/users/<id>/messages
+        and /api/v1/messages/<id>
+
+They read the same tables as the Flask views (the models' tables, the
+shards and the archive, replicas for GETs) and render the same templates,
+with plain rows standing in for ORM objects. Everything else (writes,
+forms, the other pages) goes to the Flask app unchanged, on a thread pool
+of ASGI_WSGI_THREADS (default 20), and STREAM_PATH goes to the SSE stream
+app, so this one server replaces both. A view moves over by adding it to
+`AsgiApp.routes`.
+
+Caching, request coalescing and admission control still only apply on the
+Flask side. The async drivers (asyncpg, aiosqlite) are in requirements.txt.
+"""
+
+import asyncio
+import heapq
+import random
+import re
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from itertools import islice
+from types import SimpleNamespace
+
+from flask import g, request, session, render_template
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+from api import (json_response, error, page_size, decode_cursor, cursor_id,
+                 encode_cursor, serialize_message, serialize_profile)
+from db_pool import engine_options
+from db_routing import LAST_WRITE_KEY, DEFAULT_STICKY_SECONDS
+from metrics import metrics
+from models import User, Follows, Likes, Inbox, ProfileCounts
+from sharding import MessageRow, ShardedMessage
+from stream import STREAM_PATH, create_stream_app
+
+DEFAULT_WSGI_THREADS = 20
+FEED_SIZE = 100
+
+ASYNC_DRIVERS = {
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_url(uri):
+    """`uri` with its database's async driver, e.g. postgresql+asyncpg://."""
+
+    scheme, sep, rest = uri.partition('://')
+    dialect = scheme.split('+')[0]
+    if not sep or dialect not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for {scheme} URLs.")
+    return f'{ASYNC_DRIVERS[dialect]}://{rest}'
+
+
+##############################################################################
+# ASGI <-> WSGI
+
+
+def wsgi_environ(scope, body):
+    """A WSGI environ for the ASGI HTTP `scope` and request `body`."""
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f'HTTP_{key}'
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+async def start_response(send, status, headers):
+    await send({'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers]})
+
+
+class WsgiFallback:
+    """ASGI app running a WSGI app on a thread pool.
+
+    The request body is read in full first; the response is sent chunk by
+    chunk as the WSGI app yields it, so streamed downloads stay streamed.
+    """
+
+    def __init__(self, wsgi_app, threads=DEFAULT_WSGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads,
+                                           thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        await self.serve(wsgi_environ(scope, await read_body(receive)), send)
+
+    async def serve(self, environ, send):
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def begin(status, headers, exc_info=None):
+            started['status'], started['headers'] = status, headers
+
+            def write(data):
+                raise NotImplementedError("write() is not supported; return an iterable.")
+            return write
+
+        body = await loop.run_in_executor(self.executor, self.wsgi_app, environ, begin)
+        chunks = iter(body)
+        try:
+            # Some WSGI apps only call start_response on the first chunk.
+            chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            await start_response(send, started['status'], started['headers'])
+            while chunk is not None:
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(body, 'close'):
+                await loop.run_in_executor(self.executor, body.close)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+##############################################################################
+# Async reads
+
+
+class Counted:
+    """Stands in for a relationship list when templates only take its |length."""
+
+    def __init__(self, count):
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+
+class UserView(SimpleNamespace):
+    """The User attributes templates read, loaded without the ORM."""
+
+    def is_following(self, other):
+        return other.id in self.following_ids
+
+
+def _message_columns(table):
+    return [table.c.id, table.c.text, table.c.timestamp, table.c.user_id]
+
+
+def _count(column, condition):
+    return select(func.count(column)).where(condition).scalar_subquery()
+
+
+def _visible_follows(user_column, other_column, user_id):
+    """Follows with `user_id` at `user_column` whose other user (at
+    `other_column`) isn't deleted, as the User relationships have them."""
+
+    return (select(other_column)
+            .join_from(Follows, User, User.id == other_column)
+            .where(user_column == user_id, User.deleted_at.is_(None)))
+
+
+class AsyncDatabase:
+    """Async engines for the app's databases, and the async views' queries.
+
+    Each request gets an AsyncSession on the primary, or on a replica when
+    `use_replica` (see db_routing). Messages are read through `shards`, the
+    app's MessageShards, for its routing and tables: unsharded they are in
+    the session's database; sharded, each shard has its own engine and a
+    feed or id lookup queries the shards concurrently.
+    """
+
+    def __init__(self, primary, shards, replicas=(), shard_engines=()):
+        self.primary = primary
+        self.shards = shards
+        self.replicas = list(replicas)
+        self.shard_engines = list(shard_engines)
+
+    def session(self, use_replica=False):
+        bind = (random.choice(self.replicas) if use_replica and self.replicas
+                else self.primary)
+        return AsyncSession(bind)
+
+    async def dispose(self):
+        for engine in [self.primary] + self.replicas + self.shard_engines:
+            await engine.dispose()
+
+    @staticmethod
+    async def all(session, query):
+        return (await session.execute(query)).all()
+
+    ##########################################################################
+    # Messages, mirroring MessageShards' reads
+
+    async def _rows(self, session, index, query):
+        if not self.shards.sharded:
+            rows = await self.all(session, query)
+        else:
+            async with self.shard_engines[index].connect() as conn:
+                rows = (await conn.execute(query)).all()
+        return [MessageRow(*row) for row in rows]
+
+    def _tables(self):
+        shards = self.shards
+        return [shards.table] + ([shards.archive_table] if shards.archive_after else [])
+
+    async def _newest(self, session, index, condition, limit, before=None):
+        def query(table):
+            query = (select(*_message_columns(table))
+                     .where(condition(table))
+                     .order_by(table.c.id.desc())
+                     .limit(limit))
+            return query if before is None else query.where(table.c.id < before)
+
+        rows = await self._rows(session, index, query(self.shards.table))
+        cutoff = self.shards.cutoff()
+        if cutoff and (len(rows) < limit or rows[-1].timestamp < cutoff):
+            archived = await self._rows(session, index, query(self.shards.archive_table))
+            rows = list(islice(heapq.merge(rows, archived, reverse=True,
+                                           key=lambda row: row.id),
+                               limit))
+        return rows
+
+    async def for_user(self, session, user_id, limit=FEED_SIZE):
+        return await self._newest(session, self.shards.shard_index(user_id),
+                                  lambda table: table.c.user_id == user_id, limit)
+
+    async def feed(self, session, user_ids, limit=FEED_SIZE, before=None):
+        by_shard = defaultdict(list)
+        for user_id in user_ids:
+            by_shard[self.shards.shard_index(user_id)].append(user_id)
+
+        per_shard = await asyncio.gather(*(
+            self._newest(session, index, lambda table, ids=ids: table.c.user_id.in_(ids),
+                         limit, before)
+            for index, ids in by_shard.items()))
+        return list(islice(heapq.merge(*per_shard, reverse=True, key=lambda row: row.id),
+                           limit))
+
+    async def get_message(self, session, message_id):
+        async def on_shard(index):
+            for table in self._tables():
+                rows = await self._rows(session, index,
+                                        select(*_message_columns(table))
+                                        .where(table.c.id == message_id))
+                if rows:
+                    return rows[0]
+            return None
+
+        found = await asyncio.gather(*(on_shard(index)
+                                       for index in range(self.shards.count)))
+        return next((row for row in found if row), None)
+
+    async def count_for_user(self, session, user_id):
+        index = self.shards.shard_index(user_id)
+        total = 0
+        for table in self._tables():
+            query = (select(func.count()).select_from(table)
+                     .where(table.c.user_id == user_id))
+            if not self.shards.sharded:
+                total += (await session.execute(query)).scalar()
+            else:
+                async with self.shard_engines[index].connect() as conn:
+                    total += (await conn.execute(query)).scalar()
+        return total
+
+    async def hydrate(self, session, rows):
+        """Like sharding.hydrate: attach authors, in one IN query. Messages
+        by deleted users are dropped."""
+
+        user_ids = {row.user_id for row in rows}
+        if not user_ids:
+            return []
+        authors = await self.all(session, select(
+            User.id, User.username, User.image_url)
+            .where(User.id.in_(user_ids), User.deleted_at.is_(None)))
+        users = {author.id: author for author in authors}
+        return [ShardedMessage(*row, users[row.user_id])
+                for row in rows if row.user_id in users]
+
+    ##########################################################################
+    # Users
+
+    async def user(self, session, user_id):
+        """UserView of a visible user, or None."""
+
+        row = (await session.execute(select(
+            User.id, User.username, User.image_url, User.header_image_url,
+            User.bio, User.location)
+            .where(User.id == user_id, User.deleted_at.is_(None)))).first()
+        return UserView(**row._asdict()) if row else None
+
+    async def viewer(self, session, user_id):
+        """UserView of the logged-in user: who they follow, unread count."""
+
+        user = await self.user(session, user_id)
+        if user is None:
+            return None
+        following = await self.all(session, _visible_follows(
+            Follows.user_following_id, Follows.user_being_followed_id, user_id))
+        user.following_ids = {followed_id for (followed_id,) in following}
+        user.following = Counted(len(user.following_ids))
+        user.unread = (await session.execute(
+            select(Inbox.unread).where(Inbox.user_id == user_id))).scalar() or 0
+        return user
+
+    async def add_counts(self, session, user):
+        """Give `user` the counts shown on its profile card."""
+
+        def count(query):
+            return select(func.count()).select_from(query.subquery()).scalar_subquery()
+
+        counts = (await session.execute(select(
+            count(_visible_follows(Follows.user_following_id,
+                                   Follows.user_being_followed_id, user.id)),
+            count(_visible_follows(Follows.user_being_followed_id,
+                                   Follows.user_following_id, user.id)),
+            count(select(Likes.id).where(Likes.user_id == user.id))))).first()
+        user.following, user.followers, user.likes = (Counted(n) for n in counts)
+        user.counts = ProfileCounts(*counts)
+        user.message_count = await self.count_for_user(session, user.id)
+        return user
+
+    async def profile_row(self, session, user_id):
+        """The row api.serialize_profile takes (with count_for_user), or None."""
+
+        return (await session.execute(select(
+            User.id, User.username, User.image_url, User.header_image_url,
+            User.bio, User.location,
+            _count(Follows.user_being_followed_id,
+                   Follows.user_following_id == User.id).label('following'),
+            _count(Follows.user_following_id,
+                   Follows.user_being_followed_id == User.id).label('followers'),
+            _count(Likes.id, Likes.user_id == User.id).label('likes'))
+            .where(User.id == user_id, User.deleted_at.is_(None)))).first()
+
+    async def liked_ids(self, session, user, message_ids):
+        if user is None or not message_ids:
+            return set()
+        rows = await self.all(session, select(Likes.message_id)
+                              .where(Likes.user_id == user.id,
+                                     Likes.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in rows}
+
+    ##########################################################################
+    # JSON API messages
+
+    async def api_page(self, session, user_ids, limit, before):
+        """api.paginate_messages: (messages, next_cursor), newest first."""
+
+        rows = await self.feed(session, user_ids, limit + 1, before)
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].id)
+        return await self.hydrate(session, rows), next_cursor
+
+
+##############################################################################
+# Async views
+#
+# Each takes (app, db session, request info, URL args) and returns a
+# function that builds the response; that runs later inside a Flask
+# request context, with no awaits, since Flask's context locals are
+# per-thread rather than per-task.
+
+
+def render(template, **context):
+    """render_template with the template globals that query the database
+    answered from what the view already loaded."""
+
+    return render_template(template,
+                           message_count=lambda user: user.message_count,
+                           profile_counts=lambda user_id: context['user'].counts,
+                           unread_notifications=lambda: g.user.unread if g.user else 0,
+                           **context)
+
+
+def not_found():
+    return render('404.html'), 404
+
+
+async def homepage(app, session, req):
+    user = req.user
+    if user is None:
+        return lambda: render('home-anon.html')
+
+    await app.db.add_counts(session, user)
+    rows = await app.db.feed(session, list(user.following_ids) + [user.id])
+    messages = await app.db.hydrate(session, rows)
+    likes = await app.db.liked_ids(session, user, [msg.id for msg in messages])
+    return lambda: render('home.html', messages=messages, likes=likes)
+
+
+async def users_show(app, session, req, user_id):
+    user = await app.db.user(session, user_id)
+    if user is None:
+        return not_found
+    await app.db.add_counts(session, user)
+    messages = await app.db.for_user(session, user_id)
+    return lambda: render('users/show.html', user=user, messages=messages)
+
+
+async def messages_show(app, session, req, message_id):
+    row = await app.db.get_message(session, message_id)
+    messages = await app.db.hydrate(session, [row]) if row else []
+    if not messages:
+        return not_found
+    return lambda: render('messages/show.html', message=messages[0])
+
+
+async def message_page(app, session, req, user_ids):
+    rows, next_cursor = await app.db.api_page(session, user_ids, req.limit, req.before)
+    liked = await app.db.liked_ids(session, req.user, [row.id for row in rows])
+    page = {'messages': [serialize_message(row, liked) for row in rows],
+            'next_cursor': next_cursor}
+    return lambda: json_response(page)
+
+
+async def api_timeline(app, session, req):
+    user = req.user
+    if user is None:
+        return lambda: error(401, "Authentication required.")
+
+    return await message_page(app, session, req,
+                              list(user.following_ids) + [user.id])
+
+
+async def api_user_profile(app, session, req, user_id):
+    row = await app.db.profile_row(session, user_id)
+    if row is None:
+        return lambda: error(404, "User not found.")
+    data = serialize_profile(row, await app.db.count_for_user(session, user_id))
+    if req.user:
+        data['is_following'] = user_id in req.user.following_ids
+    return lambda: json_response(data)
+
+
+async def api_user_messages(app, session, req, user_id):
+    return await message_page(app, session, req, [user_id])
+
+
+async def api_message_detail(app, session, req, message_id):
+    row = await app.db.get_message(session, message_id)
+    messages = await app.db.hydrate(session, [row]) if row else []
+    if not messages:
+        return lambda: error(404, "Message not found.")
+    liked = await app.db.liked_ids(session, req.user, [message_id])
+    return lambda: json_response(serialize_message(messages[0], liked))
+
+
+##############################################################################
+# The app
+
+
+class AsgiApp:
+    """Async read views, the SSE stream, and the Flask app for the rest.
+
+    `finish_response(response)` is applied to every async view's Flask
+    response, as the Flask app's own after_request handlers would be.
+    """
+
+    routes = [
+        (r'/', homepage),
+        (r'/users/(?P<user_id>\d+)', users_show),
+        (r'/messages/(?P<message_id>\d+)', messages_show),
+        (r'/api/v1/timeline', api_timeline),
+        (r'/api/v1/users/(?P<user_id>\d+)', api_user_profile),
+        (r'/api/v1/users/(?P<user_id>\d+)/messages', api_user_messages),
+        (r'/api/v1/messages/(?P<message_id>\d+)', api_message_detail),
+    ]
+
+    def __init__(self, flask_app, db, user_key, finish_response=None, stream=None,
+                 wsgi_threads=DEFAULT_WSGI_THREADS):
+        self.flask_app = flask_app
+        self.db = db
+        self.user_key = user_key
+        self.finish_response = finish_response or (lambda response: response)
+        self.stream = stream
+        self.wsgi = WsgiFallback(flask_app, wsgi_threads)
+        self.sticky_seconds = flask_app.config.get('REPLICA_STICKY_SECONDS',
+                                                   DEFAULT_STICKY_SECONDS)
+        self._routes = [(re.compile(pattern + '$'), view) for pattern, view in self.routes]
+
+    def match(self, scope):
+        if scope['method'] not in ('GET', 'HEAD'):
+            return None, None
+        for pattern, view in self._routes:
+            found = pattern.match(scope['path'])
+            if found:
+                return view, {name: int(value) for name, value in found.groupdict().items()}
+        return None, None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if self.stream and scope['path'] == STREAM_PATH:
+                await self.stream(scope, receive, send)
+            else:
+                await self.handle(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.stream:
+                    self.stream.subscribe(asyncio.get_running_loop())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.stream:
+                    self.stream.shutdown()
+                self.wsgi.shutdown()
+                await self.db.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, scope, receive, send):
+        environ = wsgi_environ(scope, await read_body(receive))
+        view, args = self.match(scope)
+        if view is None:
+            metrics.inc('asgi_requests_total', handler='wsgi')
+            await self.wsgi.serve(environ, send)
+            return
+
+        metrics.inc('asgi_requests_total', handler='async')
+        with self.flask_app.request_context(environ):
+            user_id = session.get(self.user_key)
+            use_replica = time.time() - session.get(LAST_WRITE_KEY, 0) > self.sticky_seconds
+            req = SimpleNamespace(user=None, limit=page_size(),
+                                  before=cursor_id(decode_cursor(request.args.get('cursor'))))
+
+        async with self.db.session(use_replica) as db_session:
+            if user_id is not None:
+                req.user = await self.db.viewer(db_session, user_id)
+            build = await view(self, db_session, req, **args)
+
+        with self.flask_app.request_context(environ) as ctx:
+            g.user = req.user
+            response = self.finish_response(self.flask_app.make_response(build()))
+            self.flask_app.session_interface.save_session(self.flask_app, ctx.session,
+                                                          response)
+            body, status, headers = response.get_wsgi_response(environ)
+            body = b''.join(body)
+
+        await start_response(send, status, headers)
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def create_asgi_app(flask_app=None):
+    """Build an AsgiApp in front of `flask_app` (default: app.app), with
+    async engines for its primary, replica and shard databases."""
+
+    from app import CURR_USER_KEY, add_header
+
+    if flask_app is None:
+        from app import app as flask_app
+
+    config = flask_app.config
+
+    def engine(uri, name):
+        options = engine_options(uri, config, name)
+        # The async engine brings its own (async-adapted) queue pool
+        options.pop('poolclass', None)
+        return create_async_engine(async_url(uri), **options)
+
+    db = AsyncDatabase(
+        engine(config['SQLALCHEMY_DATABASE_URI'], 'primary'),
+        flask_app.extensions['message_shards'],
+        replicas=[engine(uri, f'replica{i}') for i, uri
+                  in enumerate(config.get('SQLALCHEMY_REPLICA_URIS') or [])],
+        shard_engines=[engine(uri, f'shard{i}') for i, uri
+                       in enumerate(config.get('MESSAGE_SHARD_URIS') or [])])
+
+    return AsgiApp(flask_app, db, CURR_USER_KEY,
+                   finish_response=add_header,
+                   stream=create_stream_app(flask_app),
+                   wsgi_threads=config.get('ASGI_WSGI_THREADS', DEFAULT_WSGI_THREADS))
@@ -0,0 +1,195 @@
+"""Content-hashed, precompressed static assets for Warbler.
+
+`build_assets` copies everything under static/ into static/dist/ with a
+content hash in each filename, writes gzip (and, if the `brotli` package is
+installed, brotli) variants next to the compressible files and records the
+logical -> hashed mapping in static/dist/manifest.json.
+
+At runtime `connect_assets` loads that manifest, gives templates an
+`asset_url()` helper and serves the hashed files from /assets/ with
+far-future caching headers, preferring a precompressed variant the client
+accepts. Without a manifest (e.g. in dev before a build) `asset_url()` falls
+back to the plain /static/ URLs.
+
+Build with:
+
+    FLASK_APP=app.py flask build-assets
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+ASSETS_URL_PREFIX = '/assets'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Images are already compressed; only text-ish assets get precompressed.
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.ico', '.json', '.txt'}
+
+# Content-Encoding -> file suffix, in order of preference.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+CSS_URL_RE = re.compile(r'''url\(\s*(["']?)/static/([^"')]+)\1\s*\)''')
+
+
+##############################################################################
+# Build step
+
+
+def hashed_name(rel_path, content):
+    """Return `rel_path` with a short content hash before its extension."""
+
+    stem, ext = os.path.splitext(rel_path)
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return f"{stem}.{digest}{ext}"
+
+
+def rewrite_css_urls(css, manifest):
+    """Point url(/static/...) references in a stylesheet at hashed assets."""
+
+    def replace(match):
+        quote, path = match.groups()
+        if path not in manifest:
+            return match.group(0)
+        return f"url({quote}{ASSETS_URL_PREFIX}/{manifest[path]}{quote})"
+
+    return CSS_URL_RE.sub(replace, css.decode('utf-8')).encode('utf-8')
+
+
+def precompress(path, content):
+    """Write .gz/.br siblings of `path` when they are smaller than `content`."""
+
+    variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+    if brotli:
+        variants.append(('.br', brotli.compress(content)))
+
+    for suffix, compressed in variants:
+        if len(compressed) < len(content):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+
+
+def build_assets(static_folder):
+    """Fingerprint and precompress every file under `static_folder`.
+
+    Returns the manifest mapping logical paths (relative to static/) to
+    hashed paths (relative to static/dist/).
+    """
+
+    dist = os.path.join(static_folder, DIST_DIR)
+    shutil.rmtree(dist, ignore_errors=True)
+
+    sources = []
+    for root, dirs, files in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(static_folder):
+            dirs[:] = [d for d in dirs if d != DIST_DIR]
+        for filename in files:
+            full = os.path.join(root, filename)
+            sources.append(os.path.relpath(full, static_folder).replace(os.sep, '/'))
+
+    # Stylesheets go last so their url() references can be rewritten to
+    # the already-hashed images.
+    sources.sort(key=lambda rel: (rel.endswith('.css'), rel))
+
+    manifest = {}
+    for rel in sources:
+        with open(os.path.join(static_folder, rel), 'rb') as f:
+            content = f.read()
+
+        if rel.endswith('.css'):
+            content = rewrite_css_urls(content, manifest)
+
+        target_rel = hashed_name(rel, content)
+        target = os.path.join(dist, target_rel)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(content)
+
+        if os.path.splitext(rel)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+            precompress(target, content)
+
+        manifest[rel] = target_rel
+
+    with open(os.path.join(dist, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+##############################################################################
+# Runtime
+
+
+def load_manifest(static_folder):
+    """Read the asset manifest, or return {} if assets haven't been built."""
+
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def asset_url(path):
+    """URL for static file `path`: hashed if built, plain /static/ if not."""
+
+    manifest = current_app.extensions['assets']
+    if path in manifest:
+        return url_for('serve_asset', filename=manifest[path])
+    return url_for('static', filename=path)
+
+
+def serve_asset(filename):
+    """Serve a hashed asset, using a precompressed variant when accepted."""
+
+    dist = os.path.join(current_app.static_folder, DIST_DIR)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    for encoding, suffix in ENCODINGS:
+        if (request.accept_encodings[encoding]
+                and os.path.isfile(os.path.join(dist, filename + suffix))):
+            response = send_from_directory(dist, filename + suffix,
+                                           mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(dist, filename, mimetype=mimetype)
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+def connect_assets(app):
+    """Register the asset manifest, route, template helper and CLI command.
+
+    Files are handed to the server via `send_file`, so they go out through
+    wsgi.file_wrapper (sendfile) or X-Sendfile when USE_X_SENDFILE is set.
+    """
+
+    app.extensions['assets'] = load_manifest(app.static_folder)
+    app.add_url_rule(f'{ASSETS_URL_PREFIX}/<path:filename>', 'serve_asset',
+                     serve_asset)
+    app.add_template_global(asset_url)
+
+    @app.cli.command('build-assets')
+    def build_assets_command():
+        """Fingerprint and precompress static files into static/dist/."""
+
+        manifest = build_assets(app.static_folder)
+        app.extensions['assets'] = manifest
+        print(f"Built {len(manifest)} assets into "
+              f"{os.path.join(app.static_folder, DIST_DIR)}")
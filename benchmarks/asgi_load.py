@@ -0,0 +1,202 @@
+"""Load test: the WSGI app against the ASGI entry point, many connections.
+
+Both serve the same request mix (home feed, profile, message page and JSON
+API reads, logged in as random users) from the same seeded database, with
+--connections clients each sending requests back to back. The WSGI app
+gets --threads worker threads, like one gunicorn gthread worker; the ASGI
+app (asgi.py) runs every request as a coroutine on one event loop, like one
+uvicorn worker. Requests go straight to each app, without an HTTP server,
+so the numbers compare the apps' concurrency, not the servers'.
+
+Each query is delayed by --latency-ms to stand in for the round trip to a
+database server: a sleep that blocks the thread under WSGI, an await under
+ASGI. Use --latency-ms 0 against a real server with --url.
+
+    python benchmarks/asgi_load.py                  # temporary SQLite file
+    python benchmarks/asgi_load.py --connections 200 --threads 20
+    python benchmarks/asgi_load.py --url postgresql:///warbler-bench --latency-ms 0
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+os.environ.setdefault(
+    'DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+os.environ.setdefault('JINJA_CACHE_DIR', tempfile.mkdtemp())
+
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.util import await_only  # noqa: E402
+
+from app import create_app, CURR_USER_KEY  # noqa: E402
+from asgi import create_asgi_app, wsgi_environ  # noqa: E402
+from models import db, User, Follows  # noqa: E402
+from sharding import message_shards  # noqa: E402
+
+
+def seed(app, users, following, messages):
+    with app.app_context():
+        db.create_all()
+        rows = [User(username=f'bench{i}', email=f'bench{i}@test.com', password='x')
+                for i in range(users)]
+        db.session.add_all(rows)
+        db.session.commit()
+        user_ids = [user.id for user in rows]
+        for user_id in user_ids:
+            for followed in random.sample(user_ids, following):
+                if followed != user_id:
+                    db.session.add(Follows(user_following_id=user_id,
+                                           user_being_followed_id=followed))
+        db.session.commit()
+        shards = message_shards()
+        message_ids = [shards.add(user_id, f'warble {n} from {user_id}').id
+                       for n in range(messages) for user_id in user_ids]
+        db.session.commit()
+    return user_ids, message_ids
+
+
+def add_latency(app, asgi_app, latency):
+    """Delay every query by `latency` seconds, on both apps' engines."""
+
+    def blocking(*args):
+        time.sleep(latency)
+
+    def awaiting(*args):
+        await_only(asyncio.sleep(latency))
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', blocking)
+    event.listen(asgi_app.db.primary.sync_engine, 'before_cursor_execute', awaiting)
+
+
+def make_scopes(app, user_ids, message_ids, count):
+    """`count` request scopes: the request mix, as random users."""
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookies = {user_id: f"session={serializer.dumps({CURR_USER_KEY: user_id})}".encode()
+               for user_id in user_ids}
+    paths = [
+        lambda: '/',
+        lambda: f'/users/{random.choice(user_ids)}',
+        lambda: f'/messages/{random.choice(message_ids)}',
+        lambda: '/api/v1/timeline',
+        lambda: f'/api/v1/users/{random.choice(user_ids)}/messages',
+    ]
+    return [{'type': 'http', 'method': 'GET', 'path': random.choice(paths)(),
+             'query_string': b'', 'server': ('bench', 80), 'client': ('127.0.0.1', 0),
+             'headers': [(b'cookie', cookies[random.choice(user_ids)])]}
+            for _ in range(count)]
+
+
+def call_wsgi(app, scope):
+    status = []
+    body = app(wsgi_environ(scope, b''),
+               lambda status_line, headers, exc_info=None: status.append(status_line))
+    b''.join(body)
+    return int(status[0].split()[0])
+
+
+async def call_asgi(asgi_app, scope):
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app(scope, receive, send)
+    return sent[0]['status']
+
+
+async def drive(scopes, connections, handle):
+    """Send `scopes` from `connections` clients; returns (seconds, latencies, errors)."""
+
+    queue = list(reversed(scopes))
+    latencies, errors = [], []
+
+    async def client():
+        while queue:
+            scope = queue.pop()
+            started = time.perf_counter()
+            status = await handle(scope)
+            latencies.append(time.perf_counter() - started)
+            if status >= 500:
+                errors.append(status)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(connections)))
+    return time.perf_counter() - started, sorted(latencies), errors
+
+
+def report(name, elapsed, latencies, errors):
+    def percentile(p):
+        return 1000 * latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+    throughput = len(latencies) / elapsed
+    print(f"{name:>5} {throughput:>9.0f} {percentile(0.5):>9.1f} {percentile(0.99):>9.1f} "
+          f"{len(errors):>7}")
+    return throughput
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default=None,
+                        help='database URL (default: a temporary SQLite file)')
+    parser.add_argument('--connections', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=10,
+                        help='WSGI worker threads')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--latency-ms', type=float, default=5)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--following', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=20, help='per user')
+    args = parser.parse_args()
+
+    config = {'ADMISSION_ENABLED': False, 'DB_POOL_SIZE': args.threads,
+              'DB_MAX_OVERFLOW': args.connections}
+    if args.url:
+        config['SQLALCHEMY_DATABASE_URI'] = args.url
+    app = create_app(config)
+    user_ids, message_ids = seed(app, args.users, args.following, args.messages)
+    asgi_app = create_asgi_app(app)
+    if args.latency_ms:
+        add_latency(app, asgi_app, args.latency_ms / 1000)
+
+    scopes = make_scopes(app, user_ids, message_ids, args.requests)
+    threads = ThreadPoolExecutor(max_workers=args.threads)
+
+    async def wsgi(scope):
+        return await asyncio.get_running_loop().run_in_executor(
+            threads, call_wsgi, app, scope)
+
+    async def asgi(scope):
+        return await call_asgi(asgi_app, scope)
+
+    async def run(handle):
+        # One untimed pass to fill pools and compile templates
+        await drive(scopes[:args.connections], args.connections, handle)
+        return await drive(scopes, args.connections, handle)
+
+    async def bench():
+        print(f"{args.requests} requests from {args.connections} connections, "
+              f"{args.latency_ms}ms per query; WSGI on {args.threads} threads")
+        print(f"{'app':>5} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+        wsgi_rate = report('wsgi', *await run(wsgi))
+        asgi_rate = report('asgi', *await run(asgi))
+        print(f"asgi/wsgi throughput: {asgi_rate / wsgi_rate:.2f}")
+        await asgi_app.db.dispose()
+
+    asyncio.run(bench())
+    threads.shutdown()
+    asgi_app.wsgi.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Load test: throughput when request workers outnumber DB connections.
+
+Runs a fixed amount of simulated request work (check out a connection, run
+a query, hold it for --hold-ms to stand in for query time) with more and
+more worker threads against one pool of DB_POOL_SIZE + DB_MAX_OVERFLOW
+connections. With a correctly bounded pool, extra workers queue for a
+connection instead of failing, so throughput should stay flat as workers
+grow; the script exits non-zero if it falls below --min-ratio of the
+baseline or any checkout times out.
+
+    python benchmarks/pool_load.py                     # temporary SQLite file
+    python benchmarks/pool_load.py --url postgresql:///warbler
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import create_engine, text  # noqa: E402
+
+from db_pool import engine_options, instrumented_pool  # noqa: E402
+from metrics import metrics  # noqa: E402
+
+
+def make_engine(url, pool_size, max_overflow, timeout):
+    config = {'DB_POOL_SIZE': pool_size, 'DB_MAX_OVERFLOW': max_overflow,
+              'DB_POOL_TIMEOUT': timeout}
+    options = engine_options(url, config, name='load')
+    if url.startswith('sqlite'):
+        # Force a real queue pool so SQLite behaves like a server database.
+        options.update(poolclass=instrumented_pool('load'), pool_size=pool_size,
+                       max_overflow=max_overflow, pool_timeout=timeout,
+                       connect_args={'check_same_thread': False})
+    return create_engine(url, **options)
+
+
+def run(engine, workers, requests, hold):
+    """Run `requests` units of work on `workers` threads; return stats."""
+
+    metrics.reset()
+    remaining = [requests]
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            try:
+                with engine.connect() as conn:
+                    conn.execute(text('SELECT 1')).scalar()
+                    time.sleep(hold)
+            except Exception as exc:
+                errors.append(exc)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    waits, wait_sum = metrics.histogram('db_pool_checkout_wait_seconds', pool='load')
+    return {
+        'workers': workers,
+        'throughput': requests / elapsed,
+        'mean_wait_ms': 1000 * wait_sum / waits if waits else 0,
+        'timeouts': metrics.value('db_pool_timeouts_total', pool='load'),
+        'errors': len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default=None,
+                        help='database URL (default: a temporary SQLite file)')
+    parser.add_argument('--pool-size', type=int, default=4)
+    parser.add_argument('--max-overflow', type=int, default=2)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--hold-ms', type=float, default=5)
+    parser.add_argument('--min-ratio', type=float, default=0.8)
+    args = parser.parse_args()
+
+    url = args.url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'load.db')}"
+    engine = make_engine(url, args.pool_size, args.max_overflow, args.timeout)
+    capacity = args.pool_size + args.max_overflow
+
+    print(f"pool: {args.pool_size} + {args.max_overflow} overflow, "
+          f"{args.requests} requests holding {args.hold_ms}ms each")
+    print(f"{'workers':>8} {'req/s':>9} {'wait ms':>9} {'timeouts':>9} {'errors':>7}")
+
+    results = []
+    for multiple in (1, 2, 4, 8):
+        stats = run(engine, capacity * multiple, args.requests, args.hold_ms / 1000)
+        results.append(stats)
+        print(f"{stats['workers']:>8} {stats['throughput']:>9.0f} "
+              f"{stats['mean_wait_ms']:>9.2f} {stats['timeouts']:>9} {stats['errors']:>7}")
+
+    baseline = results[0]['throughput']
+    worst = min(r['throughput'] for r in results[1:])
+    failures = sum(r['timeouts'] + r['errors'] for r in results)
+    ok = worst >= args.min_ratio * baseline and not failures
+    print(f"worst/baseline throughput: {worst / baseline:.2f} -> {'OK' if ok else 'COLLAPSED'}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
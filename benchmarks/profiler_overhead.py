@@ -0,0 +1,108 @@
+"""Benchmark: request cost with the sampling profiler off and on.
+
+Serves the same requests (a logged-in home feed and /users) through the
+Flask test client from --threads threads, first with no profile running,
+then profiling every request at the default and at a zero (unbounded)
+overhead budget. Prints requests/s, the slowdown against the first run and
+the overhead the profiler measured itself (`profiler_overhead_ratio`).
+
+    python benchmarks/profiler_overhead.py
+    python benchmarks/profiler_overhead.py --requests 2000 --threads 8
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+os.environ.setdefault(
+    'DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+os.environ.setdefault('JINJA_CACHE_DIR', tempfile.mkdtemp())
+os.environ.setdefault('PROFILE_DIR', tempfile.mkdtemp())
+os.environ.setdefault('ADMISSION_ENABLED', '0')
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from models import db, User, Follows  # noqa: E402
+from sharding import message_shards  # noqa: E402
+
+PATHS = ('/', '/users')
+
+
+def seed(users=30, messages=10):
+    with app.app_context():
+        db.create_all()
+        rows = [User(username=f'bench{i}', email=f'bench{i}@test.com', password='x')
+                for i in range(users)]
+        db.session.add_all(rows)
+        db.session.commit()
+        for user in rows[1:]:
+            db.session.add(Follows(user_following_id=rows[0].id,
+                                   user_being_followed_id=user.id))
+        db.session.commit()
+        for user in rows:
+            for n in range(messages):
+                message_shards().add(user.id, f'warble {n}')
+        db.session.commit()
+        return rows[0].id
+
+
+def run(user_id, requests, threads):
+    """Serve `requests` requests from `threads` threads; returns requests/s."""
+
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def worker():
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session[CURR_USER_KEY] = user_id
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+                path = PATHS[remaining[0] % len(PATHS)]
+            client.get(path)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return requests / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    user_id = seed()
+    profiler = app.extensions['profiler']
+    default_budget = profiler.max_overhead
+    run(user_id, 50, args.threads)    # warm up
+
+    print(f"{args.requests} requests ({', '.join(PATHS)}) from {args.threads} threads")
+    print(f"{'profile':>22} {'req/s':>8} {'slowdown':>9} {'measured':>9} {'samples':>8}")
+    baseline = run(user_id, args.requests, args.threads)
+    print(f"{'off':>22} {baseline:>8.0f} {'':>9} {'':>9} {'':>8}")
+
+    for label, budget in ((f'all, {default_budget:.0%} budget', default_budget),
+                          ('all, unbounded', 1e9)):
+        profiler.max_overhead = budget
+        profiler.start(rate=1)
+        rate = run(user_id, args.requests, args.threads)
+        measured, samples = profiler.overhead(), profiler.samples
+        profiler.stop()
+        print(f"{label:>22} {rate:>8.0f} {1 - rate / baseline:>9.1%} "
+              f"{measured:>9.2%} {samples:>8}")
+
+
+if __name__ == '__main__':
+    main()
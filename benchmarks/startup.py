@@ -0,0 +1,85 @@
+"""Benchmark: app startup and per-worker fork cost.
+
+    cold import      `import app` (module-level create_app()) in a fresh
+                     interpreter, production vs development (debug toolbar)
+    create_app()     building another app once modules are imported
+    fork -> request  a forked child serving its first request from a
+                     preloaded app (what a gunicorn --preload worker pays)
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 20
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+IMPORT_SNIPPET = (
+    "import time; started = time.perf_counter(); import app; "
+    "print(time.perf_counter() - started)")
+
+
+def cold_import(env_overrides, runs):
+    env = dict(os.environ, **env_overrides)
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET], cwd=ROOT, env=env,
+                                check=True, stdout=subprocess.PIPE).stdout
+        times.append(float(output.decode().strip().splitlines()[-1]) * 1000)
+    return statistics.median(times)
+
+
+def fork_first_request(flask_app, runs):
+    times = []
+    for _ in range(runs):
+        read_fd, write_fd = os.pipe()
+        started = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            flask_app.test_client().get('/')
+            os.write(write_fd, b'.')
+            os._exit(0)
+        os.close(write_fd)
+        os.read(read_fd, 1)
+        times.append((time.perf_counter() - started) * 1000)
+        os.waitpid(pid, 0)
+        os.close(read_fd)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    os.environ.setdefault(
+        'DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'startup.db')}")
+    os.environ.setdefault('JINJA_CACHE_DIR', tempfile.mkdtemp())
+
+    production = cold_import({'FLASK_ENV': 'production'}, args.runs)
+    development = cold_import({'FLASK_ENV': 'development'}, args.runs)
+
+    os.environ['FLASK_ENV'] = 'production'
+    from app import create_app, preload_app  # noqa: E402
+    started = time.perf_counter()
+    create_app()
+    rebuild = (time.perf_counter() - started) * 1000
+    forked = fork_first_request(preload_app(), args.runs)
+
+    print(f"median of {args.runs} runs, ms")
+    print(f"{'cold import (production)':>28} {production:>8.1f}")
+    print(f"{'cold import (development)':>28} {development:>8.1f}")
+    print(f"{'create_app()':>28} {rebuild:>8.1f}")
+    print(f"{'fork -> first request':>28} {forked:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
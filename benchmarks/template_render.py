@@ -0,0 +1,97 @@
+"""Benchmark: rendering home.html with 100 messages, with and without the
+Jinja bytecode cache.
+
+Three numbers per configuration:
+
+    first render   compile (or load from the bytecode cache) + render,
+                   what a fresh worker pays for its first home page
+    steady render  mean render time once the template is in memory
+    warm-up        compiling every app template, as done at boot
+
+"no bytecode cache" is the old behaviour; "bytecode cache" is what
+templating.connect_templates sets up (the cache is filled beforehand, as
+after a previous boot or `flask warm-templates`).
+
+    python benchmarks/template_render.py
+    python benchmarks/template_render.py --renders 500
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+os.environ.setdefault(
+    'DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+os.environ.setdefault('JINJA_CACHE_DIR', tempfile.mkdtemp())
+
+from flask import g, render_template  # noqa: E402
+
+from app import app  # noqa: E402
+from models import db, User  # noqa: E402
+from sharding import ShardedMessage  # noqa: E402
+from templating import warm_templates  # noqa: E402
+
+
+def timed(fn):
+    started = time.perf_counter()
+    fn()
+    return (time.perf_counter() - started) * 1000
+
+
+def render_home(user, messages):
+    g.user = user
+    return render_template('home.html', messages=messages, likes=[])
+
+
+def measure(user, messages, bytecode_cache, renders):
+    env = app.jinja_env
+    env.bytecode_cache = bytecode_cache
+
+    env.cache.clear()
+    first = timed(lambda: render_home(user, messages))
+    steady = sum(timed(lambda: render_home(user, messages))
+                 for _ in range(renders)) / renders
+
+    env.cache.clear()
+    warm_up = timed(lambda: warm_templates(app))
+    return first, steady, warm_up
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--renders', type=int, default=200)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        user = User.query.filter_by(username='bench').first()
+        if user is None:
+            user = User(username='bench', email='bench@test.com', password='x')
+            db.session.add(user)
+            db.session.commit()
+
+        now = datetime.utcnow()
+        messages = [ShardedMessage(i, f'warble number {i} ' * 5,
+                                   now - timedelta(minutes=i), user.id, user)
+                    for i in range(100)]
+
+        bytecode_cache = app.jinja_env.bytecode_cache
+        with app.test_request_context('/'):
+            results = [
+                ('no bytecode cache', measure(user, messages, None, args.renders)),
+                ('bytecode cache', measure(user, messages, bytecode_cache, args.renders)),
+            ]
+
+    print(f"home.html with {len(messages)} messages, {args.renders} steady renders")
+    print(f"{'':>18} {'first ms':>9} {'steady ms':>10} {'warm-up ms':>11}")
+    for label, (first, steady, warm_up) in results:
+        print(f"{label:>18} {first:>9.2f} {steady:>10.3f} {warm_up:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+"""Two-tier cache for Warbler.
+
+`Cache` puts a bounded in-process LRU in front of an optional shared tier
+that speaks the Redis protocol (CACHE_URL), so gunicorn workers share
+results. Without CACHE_URL only the per-process LRU is used.
+
+Entries can carry tags; `invalidate_tags` drops every entry with any of
+them. On the shared tier this is done by bumping a per-tag version that
+entries are checked against, so no key lists are kept. Another worker's
+LRU may keep serving an invalidated entry for up to CACHE_LOCAL_TTL seconds.
+
+`get_or_set` protects the backing store from stampedes: on a miss only one
+thread per process computes the value while others wait for it, and in the
+last EARLY_REFRESH of an entry's TTL a single caller recomputes it while
+everyone else keeps getting the current value.
+
+Lookups are counted in cache_requests_total{tier, result}.
+"""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app
+
+from metrics import metrics
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+DEFAULT_TTL = 60
+DEFAULT_LOCAL_TTL = 5
+DEFAULT_MAX_ENTRIES = 1024
+EARLY_REFRESH = 0.1
+LOCK_STRIPES = 64
+
+
+# What both tiers store; `tags` maps each tag to its version at write time.
+Entry = namedtuple('Entry', 'value expires_at ttl tags')
+
+
+class LRUCache:
+    """Thread-safe LRU of Entries, bounded by entry count."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, entry, expires_at):
+        with self._lock:
+            self._entries[key] = (entry, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def drop_tags(self, tags):
+        tags = set(tags)
+        with self._lock:
+            for key in [key for key, (entry, _) in self._entries.items()
+                        if tags.intersection(entry.tags)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisTier:
+    """Shared tier over a Redis-protocol client (redis.Redis or a fake)."""
+
+    def __init__(self, client, prefix='warbler:cache:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url):
+        if redis is None:
+            raise RuntimeError("RedisTier requires the 'redis' package.")
+        return cls(redis.Redis.from_url(url))
+
+    def _key(self, key):
+        return f'{self.prefix}{key}'
+
+    def _tag_key(self, tag):
+        return f'{self.prefix}tag:{tag}'
+
+    def get_many(self, keys):
+        raw = self.client.mget([self._key(key) for key in keys]) if keys else []
+        return [pickle.loads(value) if value is not None else None for value in raw]
+
+    def set_many(self, entries):
+        pipe = self.client.pipeline(transaction=False)
+        for key, entry in entries.items():
+            pipe.set(self._key(key), pickle.dumps(entry),
+                     ex=max(int(entry.expires_at - time.time()), 1))
+        pipe.execute()
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self._key(key) for key in keys])
+
+    def add(self, key, ttl):
+        """Set `key` only if absent (a short-lived lock); True if it was set."""
+
+        return bool(self.client.set(self._key(key), b'1', nx=True, ex=ttl))
+
+    def tag_versions(self, tags):
+        tags = sorted(set(tags))
+        if not tags:
+            return {}
+        raw = self.client.mget([self._tag_key(tag) for tag in tags])
+        return {tag: int(value or 0) for tag, value in zip(tags, raw)}
+
+    def bump_tags(self, tags):
+        pipe = self.client.pipeline(transaction=False)
+        for tag in set(tags):
+            pipe.incr(self._tag_key(tag))
+        pipe.execute()
+
+
+class Cache:
+    """get/set/delete/get_many/set_many with TTLs and tags over two tiers."""
+
+    def __init__(self, local=None, shared=None, default_ttl=DEFAULT_TTL,
+                 local_ttl=DEFAULT_LOCAL_TTL):
+        self.local = local if local is not None else LRUCache()
+        self.shared = shared
+        self.default_ttl = default_ttl
+        self.local_ttl = local_ttl
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._local_versions = {}
+
+    def _lock_for(self, key):
+        return self._locks[hash(key) % LOCK_STRIPES]
+
+    def _entries(self, keys):
+        """{key: Entry} for the keys found, local tier first."""
+
+        found = {}
+        missing = []
+        for key in keys:
+            entry = self.local.get(key)
+            if entry is None:
+                missing.append(key)
+            else:
+                found[key] = entry
+        metrics.inc('cache_requests_total', len(found), tier='local', result='hit')
+        metrics.inc('cache_requests_total', len(missing), tier='local', result='miss')
+
+        if self.shared is None or not missing:
+            return found
+
+        now = time.time()
+        entries = dict(zip(missing, self.shared.get_many(missing)))
+        versions = self.shared.tag_versions(
+            tag for entry in entries.values() if entry for tag in entry.tags)
+        hits = 0
+        for key, entry in entries.items():
+            if (entry is None or entry.expires_at <= now
+                    or any(versions.get(tag, 0) != version
+                           for tag, version in entry.tags.items())):
+                continue
+            found[key] = entry
+            self.local.set(key, entry, min(entry.expires_at, now + self.local_ttl))
+            hits += 1
+        metrics.inc('cache_requests_total', hits, tier='shared', result='hit')
+        metrics.inc('cache_requests_total', len(missing) - hits, tier='shared',
+                    result='miss')
+        return found
+
+    def _tag_versions(self, tags):
+        if self.shared:
+            return self.shared.tag_versions(tags)
+        return {tag: self._local_versions.get(tag, 0) for tag in tags}
+
+    def _store(self, values, ttl, tags, versions=None):
+        ttl = ttl or self.default_ttl
+        now = time.time()
+        if versions is None:
+            versions = self._tag_versions(tags)
+        elif not self.shared and versions != self._tag_versions(tags):
+            return  # invalidated while it was being computed
+        entries = {key: Entry(value, now + ttl, ttl, versions)
+                   for key, value in values.items()}
+        for key, entry in entries.items():
+            self.local.set(key, entry, min(entry.expires_at, now + self.local_ttl)
+                           if self.shared else entry.expires_at)
+        if self.shared:
+            self.shared.set_many(entries)
+
+    def get(self, key, default=None):
+        entry = self._entries([key]).get(key)
+        return entry.value if entry else default
+
+    def get_many(self, keys):
+        """{key: value} for the keys that are cached."""
+
+        return {key: entry.value for key, entry in self._entries(list(keys)).items()}
+
+    def set(self, key, value, ttl=None, tags=()):
+        self._store({key: value}, ttl, tags)
+
+    def set_many(self, values, ttl=None, tags=()):
+        self._store(dict(values), ttl, tags)
+
+    def delete(self, *keys):
+        self.local.delete(*keys)
+        if self.shared:
+            self.shared.delete(*keys)
+
+    def invalidate_tags(self, *tags):
+        """Drop every entry stored with any of `tags`."""
+
+        self.local.drop_tags(tags)
+        if self.shared:
+            self.shared.bump_tags(tags)
+        else:
+            for tag in tags:
+                self._local_versions[tag] = self._local_versions.get(tag, 0) + 1
+
+    def clear(self):
+        """Empty this process's tier (the shared tier is left alone)."""
+
+        self.local.clear()
+
+    def get_or_set(self, key, compute, ttl=None, tags=()):
+        """Cached value for `key`, or `compute()` stored under it.
+
+        None results are returned but not cached.
+        """
+
+        entry = self._entries([key]).get(key)
+        if entry is not None:
+            remaining = entry.expires_at - time.time()
+            if remaining > entry.ttl * EARLY_REFRESH:
+                return entry.value
+            # Near expiry: one caller refreshes, the rest keep the current value
+            lock = self._lock_for(key)
+            if not lock.acquire(blocking=False):
+                return entry.value
+            try:
+                metrics.inc('cache_early_refreshes_total')
+                return self._compute(key, compute, ttl, tags)
+            finally:
+                lock.release()
+
+        with self._lock_for(key):
+            # Whoever held the lock may have just stored it
+            entry = self._entries([key]).get(key)
+            if entry is not None:
+                metrics.inc('cache_single_flight_waits_total')
+                return entry.value
+            return self._compute(key, compute, ttl, tags)
+
+    def _compute(self, key, compute, ttl, tags):
+        # Versions from before computing, so an invalidation that lands
+        # meanwhile makes the stored entry stale rather than being lost
+        versions = self._tag_versions(tags)
+        value = compute()
+        if value is not None:
+            self._store({key: value}, ttl, tags, versions)
+        return value
+
+
+def make_cache(config):
+    """Cache configured from CACHE_URL, CACHE_MAX_ENTRIES, CACHE_TTL and
+    CACHE_LOCAL_TTL."""
+
+    url = config.get('CACHE_URL')
+    return Cache(
+        local=LRUCache(config.get('CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)),
+        shared=RedisTier.from_url(url) if url else None,
+        default_ttl=config.get('CACHE_TTL', DEFAULT_TTL),
+        local_ttl=config.get('CACHE_LOCAL_TTL', DEFAULT_LOCAL_TTL))
+
+
+def app_cache():
+    """The current app's Cache."""
+
+    return current_app.extensions['cache']
+
+
+def connect_cache(app):
+    """Attach the app's Cache to `app.extensions['cache']`."""
+
+    app.extensions['cache'] = make_cache(app.config)
@@ -0,0 +1,132 @@
+"""Request coalescing for hot anonymous pages.
+
+Wrap a view with `@coalesced` and concurrent identical anonymous GETs in a
+worker share one run of it: the first request (the leader) renders the
+page and the others (followers) wait for its response instead of repeating
+the same queries and template work. A follower waits at most
+COALESCE_MAX_WAIT seconds, then renders the page itself.
+
+With COALESCE_SHARED on and a shared cache tier (CACHE_URL), leaders in
+different workers also coordinate: one takes a short lock in the shared
+tier and publishes its response there, and the others poll for it.
+
+Only requests whose response can't depend on who is asking are coalesced:
+no logged-in user and no flashed messages. Set-Cookie headers are never
+shared. Outcomes are counted in coalesced_requests_total{result}.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+
+from flask import current_app, g, request, session
+
+from metrics import metrics
+
+DEFAULT_MAX_WAIT = 2.0
+POLL_INTERVAL = 0.01
+
+# A response in a form that can be shared between requests and workers.
+Snapshot = namedtuple('Snapshot', 'body status headers')
+
+
+class Flight:
+    """One in-flight computation and its eventual result."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class Coalescer:
+    """Runs at most one computation per key at a time; callers share it."""
+
+    def __init__(self, max_wait=DEFAULT_MAX_WAIT, cache=None):
+        self.max_wait = max_wait
+        self.cache = cache if cache is not None and cache.shared else None
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, compute):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            if flight.done.wait(self.max_wait) and flight.result is not None:
+                metrics.inc('coalesced_requests_total', result='follower')
+                return flight.result
+            metrics.inc('coalesced_requests_total', result='timeout')
+            return compute()
+
+        try:
+            flight.result = self._lead(key, compute)
+            return flight.result
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _lead(self, key, compute):
+        """Compute as this worker's leader, coordinating with other workers."""
+
+        metrics.inc('coalesced_requests_total', result='leader')
+        if self.cache is None:
+            return compute()
+
+        result_key = f'coalesce:result:{key}'
+        lock_ttl = max(int(self.max_wait + 1), 1)
+        if self.cache.shared.add(f'coalesce:lock:{key}', lock_ttl):
+            result = compute()
+            self.cache.set(result_key, result, ttl=lock_ttl)
+            self.cache.shared.delete(f'coalesce:lock:{key}')
+            return result
+
+        deadline = time.monotonic() + self.max_wait
+        while time.monotonic() < deadline:
+            result = self.cache.get(result_key)
+            if result is not None:
+                metrics.inc('coalesced_requests_total', result='shared')
+                return result
+            time.sleep(POLL_INTERVAL)
+        metrics.inc('coalesced_requests_total', result='timeout')
+        return compute()
+
+
+def coalesced(view):
+    """Share one rendering of `view` among concurrent anonymous GETs."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        coalescer = current_app.extensions.get('coalescer')
+        if (coalescer is None or request.method != 'GET'
+                or g.get('user') or '_flashes' in session):
+            return view(*args, **kwargs)
+
+        def compute():
+            response = current_app.make_response(view(*args, **kwargs))
+            headers = [(name, value) for name, value in response.headers
+                       if name.lower() != 'set-cookie']
+            return Snapshot(response.get_data(), response.status_code, headers)
+
+        snapshot = coalescer.run(request.full_path, compute)
+        return current_app.response_class(
+            snapshot.body, status=snapshot.status, headers=snapshot.headers)
+
+    return wrapper
+
+
+def connect_coalescing(app):
+    """Set up coalescing from COALESCE_MAX_WAIT and COALESCE_SHARED.
+
+    Call after connect_cache; the shared tier is only used when
+    COALESCE_SHARED is on and CACHE_URL is set.
+    """
+
+    shared = app.config.get('COALESCE_SHARED')
+    app.extensions['coalescer'] = Coalescer(
+        max_wait=app.config.get('COALESCE_MAX_WAIT', DEFAULT_MAX_WAIT),
+        cache=app.extensions.get('cache') if shared else None)
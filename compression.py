@@ -0,0 +1,177 @@
+"""Streaming gzip compression for Warbler responses.
+
+`CompressionMiddleware` wraps the WSGI app and gzips responses whose content
+type is on an allowlist and whose body is at least `min_size` bytes. Bodies
+are compressed chunk by chunk as the app yields them, so streamed responses
+are never buffered whole; only the first `min_size` bytes are held back when
+the length isn't known up front.
+
+Compression ratio, bytes in/out and the CPU time spent compressing are
+reported to the shared metrics registry.
+"""
+
+import time
+import zlib
+
+from metrics import metrics
+
+DEFAULT_MIMETYPES = frozenset([
+    'text/html',
+    'text/plain',
+    'text/css',
+    'application/json',
+    'application/javascript',
+    'image/svg+xml',
+])
+
+SKIP_STATUSES = ('204', '206', '304')
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+class CompressionMiddleware:
+    """WSGI middleware that stream-compresses eligible responses."""
+
+    def __init__(self, app, level=6, min_size=500, mimetypes=DEFAULT_MIMETYPES):
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+        self.mimetypes = frozenset(mimetypes)
+
+    def accepts_gzip(self, environ):
+        for part in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+            coding, _, param = part.strip().partition(';')
+            if coding.strip().lower() not in ('gzip', '*'):
+                continue
+            param = param.replace(' ', '')
+            if not param.startswith('q='):
+                return True
+            try:
+                return float(param[2:]) > 0
+            except ValueError:
+                return False
+        return False
+
+    def is_compressible(self, status, headers):
+        if status[:3] in SKIP_STATUSES:
+            return False
+        if _header(headers, 'Content-Encoding'):
+            return False
+        content_type = (_header(headers, 'Content-Type') or '').split(';')[0]
+        if content_type.strip().lower() not in self.mimetypes:
+            return False
+        length = _header(headers, 'Content-Length')
+        return length is None or int(length) >= self.min_size
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') == 'HEAD' or not self.accepts_gzip(environ):
+            return self.app(environ, start_response)
+
+        captured = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured['status'] = status
+            captured['headers'] = headers
+            captured['exc_info'] = exc_info
+            # The real start_response is called lazily once we know whether
+            # the body gets compressed; the write() callable is unsupported.
+            return None
+
+        body = self.app(environ, capture_start_response)
+        return self.stream(body, captured, start_response)
+
+    def stream(self, body, captured, start_response):
+        """Yield the (possibly compressed) body, closing `body` when done."""
+
+        try:
+            chunks = iter(body)
+            status = captured['status']
+            headers = list(captured['headers'])
+
+            if not self.is_compressible(status, headers):
+                start_response(status, headers, captured['exc_info'])
+                yield from chunks
+                return
+
+            # Hold back up to min_size bytes when the length is unknown, so
+            # tiny streamed bodies aren't compressed.
+            pending = []
+            pending_size = 0
+            if _header(headers, 'Content-Length') is None:
+                for chunk in chunks:
+                    pending.append(chunk)
+                    pending_size += len(chunk)
+                    if pending_size >= self.min_size:
+                        break
+                else:
+                    start_response(status, headers, captured['exc_info'])
+                    yield from pending
+                    return
+
+            headers = [(k, v) for k, v in headers
+                       if k.lower() != 'content-length']
+            headers.append(('Content-Encoding', 'gzip'))
+            vary = _header(headers, 'Vary')
+            if vary is None:
+                headers.append(('Vary', 'Accept-Encoding'))
+            elif 'accept-encoding' not in vary.lower():
+                headers = [(k, f'{v}, Accept-Encoding' if k.lower() == 'vary' else v)
+                           for k, v in headers]
+            start_response(status, headers, captured['exc_info'])
+
+            yield from self.compress(pending, chunks)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def compress(self, pending, chunks):
+        """Gzip `pending` then `chunks`, recording ratio and CPU time."""
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        size_in = size_out = 0
+        cpu = 0.0
+
+        for source in (pending, chunks):
+            for chunk in source:
+                started = time.thread_time()
+                out = compressor.compress(chunk)
+                cpu += time.thread_time() - started
+                size_in += len(chunk)
+                if out:
+                    size_out += len(out)
+                    yield out
+
+        started = time.thread_time()
+        out = compressor.flush()
+        cpu += time.thread_time() - started
+        size_out += len(out)
+        yield out
+
+        metrics.inc('http_compression_bytes_in_total', size_in)
+        metrics.inc('http_compression_bytes_out_total', size_out)
+        metrics.observe('http_compression_cpu_seconds', cpu,
+                        buckets=(.0001, .0005, .001, .005, .01, .05))
+        if size_in:
+            metrics.observe('http_compression_ratio', size_out / size_in,
+                            buckets=(.1, .2, .3, .4, .5, .6, .7, .8, .9, 1))
+
+
+def connect_compression(app):
+    """Wrap `app` in CompressionMiddleware configured from app.config.
+
+    COMPRESS_LEVEL (zlib level, default 6), COMPRESS_MIN_SIZE (bytes,
+    default 500) and COMPRESS_MIMETYPES (allowlist) tune it.
+    """
+
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        level=app.config.get('COMPRESS_LEVEL', 6),
+        min_size=app.config.get('COMPRESS_MIN_SIZE', 500),
+        mimetypes=app.config.get('COMPRESS_MIMETYPES', DEFAULT_MIMETYPES),
+    )
@@ -0,0 +1,152 @@
+"""Connection pool configuration and instrumentation for Warbler.
+
+Pool settings come from app.config, which app.py fills from environment
+variables of the same names:
+
+    DB_POOL_SIZE      persistent connections per process (default 5)
+    DB_MAX_OVERFLOW   extra connections allowed under burst (default 5)
+    DB_POOL_TIMEOUT   seconds to wait for a connection before failing (10)
+    DB_POOL_RECYCLE   seconds before a connection is replaced (1800)
+    DB_POOL_PRE_PING  test connections on checkout (default on)
+
+Size them so that gunicorn workers x (DB_POOL_SIZE + DB_MAX_OVERFLOW), plus
+the job workers, stays under Postgres' max_connections. When requests
+outnumber connections they queue in the pool for up to DB_POOL_TIMEOUT,
+and that queueing is visible through these metrics:
+
+    db_pool_checkout_wait_seconds  time spent waiting for a connection
+    db_pool_in_use / db_pool_idle / db_pool_overflow  (per scrape)
+    db_pool_overflow_total         checkouts that opened an overflow connection
+    db_pool_timeouts_total         checkouts that gave up after DB_POOL_TIMEOUT
+
+SQLite URLs keep Flask-SQLAlchemy's own pooling and are not instrumented.
+"""
+
+import os
+import time
+import weakref
+
+from flask import current_app, has_app_context
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from metrics import metrics
+
+DEFAULTS = {
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 5,
+    'DB_POOL_TIMEOUT': 10,
+    'DB_POOL_RECYCLE': 1800,
+    'DB_POOL_PRE_PING': True,
+}
+
+WAIT_BUCKETS = (.0005, .001, .005, .01, .05, .1, .5, 1, 5, 10)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that reports checkout wait, overflow and timeouts.
+
+    Use `instrumented_pool(name)` to get a subclass labelled for metrics;
+    the label lives on the class so it survives pool.recreate() on dispose.
+    """
+
+    metrics_name = 'primary'
+
+    def _do_get(self):
+        overflow_before = self._overflow
+        started = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            metrics.inc('db_pool_timeouts_total', pool=self.metrics_name)
+            raise
+        finally:
+            metrics.observe('db_pool_checkout_wait_seconds',
+                            time.perf_counter() - started,
+                            buckets=WAIT_BUCKETS, pool=self.metrics_name)
+
+        if self._overflow > max(overflow_before, 0):
+            metrics.inc('db_pool_overflow_total', pool=self.metrics_name)
+        return conn
+
+
+def instrumented_pool(name):
+    return type('InstrumentedQueuePool', (InstrumentedQueuePool,),
+                {'metrics_name': name})
+
+
+def engine_options(url, config, name='primary'):
+    """create_engine() keyword arguments for the pool settings in `config`."""
+
+    def setting(key):
+        return config.get(key, DEFAULTS[key])
+
+    options = {
+        'pool_pre_ping': bool(setting('DB_POOL_PRE_PING')),
+        'pool_recycle': int(setting('DB_POOL_RECYCLE')),
+    }
+    if not str(url).startswith('sqlite'):
+        options.update(
+            poolclass=instrumented_pool(name),
+            pool_size=int(setting('DB_POOL_SIZE')),
+            max_overflow=int(setting('DB_MAX_OVERFLOW')),
+            pool_timeout=float(setting('DB_POOL_TIMEOUT')),
+        )
+    return options
+
+
+def app_engines(app):
+    """The primary, replica and shard engines of `app`."""
+
+    db = app.extensions['sqlalchemy'].db
+    engines = [db.get_engine(app)] + app.extensions.get('db_replicas', [])
+    shards = app.extensions.get('message_shards')
+    if shards:
+        engines += shards.engines
+    return engines
+
+
+def collect_pool_metrics():
+    """Refresh in-use/idle/overflow gauges for the app's pools."""
+
+    if not has_app_context() or 'sqlalchemy' not in current_app.extensions:
+        return
+
+    for engine in app_engines(current_app._get_current_object()):
+        pool = engine.pool
+        if isinstance(pool, InstrumentedQueuePool):
+            metrics.set('db_pool_in_use', pool.checkedout(), pool=pool.metrics_name)
+            metrics.set('db_pool_idle', pool.checkedin(), pool=pool.metrics_name)
+            metrics.set('db_pool_overflow', max(pool.overflow(), 0),
+                        pool=pool.metrics_name)
+
+
+def connect_pool_metrics(app):
+    metrics.add_collector(collect_pool_metrics)
+
+
+# Apps whose pools are emptied before a fork. Weak, so apps that are built
+# and dropped (tests build many) aren't kept alive by the fork hook.
+_fork_apps = weakref.WeakSet()
+
+
+def _dispose_before_fork():
+    for app in list(_fork_apps):
+        for engine in app_engines(app):
+            engine.dispose()
+
+
+# Once per process, however many apps are created
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_dispose_before_fork)
+
+
+def dispose_pools_before_fork(app):
+    """Give forked children (e.g. preloaded gunicorn workers) empty pools.
+
+    Idle pooled connections are closed in the parent just before any fork,
+    so no child inherits (and shares) a connection; both sides reconnect
+    lazily. Connections checked out at the time are left alone.
+    """
+
+    _fork_apps.add(app)
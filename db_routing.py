@@ -0,0 +1,101 @@
+"""Primary/replica routing for Warbler's SQLAlchemy session.
+
+With SQLALCHEMY_REPLICA_URIS configured, reads made while handling a GET
+(or HEAD) request go to one replica from the pool, chosen once per request
+so the page sees a consistent snapshot. Everything else goes to the primary
+(SQLALCHEMY_DATABASE_URI): flushes, bulk/Core writes, reads in any other
+request, and reads outside a request (CLI, job workers).
+
+A session that writes, even during a GET, sends its later reads to the
+primary too. After a request that wrote, the user's Flask session is
+stamped with the write time, and for REPLICA_STICKY_SECONDS their requests
+read from the primary so they see their own writes despite replica lag.
+Reads whose results outlive the request (e.g. the entity cache's) use
+`primary_reads` so a lagging replica's rows aren't kept.
+"""
+
+import random
+import time
+from contextlib import contextmanager
+
+from flask import request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm
+from sqlalchemy.sql.dml import UpdateBase
+
+from db_pool import engine_options
+
+LAST_WRITE_KEY = 'db_last_write'
+DEFAULT_STICKY_SECONDS = 5
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends reads to a replica when `info['use_replica']`."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        elif self.info.get('use_replica') and not self.info.get('wrote'):
+            replicas = self.app.extensions.get('db_replicas')
+            if replicas:
+                if 'replica' not in self.info:
+                    self.info['replica'] = random.choice(replicas)
+                return self.info['replica']
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy whose sessions are RoutingSessions.
+
+    The primary engine also gets the pool settings from db_pool.
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        result = super().apply_driver_hacks(app, sa_url, options)
+        options.update(engine_options(sa_url, app.config))
+        return result
+
+
+@contextmanager
+def primary_reads(session):
+    """Send `session`'s reads to the primary inside the block."""
+
+    use_replica = session.info.get('use_replica')
+    session.info['use_replica'] = False
+    try:
+        yield
+    finally:
+        session.info['use_replica'] = use_replica
+
+
+def connect_replicas(app, db):
+    """Create replica engines and route each request's reads.
+
+    SQLALCHEMY_REPLICA_URIS is a list of database URIs; with none, every
+    query uses the primary. REPLICA_STICKY_SECONDS (default 5) is how long
+    after a write a user keeps reading from the primary.
+    """
+
+    uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+    app.extensions['db_replicas'] = [
+        create_engine(uri, **engine_options(uri, app.config, f'replica{i}'))
+        for i, uri in enumerate(uris)
+    ]
+    sticky_seconds = app.config.get('REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS)
+
+    @app.before_request
+    def choose_database():
+        last_write = session.get(LAST_WRITE_KEY, 0)
+        db.session.info['use_replica'] = (
+            request.method in ('GET', 'HEAD')
+            and time.time() - last_write > sticky_seconds)
+
+    @app.after_request
+    def remember_write(response):
+        if db.session.info.get('wrote'):
+            session[LAST_WRITE_KEY] = time.time()
+        return response
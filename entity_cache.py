@@ -0,0 +1,155 @@
+"""Read-through cache of User and Message snapshots, keyed by (model, id).
+
+Timelines, message pages, notifications and profiles read the same hot
+rows over and over: the authors on every feed, the profile owner. Rather
+than loading ORM objects each time, they ask the app's EntityCache:
+
+    authors = entity_cache().get_many(User, {row.user_id for row in rows})
+
+Cached ids come from the app cache (see cache.py), and the misses are
+loaded with one IN query, from the primary even during a GET (a lagging
+replica's row would be cached long after the commit that dropped it),
+then cached for ENTITY_CACHE_TTL seconds (default: the cache's own TTL). Entries are compact immutable snapshots,
+UserSnapshot and sharding.MessageRow namedtuples, never live ORM objects,
+so they can be shared between requests and threads and pickled to Redis.
+
+A snapshot is dropped when the transaction that changed its row commits:
+a session `after_flush` listener collects the Users and Messages flushed
+as new, changed or deleted, and `after_commit` deletes their entries
+(a rollback forgets them). Writes that bypass the ORM (Core and bulk
+deletes, sharded messages) call `expire()` to do the same.
+"""
+
+from collections import namedtuple
+from itertools import chain
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from db_routing import primary_reads
+from metrics import metrics
+from models import db, User, Message
+
+STALE_KEY = 'entity_cache_stale'
+
+UserSnapshot = namedtuple(
+    'UserSnapshot', 'id username image_url header_image_url bio location deleted_at')
+
+
+def load_users(user_ids):
+    """{id: UserSnapshot} for each of `user_ids` that exists, deleted or not."""
+
+    with primary_reads(db.session):
+        rows = (db.session.query(*(getattr(User, field) for field in UserSnapshot._fields))
+                .filter(User.id.in_(user_ids))
+                .all())
+    return {row[0]: UserSnapshot(*row) for row in rows}
+
+
+def load_messages(message_ids):
+    """{id: MessageRow} for each of `message_ids`, from whichever shard has it."""
+
+    # Unsharded, the messages table is read through db.session
+    with primary_reads(db.session):
+        return current_app.extensions['message_shards'].get_many(message_ids)
+
+
+class EntityCache:
+    """Snapshots of `loaders`' models by id, stored in `cache`.
+
+    `loaders` maps each model to a function taking a collection of ids and
+    returning {id: snapshot} for those that exist; missing ids aren't
+    cached, so a row created later is found.
+    """
+
+    def __init__(self, cache, loaders, ttl=None):
+        self.cache = cache
+        self.loaders = loaders
+        self.ttl = ttl
+
+    @staticmethod
+    def key(model, entity_id):
+        return f'entity:{model.__name__}:{entity_id}'
+
+    def get(self, model, entity_id):
+        """Snapshot of `model` #`entity_id`, or None."""
+
+        return self.get_many(model, [entity_id]).get(entity_id)
+
+    def get_many(self, model, entity_ids):
+        """{id: snapshot} for each of `entity_ids` that exists; one query
+        for the ids that aren't cached."""
+
+        keys = {self.key(model, entity_id): entity_id for entity_id in set(entity_ids)}
+        if not keys:
+            return {}
+        found = {keys[key]: snapshot
+                 for key, snapshot in self.cache.get_many(keys).items()}
+        missing = [entity_id for entity_id in keys.values() if entity_id not in found]
+        if missing:
+            loaded = self.loaders[model](missing)
+            metrics.inc('entity_cache_loads_total', len(missing), model=model.__name__)
+            if loaded:
+                self.cache.set_many({self.key(model, entity_id): snapshot
+                                     for entity_id, snapshot in loaded.items()},
+                                    ttl=self.ttl)
+            found.update(loaded)
+        return found
+
+    def forget(self, model, entity_ids):
+        """Drop the snapshots of `model` #`entity_ids` now."""
+
+        self.cache.delete(*(self.key(model, entity_id) for entity_id in entity_ids))
+
+
+def entity_cache():
+    """The current app's EntityCache."""
+
+    return current_app.extensions['entity_cache']
+
+
+def expire(model, entity_ids, session=None):
+    """Drop `model` #`entity_ids` from the cache when `session` (default:
+    db.session) commits; for writes the ORM doesn't see."""
+
+    session = session if session is not None else db.session
+    session.info.setdefault(STALE_KEY, set()).update(
+        (model, entity_id) for entity_id in entity_ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_stale(session, flush_context):
+    stale = [(type(obj), obj.id)
+             for obj in chain(session.new, session.dirty, session.deleted)
+             if type(obj) in (User, Message) and obj.id is not None]
+    if stale:
+        session.info.setdefault(STALE_KEY, set()).update(stale)
+
+
+@event.listens_for(Session, 'after_commit')
+def _drop_stale(session):
+    stale = session.info.pop(STALE_KEY, None)
+    # Flask-SQLAlchemy sessions know their app, even outside an app context
+    app = getattr(session, 'app', None) or (current_app if has_app_context() else None)
+    cache = app and app.extensions.get('entity_cache')
+    if not stale or cache is None:
+        return
+    by_model = {}
+    for model, entity_id in stale:
+        by_model.setdefault(model, []).append(entity_id)
+    for model, entity_ids in by_model.items():
+        cache.forget(model, entity_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_stale(session):
+    session.info.pop(STALE_KEY, None)
+
+
+def connect_entity_cache(app):
+    """Give `app` an EntityCache for Users and Messages, over its app cache."""
+
+    app.extensions['entity_cache'] = EntityCache(
+        app.extensions['cache'], {User: load_users, Message: load_messages},
+        ttl=app.config.get('ENTITY_CACHE_TTL'))
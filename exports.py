@@ -0,0 +1,292 @@
+"""Account data exports for Warbler.
+
+A user asks for an export on /users/exports. An `export.user` job writes a
+zip of their data to EXPORT_DIR (default exports/), and the page then links
+to it:
+
+    profile.json                    the user row (no password hash)
+    messages.csv                    id, timestamp, text (hot and archived)
+    likes.csv                       message_id
+    following.csv, followers.csv    id, username
+
+With format 'ndjson' the tables are .jsonl files, one JSON object per line.
+Every table is read through a server-side cursor (`yield_per`, or
+stream_results on the shards) and written into its zip member row by row,
+so memory use stays flat however much the user has posted. Archives are
+deleted after EXPORT_RETENTION_DAYS (default 7).
+
+`flask export-site` dumps whole tables for admins. Each table (and each
+shard's messages) is streamed on its own connection, in parallel, to a
+gzipped CSV or NDJSON file in the output directory, and a manifest.json
+lists the row counts. Each file is consistent on its own, but the files
+are not one point-in-time snapshot of the site.
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import select
+
+from api import dumps
+from jobs import job_handler, enqueue
+from metrics import metrics
+from models import db, User, Follows, Likes, Tag, MessageTag, Mention, Export
+from sharding import message_shards, fetch_in_batches
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_EXPORT_DIR = os.path.join(ROOT, 'exports')
+DEFAULT_RETENTION_DAYS = 7
+BATCH_SIZE = 1000
+DEFAULT_SITE_WORKERS = 4
+
+EXPORT_USER = 'export.user'
+
+FORMATS = {'csv': 'csv', 'ndjson': 'jsonl'}
+
+PROFILE_COLUMNS = ('id', 'username', 'email', 'bio', 'location', 'image_url',
+                   'header_image_url')
+
+
+def export_dir():
+    return current_app.config.get('EXPORT_DIR') or DEFAULT_EXPORT_DIR
+
+
+def _csv_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def write_rows(stream, fmt, columns, rows):
+    """Write `rows` (tuples in `columns` order) to binary `stream` as CSV
+    with a header, or as NDJSON. Returns the number of rows."""
+
+    count = 0
+    if fmt == 'ndjson':
+        for row in rows:
+            stream.write(dumps(dict(zip(columns, row))) + b'\n')
+            count += 1
+        return count
+
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+        count += 1
+    text.flush()
+    text.detach()   # leave `stream` open for the caller
+    return count
+
+
+##############################################################################
+# Per-user exports
+
+
+def user_tables(user_id):
+    """(name, columns, rows function) for each table of a user export."""
+
+    def messages():
+        for row in message_shards().stream_for_user(user_id, BATCH_SIZE):
+            yield row.id, row.timestamp, row.text
+
+    def likes():
+        return (db.session.query(Likes.message_id)
+                .filter(Likes.user_id == user_id)
+                .order_by(Likes.id)
+                .yield_per(BATCH_SIZE))
+
+    def users_joined(condition, other_id):
+        return lambda: (db.session.query(User.id, User.username)
+                        .join(Follows, other_id == User.id)
+                        .filter(condition, User.deleted_at.is_(None))
+                        .order_by(User.id)
+                        .yield_per(BATCH_SIZE))
+
+    return [
+        ('messages', ('id', 'timestamp', 'text'), messages),
+        ('likes', ('message_id',), likes),
+        ('following', ('id', 'username'),
+         users_joined(Follows.user_following_id == user_id,
+                      Follows.user_being_followed_id)),
+        ('followers', ('id', 'username'),
+         users_joined(Follows.user_being_followed_id == user_id,
+                      Follows.user_following_id)),
+    ]
+
+
+def write_user_export(export):
+    """Write `export`'s archive; returns its file name."""
+
+    user = User.query.get(export.user_id)
+    directory = export_dir()
+    os.makedirs(directory, exist_ok=True)
+    # Ids only: usernames may hold path separators, quotes or non-ASCII,
+    # and this name goes on disk and into Content-Disposition
+    filename = f'warbler-{user.id}-{export.id}.zip'
+    path = os.path.join(directory, filename)
+    partial = f'{path}.{os.getpid()}.partial'
+
+    ext = FORMATS[export.format]
+    with zipfile.ZipFile(partial, 'w', zipfile.ZIP_DEFLATED) as archive:
+        profile = {column: getattr(user, column) for column in PROFILE_COLUMNS}
+        archive.writestr('profile.json', json.dumps(profile, indent=2))
+        for name, columns, rows in user_tables(user.id):
+            with archive.open(f'{name}.{ext}', 'w') as member:
+                count = write_rows(member, export.format, columns, rows())
+            metrics.inc('export_rows_total', count, table=name)
+    os.replace(partial, path)
+    return filename
+
+
+def request_export(user_id, fmt):
+    """An export of `user_id`'s data in `fmt`, reusing one in progress
+    (the caller commits)."""
+
+    pending = (Export.query
+               .filter(Export.user_id == user_id,
+                       Export.status.in_(['queued', 'running']))
+               .first())
+    if pending:
+        return pending
+
+    export = Export(user_id=user_id, format=fmt)
+    db.session.add(export)
+    db.session.flush()
+    enqueue(EXPORT_USER, {'export_id': export.id},
+            idempotency_key=f'{EXPORT_USER}:{export.id}')
+    return export
+
+
+def export_path(export):
+    return os.path.join(export_dir(), export.filename)
+
+
+def delete_exports(exports):
+    """Delete `exports` and their archives (the caller commits)."""
+
+    for export in exports:
+        if export.filename:
+            try:
+                os.remove(export_path(export))
+            except FileNotFoundError:
+                pass
+        db.session.delete(export)
+    return len(exports)
+
+
+def expire_exports():
+    """Delete exports past EXPORT_RETENTION_DAYS (the caller commits)."""
+
+    days = current_app.config.get('EXPORT_RETENTION_DAYS', DEFAULT_RETENTION_DAYS)
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    return delete_exports(Export.query.filter(Export.created_at < cutoff).all())
+
+
+@job_handler(EXPORT_USER)
+def export_user(payload):
+    """Build a requested export, then clear out expired ones."""
+
+    export = Export.query.get(payload['export_id'])
+    if export is None or export.status == 'done':
+        return
+    export.status = 'running'
+    db.session.commit()
+
+    try:
+        filename = write_user_export(export)
+    except Exception:
+        # Shown as failed unless a retry succeeds
+        db.session.rollback()
+        Export.query.filter_by(id=payload['export_id']).update({'status': 'failed'})
+        db.session.commit()
+        raise
+
+    export.filename = filename
+    export.size = os.path.getsize(export_path(export))
+    export.status = 'done'
+    export.finished_at = datetime.utcnow()
+    expire_exports()
+    db.session.commit()
+    metrics.inc('exports_completed_total', format=export.format)
+
+
+##############################################################################
+# Full-site dumps
+
+
+def site_tables():
+    """(file name, engine, query) of each table in a site dump."""
+
+    users = User.__table__
+    tables = [('users', db.engine,
+               select([c for c in users.c if c.name != 'password']).order_by(users.c.id))]
+    for model in (Follows, Likes, Tag, MessageTag, Mention):
+        table = model.__table__
+        tables.append((table.name, db.engine,
+                       select([table]).order_by(*table.primary_key.columns)))
+
+    shards = message_shards()
+    for index, engine in enumerate(shards.engines or [db.engine]):
+        suffix = f'-shard{index}' if shards.sharded else ''
+        for table in (shards.table, shards.archive_table):
+            tables.append((f'{table.name}{suffix}', engine,
+                           select([table]).order_by(table.c.id)))
+    return tables
+
+
+def dump_table(directory, fmt, name, engine, query):
+    """Stream one table to `directory`/`name`.<ext>.gz; returns its row count."""
+
+    path = os.path.join(directory, f'{name}.{FORMATS[fmt]}.gz')
+    partial = f'{path}.partial'
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        with gzip.open(partial, 'wb') as out:
+            count = write_rows(out, fmt, result.keys(),
+                               fetch_in_batches(result, BATCH_SIZE))
+    os.replace(partial, path)
+    metrics.inc('export_rows_total', count, table=name)
+    return count
+
+
+def dump_site(directory, fmt='csv', workers=DEFAULT_SITE_WORKERS):
+    """Dump every table to `directory`, `workers` tables at a time.
+
+    Returns {file name: row count}, also written to manifest.json.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    started = datetime.utcnow()
+    tables = site_tables()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        counts = list(executor.map(lambda table: dump_table(directory, fmt, *table),
+                                   tables))
+    rows = {name: count for (name, _, _), count in zip(tables, counts)}
+
+    manifest = {'format': fmt, 'started_at': started.isoformat(),
+                'finished_at': datetime.utcnow().isoformat(), 'rows': rows}
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return rows
+
+
+def connect_exports(app):
+    """Register the `flask export-site` command."""
+
+    @app.cli.command('export-site')
+    @click.argument('directory')
+    @click.option('--format', 'fmt', type=click.Choice(sorted(FORMATS)), default='csv')
+    @click.option('--workers', default=DEFAULT_SITE_WORKERS,
+                  help='Tables dumped in parallel.')
+    def export_site_command(directory, fmt, workers):
+        """Dump every table, gzipped, into DIRECTORY."""
+
+        rows = dump_site(directory, fmt, workers)
+        print(f"Dumped {sum(rows.values())} rows from {len(rows)} tables to {directory}.")
@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length, Optional
 
@@ -26,6 +27,8 @@ class UserEditForm(FlaskForm):
     bio = TextAreaField('Bio', validators=[Optional()])
     image_url = StringField('(Optional) Image URL', validators=[Optional()])
     header_image_url = StringField('(Optional) Header_Image URL', validators=[Optional()])
+    image_file = FileField('(Optional) Upload image')
+    header_image_file = FileField('(Optional) Upload header image')
     password = PasswordField('Password', validators=[Length(min=6)])
 
 
@@ -0,0 +1,29 @@
+"""gunicorn settings for Warbler:
+
+    gunicorn -c gunicorn.conf.py --preload 'app:preload_app()'
+
+Each worker runs requests on a pool of threads, so the admission limiter
+(see admission.py), which counts requests in flight per process, has
+something to limit: a sync worker only ever runs one. Size the threads
+against the database pool (see db_pool.py): a thread beyond DB_POOL_SIZE +
+DB_MAX_OVERFLOW would only wait on a connection, so GUNICORN_THREADS
+defaults to that sum. Workers (WEB_CONCURRENCY) x that, plus the job
+workers, must stay under Postgres' max_connections.
+"""
+
+import os
+
+from db_pool import DEFAULTS
+from profiling import install_signal_toggle
+
+worker_class = 'gthread'
+threads = int(os.environ.get(
+    'GUNICORN_THREADS',
+    int(os.environ.get('DB_POOL_SIZE', DEFAULTS['DB_POOL_SIZE']))
+    + int(os.environ.get('DB_MAX_OVERFLOW', DEFAULTS['DB_MAX_OVERFLOW']))))
+
+
+def post_worker_init(worker):
+    # The worker resets SIGUSR2 (among others) once it has forked; put the
+    # profiler's toggle back (see profiling.py).
+    install_signal_toggle(worker.wsgi)
@@ -0,0 +1,421 @@
+"""Image proxy and thumbnail cache for Warbler.
+
+Profile and header images are arbitrary URLs (or uploads), often full-size
+photos. Templates don't link to them directly; `thumbnail_url(url, size)`
+returns /images/<size>/<token>, where the token is the source URL signed
+with SECRET_KEY (so the route can't be used as an open proxy). The route
+fetches the source once, crops and resizes it to one of SIZES and keeps the
+result in an on-disk cache (IMAGE_CACHE_DIR, default .image_cache/):
+
+    blobs/ab/<sha256>.<ext>   thumbnails, stored by content hash, so e.g.
+                              everyone on the default avatar shares a file
+    refs/<key>                (size, source) -> blob name
+
+The blobs are kept under IMAGE_CACHE_MAX_BYTES by evicting the least
+recently served (hits touch the blob's mtime). Thumbnails are served with
+immutable caching headers; a source that can't be fetched or isn't an image
+gets the default image for that size, cached only briefly.
+
+Sources are fetched only from public addresses (IMAGE_PROXY_ALLOW_PRIVATE
+lifts that, for development). Each host, including every redirect hop, is
+resolved once, checked, and connected to by that address.
+
+Uploads from the profile form are stored as-is, by content hash, in
+IMAGE_UPLOAD_DIR (default uploads/) and served from /images/o/; they are
+the only copy, so they are never evicted.
+
+Resizing needs Pillow. Without it, thumbnails are the original images,
+still proxied and cached.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import ssl
+from urllib.parse import urljoin, urlparse
+
+from flask import abort, current_app, send_from_directory, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+from werkzeug.security import safe_join
+
+from assets import IMMUTABLE_CACHE_CONTROL
+from metrics import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_DIR = os.path.join(ROOT, '.image_cache')
+DEFAULT_UPLOAD_DIR = os.path.join(ROOT, 'uploads')
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_SOURCE_BYTES = 10 * 1024 * 1024
+DEFAULT_FETCH_TIMEOUT = 5
+MAX_REDIRECTS = 3
+
+# Pixel sizes, about twice what the stylesheet displays them at.
+SIZES = {
+    'avatar': (400, 400),
+    'timeline': (96, 96),
+    'header': (1500, 500),
+}
+
+DEFAULT_SOURCES = {
+    'avatar': '/static/images/default-pic.png',
+    'timeline': '/static/images/default-pic.png',
+    'header': '/static/images/warbler-hero.jpg',
+}
+
+FALLBACK_CACHE_CONTROL = 'public, max-age=300'
+
+ORIGINALS_URL_PREFIX = '/images/o'
+
+MIMETYPES = {'jpg': 'image/jpeg', 'png': 'image/png', 'gif': 'image/gif',
+             'webp': 'image/webp'}
+
+
+class ImageError(Exception):
+    """The source couldn't be fetched or isn't a usable image."""
+
+
+def sniff_type(content):
+    """File extension for image bytes `content`, or None if not an image."""
+
+    if content.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if content.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if content[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def make_thumbnail(content, size):
+    """(bytes, extension) of `content` cropped and scaled to SIZES[size]."""
+
+    if Image is None:
+        ext = sniff_type(content)
+        if ext is None:
+            raise ImageError("not an image")
+        return content, ext
+
+    try:
+        image = Image.open(io.BytesIO(content))
+        image = ImageOps.fit(ImageOps.exif_transpose(image), SIZES[size],
+                             Image.LANCZOS)
+        out = io.BytesIO()
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image.convert('RGBA').save(out, 'PNG', optimize=True)
+            return out.getvalue(), 'png'
+        image.convert('RGB').save(out, 'JPEG', quality=85, optimize=True,
+                                  progressive=True)
+        return out.getvalue(), 'jpg'
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        raise ImageError(str(exc))
+
+
+##############################################################################
+# On-disk cache
+
+
+def write_atomic(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f'{path}.{os.getpid()}.partial'
+    with open(partial, 'wb') as f:
+        f.write(content)
+    os.replace(partial, path)
+
+
+class ThumbnailStore:
+    """Content-addressed thumbnails with size-bounded LRU eviction."""
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size = None
+
+    def _ref_path(self, key):
+        return os.path.join(self.directory, 'refs', key)
+
+    def _blob_path(self, name):
+        return os.path.join(self.directory, 'blobs', name[:2], name)
+
+    def get(self, key):
+        """Path of the cached thumbnail for `key`, or None."""
+
+        try:
+            with open(self._ref_path(key)) as f:
+                path = self._blob_path(f.read())
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, content, ext):
+        """Store `content` for `key`; return its path."""
+
+        name = f'{hashlib.sha256(content).hexdigest()}.{ext}'
+        path = self._blob_path(name)
+        if not os.path.exists(path):
+            write_atomic(path, content)
+            self._grow(len(content))
+        write_atomic(self._ref_path(key), name.encode())
+        return path
+
+    def _grow(self, added):
+        if self._size is None:
+            self._size = sum(os.path.getsize(path) for path, _ in self._blobs())
+        else:
+            self._size += added
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _blobs(self):
+        for root, dirs, files in os.walk(os.path.join(self.directory, 'blobs')):
+            for filename in files:
+                if not filename.endswith('.partial'):
+                    path = os.path.join(root, filename)
+                    yield path, os.stat(path)
+
+    def evict(self, target=None):
+        """Drop least recently used blobs until under `target` bytes
+        (default 90% of max_bytes). Refs to them become misses."""
+
+        target = self.max_bytes * 0.9 if target is None else target
+        blobs = sorted(self._blobs(), key=lambda blob: blob[1].st_mtime)
+        total = sum(stat.st_size for _, stat in blobs)
+        evicted = 0
+        for path, stat in blobs:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= stat.st_size
+            evicted += 1
+        self._size = total
+        metrics.inc('image_cache_evictions_total', evicted)
+        return evicted
+
+
+##############################################################################
+# Sources
+
+
+def _is_public(ip):
+    return ip.is_global
+
+
+def _resolve(host, port, allow_private=False):
+    """The address to connect to for `host`, checked to be public (every
+    address it resolves to must be, unless `allow_private`).
+
+    The fetch connects to this address rather than resolving `host` again,
+    so a DNS answer that changes in between can't redirect it.
+    """
+
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as exc:
+        raise ImageError(str(exc))
+    addresses = [info[4][0] for info in infos]
+    if not allow_private:
+        for address in addresses:
+            if not _is_public(ipaddress.ip_address(address.split('%')[0])):
+                raise ImageError(f"{host} is not a public address")
+    return addresses[0]
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection to `host` that connects to an already checked `address`."""
+
+    def __init__(self, host, port, address, timeout):
+        super().__init__(host, port, timeout=timeout)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """Like _PinnedHTTPConnection, verifying the certificate against `host`."""
+
+    def __init__(self, host, port, address, timeout):
+        super().__init__(host, port, timeout=timeout, context=ssl.create_default_context())
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def fetch(url, max_bytes, timeout, allow_private=False):
+    """GET an http(s) `url`, following up to MAX_REDIRECTS redirects; every
+    hop's host is resolved and checked once, and connected to by address."""
+
+    for _ in range(MAX_REDIRECTS + 1):
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise ImageError(f"unsupported image URL: {url}")
+        try:
+            port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        except ValueError as exc:
+            raise ImageError(str(exc))
+        address = _resolve(parsed.hostname, port, allow_private)
+
+        connection_class = (_PinnedHTTPSConnection if parsed.scheme == 'https'
+                            else _PinnedHTTPConnection)
+        connection = connection_class(parsed.hostname, port, address, timeout)
+        path = (parsed.path or '/') + (f'?{parsed.query}' if parsed.query else '')
+        try:
+            connection.request('GET', path, headers={'User-Agent': 'Warbler image proxy'})
+            response = connection.getresponse()
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                if not location:
+                    raise ImageError(f"redirect without a Location from {url}")
+                url = urljoin(url, location)
+                continue
+            if response.status != 200:
+                raise ImageError(f"HTTP {response.status} from {url}")
+            return response.read(max_bytes + 1)
+        except (OSError, http.client.HTTPException) as exc:
+            raise ImageError(str(exc))
+        finally:
+            connection.close()
+
+    raise ImageError(f"more than {MAX_REDIRECTS} redirects")
+
+
+def read_source(url):
+    """Bytes of the image at `url` (an upload, a static file or http(s))."""
+
+    config = current_app.config
+    max_bytes = config.get('IMAGE_MAX_SOURCE_BYTES', DEFAULT_MAX_SOURCE_BYTES)
+
+    for prefix, directory in ((ORIGINALS_URL_PREFIX + '/', upload_dir()),
+                              (current_app.static_url_path + '/',
+                               current_app.static_folder)):
+        if url.startswith(prefix):
+            path = safe_join(directory, url[len(prefix):])
+            try:
+                with open(path, 'rb') as f:
+                    return f.read(max_bytes)
+            except (TypeError, OSError):
+                raise ImageError(f"no such file: {url}")
+
+    content = fetch(url, max_bytes,
+                    timeout=config.get('IMAGE_FETCH_TIMEOUT', DEFAULT_FETCH_TIMEOUT),
+                    allow_private=config.get('IMAGE_PROXY_ALLOW_PRIVATE', False))
+    if len(content) > max_bytes:
+        raise ImageError(f"image larger than {max_bytes} bytes")
+    return content
+
+
+def upload_dir():
+    return current_app.config.get('IMAGE_UPLOAD_DIR') or DEFAULT_UPLOAD_DIR
+
+
+def save_upload(file_storage):
+    """Store an uploaded image; return the URL to use as its image_url.
+
+    Raises ImageError if it isn't an image or is too large.
+    """
+
+    max_bytes = current_app.config.get('IMAGE_MAX_SOURCE_BYTES',
+                                       DEFAULT_MAX_SOURCE_BYTES)
+    content = file_storage.read(max_bytes + 1)
+    if len(content) > max_bytes:
+        raise ImageError(f"image larger than {max_bytes} bytes")
+    ext = sniff_type(content)
+    if ext is None:
+        raise ImageError("not a PNG, JPEG, GIF or WebP image")
+
+    filename = f'{hashlib.sha256(content).hexdigest()}.{ext}'
+    path = os.path.join(upload_dir(), filename)
+    if not os.path.exists(path):
+        write_atomic(path, content)
+    return url_for('image_original', filename=filename)
+
+
+##############################################################################
+# Routes and template helper
+
+
+def _signer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='image-proxy')
+
+
+def thumbnail_url(url, size):
+    """URL of the `size` thumbnail of image `url` (or of the default)."""
+
+    return url_for('image_thumbnail', size=size,
+                   token=_signer().dumps(url or DEFAULT_SOURCES[size]))
+
+
+def thumbnail_path(size, source):
+    """Path of the cached thumbnail, fetching and resizing on a miss."""
+
+    store = current_app.extensions['images']
+    key = hashlib.sha256(f'{size}\n{source}'.encode()).hexdigest()
+    path = store.get(key)
+    if path is not None:
+        metrics.inc('image_thumbnails_total', result='hit')
+        return path
+
+    content, ext = make_thumbnail(read_source(source), size)
+    metrics.inc('image_thumbnails_total', result='miss')
+    return store.put(key, content, ext)
+
+
+def _send(path, cache_control):
+    ext = path.rsplit('.', 1)[-1]
+    response = send_from_directory(os.path.dirname(path), os.path.basename(path),
+                                   mimetype=MIMETYPES[ext])
+    response.headers['Cache-Control'] = cache_control
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+def serve_thumbnail(size, token):
+    if size not in SIZES:
+        abort(404)
+    try:
+        source = _signer().loads(token)
+    except BadSignature:
+        abort(404)
+
+    try:
+        return _send(thumbnail_path(size, source), IMMUTABLE_CACHE_CONTROL)
+    except ImageError:
+        metrics.inc('image_thumbnails_total', result='error')
+        if source == DEFAULT_SOURCES[size]:
+            abort(404)
+
+    # Not cached as immutable: the source may come back.
+    return _send(thumbnail_path(size, DEFAULT_SOURCES[size]), FALLBACK_CACHE_CONTROL)
+
+
+def serve_original(filename):
+    if filename.rsplit('.', 1)[-1] not in MIMETYPES:
+        abort(404)
+    return _send(safe_join(upload_dir(), filename) or abort(404),
+                 IMMUTABLE_CACHE_CONTROL)
+
+
+def connect_images(app):
+    """Register the thumbnail store, routes and `thumbnail_url` helper."""
+
+    app.extensions['images'] = ThumbnailStore(
+        app.config.get('IMAGE_CACHE_DIR') or DEFAULT_CACHE_DIR,
+        app.config.get('IMAGE_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES))
+    app.add_url_rule(f'{ORIGINALS_URL_PREFIX}/<filename>', 'image_original', serve_original)
+    app.add_url_rule('/images/<size>/<token>', 'image_thumbnail', serve_thumbnail)
+    app.add_template_global(thumbnail_url)
@@ -0,0 +1,250 @@
+"""Durable, table-backed job queue for Warbler.
+
+Views call `enqueue()` inside their own transaction, so a job exists exactly
+when the write that caused it commits. Worker processes (`flask jobs-worker`)
+claim due jobs with SELECT ... FOR UPDATE SKIP LOCKED, run the handler
+registered for the job's kind and mark it done. Delivery is at-least-once:
+
+- a failing handler is retried with exponential backoff until the job's
+  `max_attempts`, then left as 'failed' with its last error;
+- a claimed job carries a lease (`locked_until`); if its worker dies, the
+  job becomes claimable again once the lease expires.
+
+Handlers must therefore be idempotent. `idempotency_key` lets callers
+enqueue the same logical job more than once and have it stored only once.
+
+Queue depth and the lag of the oldest due job are exposed through the
+metrics registry.
+"""
+
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app, has_app_context
+from sqlalchemy import and_, or_, func
+
+from metrics import metrics
+from models import db, Job
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_LEASE = timedelta(minutes=5)
+POLL_INTERVAL = 1.0
+FINISHED_RETENTION = timedelta(days=1)
+
+HANDLERS = {}
+
+
+def job_handler(kind):
+    """Register the decorated function as the handler for `kind` jobs.
+
+    Handlers are called with the job's decoded payload inside an app
+    context; raising marks the attempt failed.
+    """
+
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+
+    return register
+
+
+def enqueue(kind, payload=None, idempotency_key=None, run_at=None,
+            max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Add a job to the current transaction (the caller commits).
+
+    Returns the new Job, or None if a job with `idempotency_key` exists.
+    """
+
+    if idempotency_key is not None:
+        exists = (db.session.query(Job.id)
+                  .filter(Job.idempotency_key == idempotency_key)
+                  .first())
+        if exists:
+            return None
+
+    job = Job(
+        kind=kind,
+        payload=json.dumps(payload or {}),
+        idempotency_key=idempotency_key,
+        run_at=run_at or datetime.utcnow(),
+        max_attempts=max_attempts,
+    )
+    db.session.add(job)
+    return job
+
+
+def claim(worker_id, batch_size=DEFAULT_BATCH_SIZE, lease=DEFAULT_LEASE):
+    """Lease up to `batch_size` due jobs to `worker_id` and commit."""
+
+    now = datetime.utcnow()
+    due = or_(
+        and_(Job.status == 'queued', Job.run_at <= now),
+        and_(Job.status == 'running', Job.locked_until < now),
+    )
+    jobs = (Job.query
+            .filter(due)
+            .order_by(Job.run_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+            .all())
+
+    for job in jobs:
+        job.status = 'running'
+        job.locked_by = worker_id
+        job.locked_until = now + lease
+        job.attempts += 1
+    db.session.commit()
+    return jobs
+
+
+def backoff(attempts):
+    """Delay before retrying a job that has failed `attempts` times."""
+
+    return timedelta(seconds=min(2 ** attempts, 3600))
+
+
+def run_job(job):
+    """Run one claimed job and record the outcome."""
+
+    job_id, kind = job.id, job.kind
+    started = time.perf_counter()
+
+    try:
+        handler = HANDLERS[kind]
+        handler(json.loads(job.payload))
+    except Exception as exc:
+        db.session.rollback()
+        job = Job.query.get(job_id)
+        job.last_error = f"{type(exc).__name__}: {exc}"
+        job.locked_by = job.locked_until = None
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            metrics.inc('jobs_failed_total', kind=kind)
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + backoff(job.attempts)
+            metrics.inc('jobs_retried_total', kind=kind)
+        db.session.commit()
+        return False
+
+    job.status = 'done'
+    job.locked_by = job.locked_until = None
+    db.session.commit()
+    metrics.inc('jobs_completed_total', kind=kind)
+    metrics.observe('job_duration_seconds', time.perf_counter() - started,
+                    kind=kind)
+    return True
+
+
+def run_pending(worker_id=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Claim and run one batch of due jobs. Returns how many ran."""
+
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    jobs = claim(worker_id, batch_size)
+    for job in jobs:
+        run_job(job)
+    return len(jobs)
+
+
+def purge_finished(older_than=FINISHED_RETENTION):
+    """Delete done jobs (and their idempotency keys) past retention."""
+
+    cutoff = datetime.utcnow() - older_than
+    deleted = (Job.query
+               .filter(Job.status == 'done', Job.created_at < cutoff)
+               .delete(synchronize_session=False))
+    db.session.commit()
+    return deleted
+
+
+def collect_queue_metrics():
+    """Refresh queue depth and lag gauges (called on each /metrics scrape)."""
+
+    if not has_app_context() or 'sqlalchemy' not in current_app.extensions:
+        return
+
+    depth = dict(db.session.query(Job.status, func.count(Job.id))
+                 .group_by(Job.status))
+    for status in ('queued', 'running', 'failed'):
+        metrics.set('jobs_queue_depth', depth.get(status, 0), status=status)
+
+    oldest = (db.session.query(func.min(Job.run_at))
+              .filter(Job.status == 'queued', Job.run_at <= datetime.utcnow())
+              .scalar())
+    lag = (datetime.utcnow() - oldest).total_seconds() if oldest else 0
+    metrics.set('jobs_lag_seconds', lag)
+
+
+##############################################################################
+# Worker processes
+
+
+def work(app, stop, batch_size=DEFAULT_BATCH_SIZE, poll_interval=POLL_INTERVAL):
+    """Process jobs until `stop` (a multiprocessing Event) is set."""
+
+    # The parent handles SIGINT/SIGTERM and sets `stop`.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    last_purge = 0
+
+    with app.app_context():
+        # Don't share the parent's pooled connections across the fork.
+        db.engine.dispose()
+
+        while not stop.is_set():
+            try:
+                ran = run_pending(worker_id, batch_size)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("Job worker poll failed")
+                ran = 0
+
+            if time.monotonic() - last_purge > 3600:
+                purge_finished()
+                last_purge = time.monotonic()
+
+            if not ran:
+                stop.wait(poll_interval)
+
+
+def run_workers(app, processes, batch_size=DEFAULT_BATCH_SIZE):
+    """Fork `processes` worker processes and run until SIGINT/SIGTERM."""
+
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    workers = [context.Process(target=work, args=(app, stop, batch_size))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    def shutdown(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for worker in workers:
+        worker.join()
+
+
+def connect_jobs(app):
+    """Register queue metrics and the `flask jobs-worker` command."""
+
+    metrics.add_collector(collect_queue_metrics)
+
+    @app.cli.command('jobs-worker')
+    @click.option('--processes', default=2, help='Number of worker processes.')
+    @click.option('--batch-size', default=DEFAULT_BATCH_SIZE,
+                  help='Jobs claimed per poll.')
+    def jobs_worker_command(processes, batch_size):
+        """Run background job workers."""
+
+        run_workers(app, processes, batch_size)
+
@@ -0,0 +1,201 @@
+"""Time-ordered 64-bit message ids ("Snowflake" ids).
+
+    | 0 | 41 bits: ms since EPOCH | 10 bits: worker | 12 bits: sequence |
+
+Each process hands out ids on its own: it has a worker id and counts up
+to 4096 ids per millisecond. One process's ids strictly increase, even if
+the clock steps back; across processes they are ordered by millisecond.
+Ordering messages by id is therefore ordering them by creation time, and a
+feed page is a range scan on one column.
+
+No two live processes may share a worker id, or they can issue the same id
+in the same millisecond. Nothing reliably catches that: a primary key only
+sees duplicates within one shard's table, and two web workers posting for
+users on different shards would both succeed. So a process either gets
+MESSAGE_ID_WORKER (one per process, e.g. from gunicorn's post_fork hook)
+or leases a worker id from the `message_id_workers` table in the primary
+database before its first id (see WorkerLeases), renewing the lease as it
+goes. Only a generator with neither, outside the app, falls back to an id
+derived from the hostname and pid, which is safe for a lone process only.
+
+41 bits of milliseconds from 2010 last until 2079.
+"""
+
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+EPOCH = datetime(2010, 1, 1)
+EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIME_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+DEFAULT_LEASE = timedelta(minutes=5)
+# Attempts at leasing a free worker id while other processes race for it.
+LEASE_ATTEMPTS = 5
+
+
+def default_worker_id():
+    """A worker id from this host and process (not guaranteed unique)."""
+
+    return zlib.crc32(f'{socket.gethostname()}:{os.getpid()}'.encode()) & MAX_WORKER
+
+
+class WorkerLeases:
+    """Worker ids leased to processes through a table, one holder each.
+
+    `engine()` gives the engine to use; `table` has worker_id, locked_by
+    and locked_until columns (models.MessageIdWorker). A lease lasts
+    `lease`, and the generator renews it every third of that, before
+    issuing an id. A process that dies just lets its lease run out.
+    """
+
+    def __init__(self, engine, table, lease=DEFAULT_LEASE):
+        self.engine = engine
+        self.table = table
+        self.lease = lease
+        self.renew_every = lease.total_seconds() / 3
+
+    def acquire(self, owner, worker_id=None):
+        """Renew `owner`'s lease on `worker_id`, or else lease the lowest
+        free worker id; returns the one `owner` now holds."""
+
+        table = self.table
+        for attempt in range(LEASE_ATTEMPTS):
+            now = datetime.utcnow()
+            until = now + self.lease
+            try:
+                with self.engine().begin() as conn:
+                    if worker_id is not None and conn.execute(
+                            table.update()
+                            .where((table.c.worker_id == worker_id)
+                                   & (table.c.locked_by == owner))
+                            .values(locked_until=until)).rowcount:
+                        return worker_id
+
+                    held = {held_id for (held_id,) in conn.execute(
+                        select([table.c.worker_id]).where(table.c.locked_until >= now))}
+                    free = next((i for i in range(MAX_WORKER + 1) if i not in held), None)
+                    if free is None:
+                        raise RuntimeError(f"All {MAX_WORKER + 1} message id workers "
+                                           f"are leased.")
+                    # Replace an expired lease only: one taken since the
+                    # SELECT above stays, and the INSERT fails and retries
+                    conn.execute(table.delete().where((table.c.worker_id == free)
+                                                      & (table.c.locked_until < now)))
+                    conn.execute(table.insert().values(
+                        worker_id=free, locked_by=owner, locked_until=until))
+                    return free
+            except IntegrityError:
+                # Another process leased the same id first
+                if attempt == LEASE_ATTEMPTS - 1:
+                    raise
+
+
+class IdGenerator:
+    """Thread-safe generator of time-ordered ids for one process."""
+
+    def __init__(self, worker_id=None, clock=time.time, leases=None):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._leases = leases
+        self.set_worker(worker_id)
+
+    def set_worker(self, worker_id):
+        """Use `worker_id` from now on (None: lease or derive one, per
+        process)."""
+
+        if worker_id is not None and not 0 <= worker_id <= MAX_WORKER:
+            raise ValueError(f"worker id must be between 0 and {MAX_WORKER}")
+        with self._lock:
+            self._configured = worker_id
+            self._pid = None
+
+    def set_leases(self, leases):
+        """Lease worker ids from `leases` (a WorkerLeases) unless one is set."""
+
+        with self._lock:
+            self._leases = leases
+            self._pid = None
+
+    def _renew_worker(self):
+        if self._leases is None:
+            worker_id = default_worker_id()
+            self._renew_at = float('inf')
+        else:
+            worker_id = self._leases.acquire(self._owner, self.worker_id)
+            self._renew_at = time.monotonic() + self._leases.renew_every
+        if worker_id != self.worker_id and self._last_ms >= 0:
+            # The lease was lost: move on to the next millisecond, so ids
+            # under the new worker id still sort after this process's last
+            self._sequence = MAX_SEQUENCE
+        self.worker_id = worker_id
+
+    def next_id(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # New process (e.g. a forked worker): new worker id unless set
+                self._pid = os.getpid()
+                self._owner = f'{socket.gethostname()}:{self._pid}:{uuid.uuid4().hex[:8]}'
+                self.worker_id = self._configured
+                self._renew_at = 0
+                self._last_ms, self._sequence = -1, 0
+            if self._configured is None and time.monotonic() >= self._renew_at:
+                self._renew_worker()
+
+            now = max(int(self.clock() * 1000) - EPOCH_MS, self._last_ms)
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # 4096 ids this millisecond: wait for the next one
+                    while now <= self._last_ms:
+                        now = int(self.clock() * 1000) - EPOCH_MS
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (now << TIME_SHIFT) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+generator = IdGenerator()
+
+
+def next_message_id():
+    """A new message id."""
+
+    return generator.next_id()
+
+
+def timestamp_of(message_id):
+    """When `message_id` was issued (UTC, millisecond precision)."""
+
+    return EPOCH + timedelta(milliseconds=message_id >> TIME_SHIFT)
+
+
+def lowest_id(moment):
+    """The smallest id that could be issued at or after `moment` (UTC)."""
+
+    return max(int((moment - EPOCH).total_seconds() * 1000), 0) << TIME_SHIFT
+
+
+def connect_message_ids(app):
+    """Use MESSAGE_ID_WORKER, if set, as this process's worker id; else
+    lease one per process from `app`'s primary database."""
+
+    from models import db, MessageIdWorker  # models imports this module
+
+    if app.config.get('MESSAGE_ID_WORKER') is not None:
+        generator.set_worker(app.config['MESSAGE_ID_WORKER'])
+    else:
+        generator.set_leases(WorkerLeases(lambda: db.get_engine(app),
+                                          MessageIdWorker.__table__))
@@ -0,0 +1,224 @@
+"""Hashtag and mention index for Warbler.
+
+Message text is stored as-is; `index_message` parses its #tags and
+@mentions when it is written and records them in two inverted-index tables
+(see models.py), keyed so that a feed is one index range scan, newest first
+(message ids are time-ordered):
+
+    message_tags  (tag_id, message_id) + author_id
+    mentions      (user_id, message_id) + author_id
+
+`tag_feed` and `mention_feed` page through them with a message id keyset
+cursor and then load just that page's messages from the shard router.
+
+Messages written before the index existed are indexed by
+`message_index.backfill` jobs: `flask backfill-message-index` splits each
+shard's messages (hot and archived) into id ranges and enqueues a job per
+range, so the job workers index them in parallel. Indexing replaces a
+message's entries, so re-running the backfill is safe.
+"""
+
+import re
+
+import click
+from flask import Markup, escape, url_for
+from sqlalchemy.exc import IntegrityError
+
+from api import encode_cursor, decode_cursor, cursor_id
+from jobs import job_handler, enqueue
+from metrics import metrics
+from models import db, User, Tag, MessageTag, Mention
+from sharding import message_shards, hydrate
+
+TAG_RE = re.compile(r'(?<![\w#])#(\w{1,139})')
+# Usernames may contain dots, but a mention doesn't end in one ("hi @bob.").
+MENTION_RE = re.compile(r'(?<![\w@])@(\w(?:[\w.]*\w)?)')
+
+FEED_PAGE_SIZE = 20
+BACKFILL = 'message_index.backfill'
+BACKFILL_CHUNK_SIZE = 2000
+INSERT_BATCH_SIZE = 500
+
+
+def parse(text):
+    """(tags, mentioned usernames) in `text`; tags are lowercased."""
+
+    tags = sorted({tag.lower() for tag in TAG_RE.findall(text)})
+    mentions = sorted(set(MENTION_RE.findall(text)))
+    return tags, mentions
+
+
+def tag_ids(names):
+    """{name: id} for tag `names`, creating the missing ones."""
+
+    if not names:
+        return {}
+    ids = dict(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(names)))
+    for name in set(names) - set(ids):
+        try:
+            with db.session.begin_nested():
+                db.session.execute(Tag.__table__.insert().values(name=name))
+        except IntegrityError:
+            pass  # added concurrently
+    missing = set(names) - set(ids)
+    if missing:
+        ids.update(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(missing)))
+    return ids
+
+
+def index_messages(rows):
+    """Replace the index entries of MessageRows `rows` (the caller commits).
+
+    Returns (tag entries, mention entries) written.
+    """
+
+    parsed = [(row, *parse(row.text)) for row in rows]
+    tags = tag_ids({tag for _, names, _ in parsed for tag in names})
+    usernames = {name for _, _, names in parsed for name in names}
+    users = (dict(db.session.query(User.username, User.id)
+                  .filter(User.username.in_(usernames), User.deleted_at.is_(None)))
+             if usernames else {})
+
+    tag_entries, mention_entries = [], []
+    for row, tag_names, mentioned in parsed:
+        entry = {'message_id': row.id, 'author_id': row.user_id}
+        tag_entries += [dict(entry, tag_id=tags[name]) for name in tag_names]
+        mention_entries += [dict(entry, user_id=users[name])
+                            for name in mentioned if name in users]
+
+    unindex_messages([row.id for row in rows])
+    for table, entries in ((MessageTag.__table__, tag_entries),
+                           (Mention.__table__, mention_entries)):
+        for start in range(0, len(entries), INSERT_BATCH_SIZE):
+            db.session.execute(table.insert(), entries[start:start + INSERT_BATCH_SIZE])
+    return len(tag_entries), len(mention_entries)
+
+
+def index_message(row):
+    """Index a newly written MessageRow (the caller commits).
+
+    Returns the ids of the users it mentions.
+    """
+
+    mentions = parse(row.text)[1]
+    index_messages([row])
+    if not mentions:
+        return []
+    return [user_id for (user_id,) in (db.session.query(User.id)
+                                       .filter(User.username.in_(mentions),
+                                               User.deleted_at.is_(None)))]
+
+
+def unindex_messages(message_ids):
+    """Drop the index entries of `message_ids` (the caller commits)."""
+
+    if message_ids:
+        for model in (MessageTag, Mention):
+            (model.query
+             .filter(model.message_id.in_(message_ids))
+             .delete(synchronize_session=False))
+
+
+##############################################################################
+# Feeds
+
+
+def feed_page(model, column, key, cursor=None, limit=FEED_PAGE_SIZE):
+    """A page of the messages indexed under `column == key`, newest first.
+
+    Returns (messages with authors attached, cursor for the next page or
+    None).
+    """
+
+    query = (db.session.query(model.message_id)
+             .join(User, User.id == model.author_id)
+             .filter(column == key, User.deleted_at.is_(None)))
+
+    before = cursor_id(decode_cursor(cursor))
+    if before is not None:
+        query = query.filter(model.message_id < before)
+
+    ids = [message_id for (message_id,) in (query
+                                            .order_by(model.message_id.desc())
+                                            .limit(limit + 1))]
+    next_cursor = None
+    if len(ids) > limit:
+        ids = ids[:limit]
+        next_cursor = encode_cursor(ids[-1])
+
+    rows = message_shards().get_many(ids)
+    return hydrate([rows[message_id] for message_id in ids if message_id in rows]), next_cursor
+
+
+def tag_feed(tag, cursor=None, limit=FEED_PAGE_SIZE):
+    """Page of messages tagged #`tag`; see `feed_page`."""
+
+    tag_id = db.session.query(Tag.id).filter_by(name=tag.lower()).scalar()
+    if tag_id is None:
+        return [], None
+    return feed_page(MessageTag, MessageTag.tag_id, tag_id, cursor, limit)
+
+
+def mention_feed(user_id, cursor=None, limit=FEED_PAGE_SIZE):
+    """Page of messages mentioning user `user_id`; see `feed_page`."""
+
+    return feed_page(Mention, Mention.user_id, user_id, cursor, limit)
+
+
+def link_tags(text):
+    """Message text (escaped) with each #tag linked to its feed."""
+
+    parts, last = [], 0
+    for match in TAG_RE.finditer(text):
+        parts.append(escape(text[last:match.start()]))
+        parts.append(Markup('<a href="{}">#{}</a>').format(
+            url_for('tags_show', tag=match.group(1).lower()), match.group(1)))
+        last = match.end()
+    parts.append(escape(text[last:]))
+    return Markup('').join(parts)
+
+
+##############################################################################
+# Backfill
+
+
+def enqueue_backfill(chunk_size=BACKFILL_CHUNK_SIZE):
+    """Enqueue a backfill job per id range of every shard's messages
+    (the caller commits). Returns the number of jobs."""
+
+    shards = message_shards()
+    jobs = 0
+    for index in range(shards.count):
+        for kind, table in (('hot', shards.table), ('archive', shards.archive_table)):
+            for start, end in shards.id_ranges(index, table, chunk_size):
+                enqueue(BACKFILL, {'shard': index, 'table': kind,
+                                   'start': start, 'end': end})
+                jobs += 1
+    return jobs
+
+
+@job_handler(BACKFILL)
+def backfill_chunk(payload):
+    """Index the messages in one id range of one shard's table."""
+
+    shards = message_shards()
+    table = shards.archive_table if payload['table'] == 'archive' else shards.table
+    rows = shards.scan(payload['shard'], table, payload['start'], payload['end'])
+    index_messages(rows)
+    metrics.inc('message_index_backfilled_total', len(rows))
+
+
+def connect_message_index(app):
+    """Register the `link_tags` template helper and the backfill CLI command."""
+
+    app.add_template_global(link_tags)
+
+    @app.cli.command('backfill-message-index')
+    @click.option('--chunk-size', default=BACKFILL_CHUNK_SIZE,
+                  help='Messages per job.')
+    def backfill_message_index_command(chunk_size):
+        """Index tags and mentions of existing messages, via the job queue."""
+
+        jobs = enqueue_backfill(chunk_size)
+        db.session.commit()
+        print(f"Enqueued {jobs} backfill jobs; run `flask jobs-worker` to process them.")
@@ -0,0 +1,172 @@
+"""In-process metrics for Warbler.
+
+A small thread-safe registry of counters, gauges and histograms, rendered in
+the Prometheus text format at /metrics. Request timing is recorded for every
+view; other subsystems report through the same module-level `metrics`
+registry.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, request, Response
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Cumulative bucket counts plus running count and sum."""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    inner = ','.join(f'{k}="{v}"' for k, v in pairs)
+    return '{' + inner + '}'
+
+
+class Metrics:
+    """Registry of named, labelled counters, gauges and histograms."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def add_collector(self, collector):
+        """Call `collector()` before every render, e.g. to refresh gauges."""
+
+        if collector not in self._collectors:
+            self._collectors.append(collector)
+
+    def inc(self, name, value=1, **labels):
+        """Add `value` to a counter."""
+
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge to `value`."""
+
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        """Record `value` in a histogram."""
+
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def value(self, name, **labels):
+        """Current value of a counter or gauge (0 if never recorded)."""
+
+        key = (name, _label_key(labels))
+        with self._lock:
+            if key in self._gauges:
+                return self._gauges[key]
+            return self._counters.get(key, 0)
+
+    def histogram(self, name, **labels):
+        """Return (count, sum) of a histogram."""
+
+        with self._lock:
+            histogram = self._histograms.get((name, _label_key(labels)))
+            if histogram is None:
+                return (0, 0.0)
+            return (histogram.count, histogram.sum)
+
+    def reset(self):
+        """Forget everything recorded so far."""
+
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format."""
+
+        for collector in self._collectors:
+            collector()
+
+        lines = []
+        with self._lock:
+            for kind, series in (('counter', self._counters),
+                                 ('gauge', self._gauges)):
+                seen = set()
+                for (name, key), value in sorted(series.items()):
+                    if name not in seen:
+                        lines.append(f'# TYPE {name} {kind}')
+                        seen.add(name)
+                    lines.append(f'{name}{_format_labels(key)} {value}')
+
+            seen = set()
+            for (name, key), histogram in sorted(self._histograms.items()):
+                if name not in seen:
+                    lines.append(f'# TYPE {name} histogram')
+                    seen.add(name)
+                cumulative = 0
+                bounds = [str(b) for b in histogram.buckets] + ['+Inf']
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    labels = _format_labels(key, [('le', bound)])
+                    lines.append(f'{name}_bucket{labels} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(key)} {histogram.sum}')
+                lines.append(f'{name}_count{_format_labels(key)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def connect_metrics(app):
+    """Time every request and expose the registry at /metrics."""
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_time(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            endpoint = request.endpoint or 'unknown'
+            metrics.observe('http_request_duration_seconds',
+                            time.perf_counter() - started,
+                            endpoint=endpoint, method=request.method)
+            metrics.inc('http_requests_total', endpoint=endpoint,
+                        method=request.method, status=response.status_code)
+        return response
+
+    @app.route('/metrics')
+    def show_metrics():
+        """Prometheus scrape endpoint."""
+
+        return Response(metrics.render(), mimetype='text/plain')
@@ -1,12 +1,23 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import namedtuple
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+
+from db_routing import RoutingSQLAlchemy
+from message_ids import next_message_id
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+# Message ids are 64-bit (see message_ids.py); SQLite's INTEGER already is,
+# and keeps the primary key a rowid alias.
+MessageId = db.BigInteger().with_variant(db.Integer, 'sqlite')
+
+ProfileCounts = namedtuple('ProfileCounts', 'following followers likes')
+
+LIKES_MESSAGE_FK = 'likes_message_id_fkey'
 
 
 class Follows(db.Model):
@@ -26,6 +37,35 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def followed_among(cls, follower_id, user_ids):
+        """Which of `user_ids` does `follower_id` follow? One query."""
+
+        rows = (db.session.query(cls.user_being_followed_id)
+                .filter(cls.user_following_id == follower_id,
+                        cls.user_being_followed_id.in_(user_ids)))
+        return {user_id for (user_id,) in rows}
+
+    @classmethod
+    def follow_many(cls, follower_id, user_ids):
+        """Make `follower_id` follow every existing user in `user_ids`.
+
+        Runs as a single INSERT ... SELECT that skips unknown or deleted
+        ids, the follower themself and follows that already exist. Returns the number
+        of follows added; the caller commits.
+        """
+
+        already_followed = (db.session.query(cls.user_being_followed_id)
+                            .filter(cls.user_following_id == follower_id))
+        new_follows = (db.select([db.literal(follower_id), User.id])
+                       .where(db.and_(User.id.in_(user_ids),
+                                      User.id != follower_id,
+                                      User.deleted_at.is_(None),
+                                      ~User.id.in_(already_followed))))
+        insert = cls.__table__.insert().from_select(
+            ['user_following_id', 'user_being_followed_id'], new_follows)
+        return db.session.execute(insert).rowcount
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -42,12 +82,26 @@ class Likes(db.Model):
         db.ForeignKey('users.id', ondelete='cascade')
     )
 
+    # Dropped when messages are sharded, as it can't span databases (see
+    # sharding.py)
     message_id = db.Column(
-        db.Integer,
-        db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        MessageId,
+        db.ForeignKey('messages.id', ondelete='cascade', name=LIKES_MESSAGE_FK),
     )
 
+    # Each user likes a message at most once; any number of users may like it.
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+    )
+
+    @classmethod
+    def liked_among(cls, user_id, message_ids):
+        """Which of `message_ids` does `user_id` like? One query."""
+
+        rows = (db.session.query(cls.message_id)
+                .filter(cls.user_id == user_id, cls.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in rows}
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,20 +148,29 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Set when the account is deleted; the rows are purged in the background
+    # (see tasks.purge_user) and the user is hidden everywhere until then.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=db.and_(Follows.user_following_id == id,
+                              deleted_at.is_(None))
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=db.and_(Follows.user_being_followed_id == id,
+                              deleted_at.is_(None)),
+        overlaps='followers',
     )
 
     likes = db.relationship(
@@ -118,17 +181,47 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    # By id, so `other_user` may be a User or a cached snapshot of one
+    # (see entity_cache.py).
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return any(user.id == other_user.id for user in self.followers)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return any(user.id == other_user.id for user in self.following)
+
+    @classmethod
+    def profile_counts(cls, user_id):
+        """ProfileCounts for `user_id`'s profile card, in one query.
+
+        Counts what `following`, `followers` and `likes` would hold,
+        without loading them.
+        """
+
+        following = (db.session.query(db.func.count(Follows.user_being_followed_id))
+                     .join(cls, cls.id == Follows.user_being_followed_id)
+                     .filter(Follows.user_following_id == user_id,
+                             cls.deleted_at.is_(None)))
+        followers = (db.session.query(db.func.count(Follows.user_following_id))
+                     .join(cls, cls.id == Follows.user_following_id)
+                     .filter(Follows.user_being_followed_id == user_id,
+                             cls.deleted_at.is_(None)))
+        # Likes go with their message (see MessageShards.delete_many), so
+        # no join to messages, which may be on another shard
+        likes = (db.session.query(db.func.count(Likes.id))
+                 .filter(Likes.user_id == user_id))
+        return ProfileCounts(*db.session.query(
+            following.scalar_subquery(), followers.scalar_subquery(),
+            likes.scalar_subquery()).one())
+
+    @classmethod
+    def visible(cls):
+        """Query of users that haven't been deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -160,7 +253,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.visible().filter_by(username=username).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -174,10 +267,51 @@ class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    )
 
+    # Time-ordered, so feeds sort and page on it alone.
     id = db.Column(
+        MessageId,
+        primary_key=True,
+        autoincrement=False,
+        default=next_message_id,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    user_id = db.Column(
         db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    user = db.relationship('User', overlaps='messages')
+
+
+class MessageArchive(db.Model):
+    """A message moved out of `messages` once older than the archive
+    horizon (see sharding.MessageShards.archive)."""
+
+    __tablename__ = 'messages_archive'
+    __table_args__ = (
+        db.Index('ix_messages_archive_user_id_id', 'user_id', 'id'),
+    )
+
+    id = db.Column(
+        MessageId,
         primary_key=True,
+        autoincrement=False,
     )
 
     text = db.Column(
@@ -188,7 +322,6 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
     )
 
     user_id = db.Column(
@@ -197,7 +330,342 @@ class Message(db.Model):
         nullable=False,
     )
 
-    user = db.relationship('User')
+
+class Tag(db.Model):
+    """A hashtag, stored once; the index refers to it by id."""
+
+    __tablename__ = 'tags'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.String(140),
+        nullable=False,
+        unique=True,
+    )
+
+
+class MessageTag(db.Model):
+    """Inverted index entry: message `message_id` has tag `tag_id`.
+
+    The primary key is ordered for the tag feed: message ids are time
+    ordered, so descending is newest first. author_id lets purges and
+    feeds skip deleted users without reading messages.
+    There is no foreign key to messages, which may be archived or sharded.
+    """
+
+    __tablename__ = 'message_tags'
+    __table_args__ = (
+        db.Index('ix_message_tags_message_id', 'message_id'),
+        db.Index('ix_message_tags_author_id', 'author_id'),
+    )
+
+    tag_id = db.Column(
+        db.Integer,
+        db.ForeignKey('tags.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        MessageId,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class Mention(db.Model):
+    """Inverted index entry: message `message_id` mentions `user_id`."""
+
+    __tablename__ = 'mentions'
+    __table_args__ = (
+        db.Index('ix_mentions_message_id', 'message_id'),
+        db.Index('ix_mentions_author_id', 'author_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        MessageId,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class Notification(db.Model):
+    """An inbox entry: every `kind` event on one subject in one time
+    bucket, coalesced ("X and 41 others liked your warble").
+
+    See notifications.py.
+    """
+
+    __tablename__ = 'notifications'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'kind', 'subject_id', 'bucket'),
+        db.Index('ix_notifications_user_id_updated_at', 'user_id', 'updated_at', 'id'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    # 'follow', 'like' or 'mention'
+    kind = db.Column(
+        db.String(20),
+        nullable=False,
+    )
+
+    # The liked or mentioning message; 0 for follows.
+    subject_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+        default=0,
+    )
+
+    bucket = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # Most recent actors first, comma-separated, at most a few.
+    actor_ids = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class NotificationActor(db.Model):
+    """One actor counted in a notification's actor_count, so repeating an
+    action (unlike, then like again) doesn't count them twice."""
+
+    __tablename__ = 'notification_actors'
+
+    notification_id = db.Column(
+        db.Integer,
+        db.ForeignKey('notifications.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+
+class Inbox(db.Model):
+    """Per-user notification counters, so nothing needs a COUNT(*)."""
+
+    __tablename__ = 'inboxes'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    unread = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    total = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class Job(db.Model):
+    """A unit of background work in the durable job queue (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    idempotency_key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_by = db.Column(
+        db.Text,
+    )
+
+    locked_until = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.kind} {self.status}>"
+
+
+class MessageIdWorker(db.Model):
+    """A message id worker leased to one process (see message_ids.py)."""
+
+    __tablename__ = 'message_id_workers'
+
+    worker_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    locked_by = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    locked_until = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class Export(db.Model):
+    """A user's data export archive (see exports.py)."""
+
+    __tablename__ = 'exports'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+        index=True,
+    )
+
+    # 'csv' or 'ndjson'
+    format = db.Column(
+        db.String(10),
+        nullable=False,
+    )
+
+    # 'queued', 'running', 'done' or 'failed'
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='queued',
+    )
+
+    # Archive file name in EXPORT_DIR, once done.
+    filename = db.Column(
+        db.Text,
+    )
+
+    size = db.Column(
+        db.BigInteger,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    def __repr__(self):
+        return f"<Export #{self.id}: user #{self.user_id} {self.format} {self.status}>"
 
 
 def connect_db(app):
@@ -208,3 +676,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
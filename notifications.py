@@ -0,0 +1,229 @@
+"""Notifications inbox for Warbler.
+
+Follows, likes and mentions call `notify()` in the same transaction as the
+write. Events are coalesced when they're written, not when the inbox is
+read: all events of one kind on one subject (a liked message, or "you"
+for follows) within one time bucket (NOTIFICATION_BUCKET_SECONDS, default
+an hour) share a single `notifications` row. That row keeps a count and
+the few most recent actors, which is all "alice and 41 others liked your
+warble" needs. `notification_actors` records everyone counted, so an actor
+who repeats an action within the bucket is counted once.
+
+Each user's `inboxes` row holds their unread and total counts, kept up to
+date by `notify()` and `mark_all_read()`. The navbar badge is therefore a
+primary-key read, not a COUNT(*). Once the total passes
+NOTIFICATION_INBOX_CAP (default 200) by a small margin, the oldest entries
+are trimmed, so an inbox never grows without bound.
+
+The inbox page is keyset-paginated on (updated_at, id), newest first.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import current_app, g
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+
+from entity_cache import entity_cache
+from metrics import metrics
+from models import db, User, Follows, Notification, NotificationActor, Inbox
+
+DEFAULT_BUCKET_SECONDS = 3600
+DEFAULT_INBOX_CAP = 200
+TRIM_SLACK = 20
+RECENT_ACTORS = 10
+PAGE_SIZE = 20
+EPOCH = datetime(1970, 1, 1)
+
+VERBS = {
+    'follow': 'followed you',
+    'like': 'liked your warble',
+    'mention': 'mentioned you',
+}
+
+# A notification ready to show: its first (visible) actor and how many
+# others there were.
+InboxEntry = namedtuple('InboxEntry', 'notification actor others verb')
+
+
+def bucket_start(moment, seconds):
+    """Start of the `seconds`-long bucket that `moment` falls in."""
+
+    offset = int((moment - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=offset - offset % seconds)
+
+
+def _bump_inbox(user_id, unread=0, total=0):
+    inboxes = Inbox.__table__
+    update = (inboxes.update()
+              .where(inboxes.c.user_id == user_id)
+              .values(unread=inboxes.c.unread + unread, total=inboxes.c.total + total))
+    if db.session.execute(update).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(inboxes.insert().values(
+                user_id=user_id, unread=unread, total=total))
+    except IntegrityError:
+        db.session.execute(update)  # created concurrently
+
+
+def notify(user_id, kind, actor_id, subject_id=0):
+    """Record that `actor_id` did `kind` to user `user_id` (or to their
+    message `subject_id`); the caller commits."""
+
+    if user_id == actor_id:
+        return
+
+    now = datetime.utcnow()
+    bucket = bucket_start(now, current_app.config.get('NOTIFICATION_BUCKET_SECONDS',
+                                                      DEFAULT_BUCKET_SECONDS))
+    key = {'user_id': user_id, 'kind': kind, 'subject_id': subject_id,
+           'bucket': bucket}
+
+    note = Notification.query.filter_by(**key).with_for_update().first()
+    if note is None:
+        try:
+            with db.session.begin_nested():
+                note = Notification(actor_ids=str(actor_id), actor_count=1,
+                                    read=False, updated_at=now, **key)
+                db.session.add(note)
+                db.session.flush()
+                db.session.add(NotificationActor(notification_id=note.id,
+                                                 actor_id=actor_id))
+        except IntegrityError:
+            note = Notification.query.filter_by(**key).with_for_update().one()
+        else:
+            _bump_inbox(user_id, unread=1, total=1)
+            trim_inbox(user_id)
+            metrics.inc('notifications_total', kind=kind, result='created')
+            return
+
+    # The row lock above keeps this check and insert to one actor at a time
+    if NotificationActor.query.get((note.id, actor_id)):
+        # e.g. unlike + like again
+        return
+    db.session.add(NotificationActor(notification_id=note.id, actor_id=actor_id))
+    actors = [int(a) for a in note.actor_ids.split(',')]
+    note.actor_ids = ','.join(str(a) for a in [actor_id] + actors[:RECENT_ACTORS - 1])
+    note.actor_count += 1
+    note.updated_at = now
+    if note.read:
+        note.read = False
+        _bump_inbox(user_id, unread=1)
+    metrics.inc('notifications_total', kind=kind, result='coalesced')
+
+
+def follow_and_notify(follower_id, user_ids):
+    """Follows.follow_many, notifying each newly followed user (the caller
+    commits). Returns the number of follows added."""
+
+    before = Follows.followed_among(follower_id, user_ids)
+    added = Follows.follow_many(follower_id, user_ids)
+    if added:
+        for user_id in Follows.followed_among(follower_id, user_ids) - before:
+            notify(user_id, 'follow', follower_id)
+    return added
+
+
+def trim_inbox(user_id, force=False):
+    """Drop the oldest notifications beyond the cap, once the total is
+    TRIM_SLACK past it (or always, with `force`)."""
+
+    cap = current_app.config.get('NOTIFICATION_INBOX_CAP', DEFAULT_INBOX_CAP)
+    total = db.session.query(Inbox.total).filter_by(user_id=user_id).scalar() or 0
+    if total <= cap + (0 if force else TRIM_SLACK):
+        return 0
+
+    newest = (db.session.query(Notification.updated_at, Notification.id)
+              .filter(Notification.user_id == user_id)
+              .order_by(Notification.updated_at.desc(), Notification.id.desc()))
+    edge = newest.offset(cap - 1).first()
+    trimmed = 0
+    if edge:
+        trimmed = (Notification.query
+                   .filter(Notification.user_id == user_id,
+                           or_(Notification.updated_at < edge.updated_at,
+                               and_(Notification.updated_at == edge.updated_at,
+                                    Notification.id < edge.id)))
+                   .delete(synchronize_session=False))
+
+    # What's left is at most `cap` rows, so counting it is cheap.
+    remaining = Notification.query.filter_by(user_id=user_id)
+    (Inbox.query
+     .filter_by(user_id=user_id)
+     .update({'total': remaining.count(),
+              'unread': remaining.filter_by(read=False).count()},
+             synchronize_session=False))
+    metrics.inc('notifications_trimmed_total', trimmed)
+    return trimmed
+
+
+def unread_count(user_id):
+    """Unread notifications of `user_id`, from the inbox counter."""
+
+    return db.session.query(Inbox.unread).filter_by(user_id=user_id).scalar() or 0
+
+
+def mark_all_read(user_id):
+    """Mark `user_id`'s notifications read (the caller commits)."""
+
+    (Notification.query
+     .filter_by(user_id=user_id, read=False)
+     .update({'read': True}, synchronize_session=False))
+    (Inbox.query
+     .filter_by(user_id=user_id)
+     .update({'unread': 0}, synchronize_session=False))
+
+
+def inbox_page(user_id, cursor=None, limit=PAGE_SIZE):
+    """A page of `user_id`'s notifications, newest first.
+
+    Returns (InboxEntry list, cursor for the next page or None).
+    """
+
+    # api imports this module, for notify()
+    from api import encode_cursor, decode_cursor
+
+    query = Notification.query.filter(Notification.user_id == user_id)
+    position = decode_cursor(cursor)
+    if position:
+        try:
+            ts, note_id = datetime.fromisoformat(position[0]), int(position[1])
+        except (ValueError, TypeError, IndexError):
+            ts = None
+        if ts:
+            query = query.filter(or_(
+                Notification.updated_at < ts,
+                and_(Notification.updated_at == ts, Notification.id < note_id)))
+
+    notes = (query
+             .order_by(Notification.updated_at.desc(), Notification.id.desc())
+             .limit(limit + 1)
+             .all())
+    next_cursor = None
+    if len(notes) > limit:
+        notes = notes[:limit]
+        next_cursor = encode_cursor(notes[-1].updated_at, notes[-1].id)
+
+    actor_ids = {int(a) for note in notes for a in note.actor_ids.split(',')}
+    actors = {user_id: user
+              for user_id, user in entity_cache().get_many(User, actor_ids).items()
+              if user.deleted_at is None}
+
+    entries = []
+    for note in notes:
+        visible = [actors[int(a)] for a in note.actor_ids.split(',') if int(a) in actors]
+        if visible:
+            entries.append(InboxEntry(note, visible[0], note.actor_count - 1,
+                                      VERBS[note.kind]))
+    return entries, next_cursor
+
+
+def connect_notifications(app):
+    """Give templates the current user's unread count."""
+
+    @app.template_global()
+    def unread_notifications():
+        return unread_count(g.user.id) if g.get('user') else 0
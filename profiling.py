@@ -0,0 +1,362 @@
+"""On-demand sampling profiler for Warbler's views.
+
+While a profile is running, the requests it selects (a random fraction of
+all requests, and/or every request to chosen endpoints) register their
+thread, and a background thread reads those threads' Python stacks every
+PROFILER_INTERVAL_MS (default 5) via sys._current_frames(). Stacks are
+counted per endpoint; nothing is traced, so a profiled request runs at full
+speed except while a sample is taken.
+
+Sampling holds the GIL, so its cost is paid by the request threads. The
+sampler times itself and stretches its interval so that cost stays under
+PROFILER_MAX_OVERHEAD (default 0.01) of wall time; the measured ratio is
+the `profiler_overhead_ratio` gauge.
+
+Start and stop a profile with the admin route (it 404s unless
+PROFILER_TOKEN is set, and needs `Authorization: Bearer <token>`). Each
+worker process has its own profiler, so a request only starts, stops or
+reports the profile of the worker that happened to serve it; use the
+signal to reach a particular worker, or all of them.
+
+    curl -H 'Authorization: Bearer ...' -d endpoints=homepage,list_users \\
+         -d duration=60 https://.../admin/profiler          # start
+    curl -H 'Authorization: Bearer ...' https://.../admin/profiler        # status
+    curl -H 'Authorization: Bearer ...' -d action=stop https://.../admin/profiler
+
+or with `kill -USR2 <worker pid>`, which toggles a profile of
+PROFILER_SIGNAL_RATE (default 1.0) of requests for up to
+PROFILER_SIGNAL_SECONDS (default 60). The handler only sets a flag: the
+worker's next request starts the profile, or the sampler thread ends it.
+gunicorn resets SIGUSR2 in its workers after forking, so run it with
+`-c gunicorn.conf.py`, whose post_worker_init hook installs the handler
+again. When a profile ends, each worker writes to PROFILE_DIR (default
+profiles/):
+
+    <endpoint>-<pid>-<time>.collapsed      "frame;frame;frame count" lines,
+                                           for flamegraph.pl or speedscope
+    profile-<pid>-<time>.speedscope.json   every endpoint, for speedscope.app
+"""
+
+import hmac
+import json
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from flask import abort, current_app, g, request, jsonify
+
+from metrics import metrics
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PROFILE_DIR = os.path.join(ROOT, 'profiles')
+DEFAULT_INTERVAL = 0.005
+DEFAULT_MAX_OVERHEAD = 0.01
+DEFAULT_SIGNAL_RATE = 1.0
+DEFAULT_SIGNAL_SECONDS = 60
+MAX_DEPTH = 128
+
+SPEEDSCOPE_SCHEMA = 'https://www.speedscope.app/file-format-schema.json'
+
+
+def frame_label(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def fold(frame):
+    """The code objects on `frame`'s stack, outermost first."""
+
+    codes = []
+    while frame is not None and len(codes) < MAX_DEPTH:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    codes.reverse()
+    return tuple(codes)
+
+
+class SamplingProfiler:
+    """Samples the stacks of registered threads, counted per endpoint.
+
+    Request threads call `enter(endpoint)` and `leave()`; `start()` and
+    `stop()` run the sampler thread. `stacks[endpoint]` maps each stack
+    (a tuple of code objects) to [samples, seconds], where seconds is the
+    wall time those samples stand for.
+    """
+
+    def __init__(self, directory=DEFAULT_PROFILE_DIR, interval=DEFAULT_INTERVAL,
+                 max_overhead=DEFAULT_MAX_OVERHEAD, clock=time.perf_counter):
+        self.directory = directory
+        self.base_interval = interval
+        self.max_overhead = max_overhead
+        self.clock = clock
+        self.active = {}
+        self.stacks = defaultdict(dict)
+        self.rate = 0.0
+        self.endpoints = frozenset()
+        self.deadline = None
+        self.written = []
+        # Set by the signal handler; see `request_toggle`
+        self.toggle_requested = False
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.stacks = defaultdict(dict)
+        self.interval = self.base_interval
+        self.samples = 0
+        self.sample_seconds = 0.0
+        self.started_at = self.clock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, rate=0.0, endpoints=(), duration=None):
+        """Profile a fraction `rate` of requests plus all requests to
+        `endpoints`, for `duration` seconds (None: until `stop()`).
+        Returns False if a profile is already running."""
+
+        with self._lock:
+            if self.running:
+                return False
+            self.rate = rate
+            self.endpoints = frozenset(endpoints)
+            self.deadline = self.clock() + duration if duration else None
+            self._reset()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='profiler',
+                                            daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        """End the profile; returns the files it wrote."""
+
+        thread = self._thread
+        if thread is None:
+            return self.written
+        self._stop.set()
+        if thread is not threading.current_thread():
+            thread.join()
+        return self.written
+
+    def request_toggle(self):
+        """Ask for the profile to be stopped (by the sampler thread) or
+        started (by the next request). Safe in a signal handler: it only
+        sets a flag."""
+
+        self.toggle_requested = True
+
+    def wants(self, endpoint):
+        """Should a request to `endpoint` be profiled?"""
+
+        return self.running and (endpoint in self.endpoints
+                                 or (self.rate > 0 and random.random() < self.rate))
+
+    def enter(self, endpoint):
+        self.active[threading.get_ident()] = endpoint
+
+    def leave(self):
+        self.active.pop(threading.get_ident(), None)
+
+    def _run(self):
+        last = self.clock()
+        while not self._stop.wait(self.interval):
+            now = self.clock()
+            if self.deadline and now >= self.deadline:
+                break
+            if self.toggle_requested:
+                self.toggle_requested = False
+                break
+            self.sample(now - last)
+            cost = self.clock() - now
+            self.sample_seconds += cost
+            # Stretch the interval until sampling fits the overhead budget
+            self.interval = max(self.base_interval, cost / self.max_overhead)
+            last = now
+
+        self.active.clear()
+        self.written = self.write()
+        self._thread = None
+        self.report()
+
+    def sample(self, elapsed):
+        """Count the current stack of every registered thread."""
+
+        frames = sys._current_frames()
+        for thread_id, endpoint in tuple(self.active.items()):
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            stack = fold(frame)
+            counts = self.stacks[endpoint].setdefault(stack, [0, 0.0])
+            counts[0] += 1
+            counts[1] += elapsed
+            self.samples += 1
+        self.report()
+
+    def overhead(self):
+        """Fraction of wall time spent sampling, since the profile started."""
+
+        elapsed = self.clock() - self.started_at
+        return self.sample_seconds / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        metrics.set('profiler_running', int(self.running))
+        metrics.set('profiler_samples', self.samples)
+        metrics.set('profiler_overhead_ratio', self.overhead())
+
+    def status(self):
+        return {
+            'running': self.running,
+            'rate': self.rate,
+            'endpoints': sorted(self.endpoints),
+            'samples': {endpoint: sum(c[0] for c in stacks.values())
+                        for endpoint, stacks in self.stacks.items()},
+            'interval_ms': self.interval * 1000,
+            'overhead': self.overhead(),
+            'written': self.written,
+        }
+
+    ##########################################################################
+    # Output
+
+    def write(self):
+        """Write collapsed stacks per endpoint and one speedscope file;
+        returns their paths (none if nothing was sampled)."""
+
+        if not self.stacks:
+            return []
+        os.makedirs(self.directory, exist_ok=True)
+        suffix = f'{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}'
+        paths = []
+        for endpoint, stacks in sorted(self.stacks.items()):
+            path = os.path.join(self.directory, f'{endpoint}-{suffix}.collapsed')
+            with open(path, 'w') as f:
+                write_collapsed(f, stacks)
+            paths.append(path)
+
+        path = os.path.join(self.directory, f'profile-{suffix}.speedscope.json')
+        with open(path, 'w') as f:
+            json.dump(speedscope(self.stacks, f'warbler {suffix}'), f)
+        paths.append(path)
+        return paths
+
+
+def write_collapsed(out, stacks):
+    """Brendan Gregg's folded format: one "a;b;c <samples>" line per stack."""
+
+    for stack, (samples, _) in sorted(stacks.items(), key=lambda item: -item[1][0]):
+        out.write(';'.join(frame_label(code) for code in stack))
+        out.write(f' {samples}\n')
+
+
+def speedscope(stacks_by_endpoint, name):
+    """A speedscope "sampled" profile per endpoint, weighted in ms."""
+
+    frames, index = [], {}
+
+    def frame_id(code):
+        if code not in index:
+            index[code] = len(frames)
+            frames.append({'name': code.co_name, 'file': code.co_filename,
+                           'line': code.co_firstlineno})
+        return index[code]
+
+    profiles = []
+    for endpoint, stacks in sorted(stacks_by_endpoint.items()):
+        samples = [[frame_id(code) for code in stack] for stack in stacks]
+        weights = [round(seconds * 1000, 3) for _, seconds in stacks.values()]
+        profiles.append({'type': 'sampled', 'name': endpoint, 'unit': 'milliseconds',
+                         'startValue': 0, 'endValue': sum(weights),
+                         'samples': samples, 'weights': weights})
+
+    return {'$schema': SPEEDSCOPE_SCHEMA, 'name': name, 'exporter': 'warbler',
+            'shared': {'frames': frames}, 'profiles': profiles}
+
+
+##############################################################################
+# Flask wiring
+
+
+def _authorized():
+    token = current_app.config.get('PROFILER_TOKEN')
+    return bool(token) and hmac.compare_digest(
+        request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode())
+
+
+def admin_profiler():
+    """GET: status. POST: start (rate, endpoints, duration) or action=stop.
+
+    Only this worker's profiler: other workers aren't affected.
+    """
+
+    if not _authorized():
+        abort(404)
+
+    profiler = current_app.extensions['profiler']
+    if request.method == 'POST':
+        form = request.get_json(silent=True) or request.form
+        if form.get('action') == 'stop':
+            return jsonify(written=profiler.stop())
+
+        endpoints = form.get('endpoints') or ()
+        if isinstance(endpoints, str):
+            endpoints = [e for e in endpoints.split(',') if e]
+        try:
+            rate = float(form.get('rate', 0 if endpoints else 0.01))
+            duration = float(form['duration']) if form.get('duration') else None
+        except ValueError:
+            return jsonify(error="rate and duration must be numbers."), 400
+        if not 0 <= rate <= 1:
+            return jsonify(error="rate must be between 0 and 1."), 400
+        if not profiler.start(rate, endpoints, duration):
+            return jsonify(error="A profile is already running."), 409
+
+    return jsonify(profiler.status())
+
+
+def install_signal_toggle(app):
+    """Make SIGUSR2 toggle `app`'s profile in this process. Call it from
+    the main thread, after any server has set up its own signals (see
+    gunicorn.conf.py)."""
+
+    if hasattr(signal, 'SIGUSR2') and threading.current_thread() is threading.main_thread():
+        profiler = app.extensions['profiler']
+        signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.request_toggle())
+
+
+def connect_profiler(app):
+    """Give `app` a SamplingProfiler, its request hooks, the admin route
+    and the SIGUSR2 toggle."""
+
+    profiler = SamplingProfiler(
+        directory=app.config.get('PROFILE_DIR') or DEFAULT_PROFILE_DIR,
+        interval=app.config.get('PROFILER_INTERVAL_MS', DEFAULT_INTERVAL * 1000) / 1000,
+        max_overhead=app.config.get('PROFILER_MAX_OVERHEAD', DEFAULT_MAX_OVERHEAD))
+    app.extensions['profiler'] = profiler
+
+    @app.before_request
+    def start_profiling():
+        if profiler.toggle_requested and not profiler.running:
+            profiler.toggle_requested = False
+            profiler.start(
+                app.config.get('PROFILER_SIGNAL_RATE', DEFAULT_SIGNAL_RATE),
+                duration=app.config.get('PROFILER_SIGNAL_SECONDS', DEFAULT_SIGNAL_SECONDS))
+        if profiler.wants(request.endpoint):
+            profiler.enter(request.endpoint)
+            g.profiled = True
+
+    @app.teardown_request
+    def stop_profiling(exc):
+        if g.pop('profiled', False):
+            profiler.leave()
+
+    app.add_url_rule('/admin/profiler', 'admin_profiler', admin_profiler,
+                     methods=['GET', 'POST'])
+    install_signal_toggle(app)
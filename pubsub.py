@@ -0,0 +1,96 @@
+"""Publish/subscribe bus for Warbler events.
+
+Views publish small JSON-able events (e.g. a new message) to a topic;
+subscribers such as the SSE stream app receive them. `InMemoryBus` delivers
+within one process and doubles as the test stand-in; `RedisBus` fans events
+out across processes through Redis PUBLISH/SUBSCRIBE. `make_bus` picks one
+from a URL, so swapping brokers is a config change (PUBSUB_URL).
+"""
+
+import json
+import threading
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Payload: {'id', 'text', 'timestamp', 'user': {'id', 'username', 'image_url'}}
+MESSAGES_TOPIC = 'messages'
+
+
+class InMemoryBus:
+    """Thread-safe in-process bus. Callbacks run in the publisher's thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, topic, callback):
+        """Call `callback(event)` for every event on `topic`.
+
+        Returns a function that removes the subscription.
+        """
+
+        with self._lock:
+            self._subscribers.setdefault(topic, []).append(callback)
+
+        def unsubscribe():
+            with self._lock:
+                callbacks = self._subscribers.get(topic, [])
+                if callback in callbacks:
+                    callbacks.remove(callback)
+
+        return unsubscribe
+
+    def publish(self, topic, event):
+        with self._lock:
+            callbacks = list(self._subscribers.get(topic, ()))
+        for callback in callbacks:
+            callback(event)
+
+
+class RedisBus(InMemoryBus):
+    """Bus shared between processes via Redis pub/sub.
+
+    Events are JSON-encoded on publish; a daemon thread per bus listens on
+    subscribed topics and hands decoded events to local callbacks.
+    """
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("RedisBus requires the 'redis' package.")
+        super().__init__()
+        self._client = redis.Redis.from_url(url)
+        self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        self._listener = None
+
+    def subscribe(self, topic, callback):
+        unsubscribe = super().subscribe(topic, callback)
+        self._pubsub.subscribe(**{topic: self._deliver})
+        if self._listener is None:
+            self._listener = self._pubsub.run_in_thread(sleep_time=1, daemon=True)
+        return unsubscribe
+
+    def _deliver(self, message):
+        topic = message['channel']
+        if isinstance(topic, bytes):
+            topic = topic.decode('utf-8')
+        super().publish(topic, json.loads(message['data']))
+
+    def publish(self, topic, event):
+        self._client.publish(topic, json.dumps(event))
+
+
+def make_bus(url=None):
+    """Bus for `url`: redis://... for RedisBus, anything else in-memory."""
+
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBus(url)
+    return InMemoryBus()
+
+
+def connect_pubsub(app):
+    """Attach a bus built from PUBSUB_URL to `app.extensions['bus']`."""
+
+    app.extensions['bus'] = make_bus(app.config.get('PUBSUB_URL'))
@@ -1,10 +1,18 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from datetime import datetime
 
+from app import app, db
+from message_ids import lowest_id
+from models import User, Follows
+from sharding import shard_metadata
 
+
+shards = app.extensions['message_shards']
+for engine in shards.engines:
+    shard_metadata.drop_all(bind=engine)
+shards.create_schema()
 db.drop_all()
 db.create_all()
 
@@ -12,7 +20,15 @@ with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    rows = list(DictReader(messages))
+    # Ids are time-ordered (see message_ids.py): derive them from the sample
+    # timestamps rather than the time of seeding.
+    for i, row in enumerate(rows):
+        row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+        row['id'] = lowest_id(row['timestamp']) + i % 4096
+        row['user_id'] = int(row['user_id'])
+    # Each on its author's shard (the messages table when unsharded)
+    shards.insert_many(rows)
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
@@ -0,0 +1,565 @@
+"""Message storage: a shard router with a hot/cold archive.
+
+Every message read and write (the pages, the JSON API, likes, account
+purge and seeding) goes through `MessageShards` instead of querying the
+`messages` table directly.
+
+With no MESSAGE_SHARD_URIS configured there is one shard: the app's own
+`messages` table, reached through `db.session` so reads and writes join the
+request's transaction (and its replica routing) exactly as before.
+
+With shard URIs configured, messages live in one database per shard,
+chosen by a hash of the author's user_id, so a user's messages are always
+together and a profile is a single-shard query. On Postgres each shard's
+`messages` table is natively range-partitioned by month on `timestamp`
+(`flask shards-init` creates it and `flask shards-add-partitions` adds
+months ahead); SQLite files can stand in for shards in tests. Message ids
+are time-ordered Snowflake ids (see message_ids.py), unique across shards
+without coordination, so every read orders and merges by id alone. An id
+doesn't say which shard holds it; lookups by id ask all shards at once.
+The home feed queries each followed user's shard in parallel and k-way
+merges the per-shard sorted results with a heap.
+
+With ARCHIVE_AFTER_DAYS set, `flask archive-messages` (run it from cron)
+moves messages older than that into `messages_archive` on the same shard,
+keeping the hot table and its indexes small. Reads fall through to the
+archive only when a page reaches past the horizon, so profiles, feeds and
+`get` by id see archived messages without the common case paying for it.
+
+The `likes.message_id` foreign key cannot span databases, so with shards
+configured it is dropped right after `likes` is created, and by `flask
+shards-init` from an existing primary; `delete_many` deletes a message's
+likes itself. SQLite doesn't enforce foreign keys unless asked to, so this
+only matters on Postgres.
+"""
+
+import heapq
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+from itertools import islice
+
+import click
+from flask import current_app
+from sqlalchemy import (MetaData, Table, Column, String, Integer, DateTime, Index,
+                        create_engine, select, func, text, exists, event, DDL)
+from sqlalchemy.exc import IntegrityError
+
+from db_pool import engine_options
+from db_routing import primary_reads
+from entity_cache import entity_cache
+from message_ids import next_message_id, timestamp_of
+from metrics import metrics
+from models import db, User, Message, MessageArchive, MessageId, Likes, LIKES_MESSAGE_FK
+
+# Shard-side schema: same columns as Message, but no foreign key, since
+# users live in the primary database.
+shard_metadata = MetaData()
+
+
+def _shard_table(name):
+    return Table(
+        name, shard_metadata,
+        Column('id', MessageId, primary_key=True, autoincrement=False),
+        Column('text', String(140), nullable=False),
+        Column('timestamp', DateTime, nullable=False),
+        Column('user_id', Integer, nullable=False),
+        Index(f'ix_{name}_user_id_id', 'user_id', 'id'),
+    )
+
+
+shard_messages = _shard_table('messages')
+shard_messages_archive = _shard_table('messages_archive')
+
+drop_likes_message_fk = DDL(
+    f"ALTER TABLE likes DROP CONSTRAINT IF EXISTS {LIKES_MESSAGE_FK}")
+
+
+def _messages_sharded(ddl, target, bind, **kw):
+    shards = db.get_app().extensions.get('message_shards')
+    return shards is not None and shards.sharded
+
+
+event.listen(Likes.__table__, 'after_create',
+             drop_likes_message_fk.execute_if(dialect='postgresql',
+                                              callable_=_messages_sharded))
+
+MessageRow = namedtuple('MessageRow', 'id text timestamp user_id')
+
+# Attempts at inserting a message before giving up on fresh ids.
+ID_ATTEMPTS = 3
+
+
+class ShardedMessage(namedtuple('ShardedMessage', 'id text timestamp user_id user')):
+    """A message row with its author (a UserSnapshot) attached for templates."""
+
+    __slots__ = ()
+
+
+def _sort_key(row):
+    return row.id
+
+
+def _month_start(day, offset=0):
+    month = day.month - 1 + offset
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+class MessageShards:
+    """Routes message reads and writes to the shard owning each author."""
+
+    def __init__(self, engines=None, archive_after=None):
+        self.engines = list(engines or [])
+        self.sharded = bool(self.engines)
+        self.archive_after = archive_after
+        if self.sharded:
+            self.table, self.archive_table = shard_messages, shard_messages_archive
+        else:
+            self.table, self.archive_table = Message.__table__, MessageArchive.__table__
+        self._executor = (ThreadPoolExecutor(max_workers=len(self.engines))
+                          if len(self.engines) > 1 else None)
+
+    @property
+    def count(self):
+        return len(self.engines) or 1
+
+    def shard_index(self, user_id):
+        """Shard owning `user_id` (Knuth multiplicative hash)."""
+
+        return ((user_id * 2654435761) & 0xffffffff) % self.count
+
+    def execute(self, index, query):
+        """Run `query` on shard `index` and return its rows.
+
+        Unsharded, this goes through db.session so it joins the request's
+        transaction and replica routing.
+        """
+
+        if not self.sharded:
+            return db.session.execute(query).fetchall()
+        with self.engines[index].connect() as conn:
+            return conn.execute(query).fetchall()
+
+    def stream(self, index, query, batch_size=1000):
+        """Rows of `query` on shard `index`, read `batch_size` at a time
+        through a server-side cursor, so memory use doesn't grow with the
+        result."""
+
+        if not self.sharded:
+            result = db.session.execute(query.execution_options(stream_results=True))
+            yield from fetch_in_batches(result, batch_size)
+            return
+        with self.engines[index].connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(query)
+            yield from fetch_in_batches(result, batch_size)
+
+    def _rows(self, index, query):
+        return [MessageRow(*row) for row in self.execute(index, query)]
+
+    def _columns(self, table):
+        return [table.c.id, table.c.text, table.c.timestamp, table.c.user_id]
+
+    def _tables(self):
+        """Hot table, then the archive if archive reads are enabled."""
+
+        return [self.table] + ([self.archive_table] if self.archive_after else [])
+
+    def cutoff(self):
+        """Messages older than this may be in the archive (None: no archive)."""
+
+        return datetime.utcnow() - self.archive_after if self.archive_after else None
+
+    def _newest(self, index, condition, limit, before=None):
+        """Newest `limit` rows on shard `index` matching `condition(table)`,
+        with ids below `before` if given.
+
+        The archive is only read when the hot rows run out or reach past
+        the archive horizon.
+        """
+
+        def query(table):
+            query = (select(self._columns(table))
+                     .where(condition(table))
+                     .order_by(table.c.id.desc())
+                     .limit(limit))
+            return query if before is None else query.where(table.c.id < before)
+
+        rows = self._rows(index, query(self.table))
+        cutoff = self.cutoff()
+        if cutoff and (len(rows) < limit or rows[-1].timestamp < cutoff):
+            archived = self._rows(index, query(self.archive_table))
+            rows = list(islice(heapq.merge(rows, archived, key=_sort_key, reverse=True),
+                               limit))
+        return rows
+
+    ##########################################################################
+    # Writes
+
+    def _insert(self, index, values):
+        if not self.sharded:
+            with db.session.begin_nested():
+                db.session.execute(self.table.insert().values(**values))
+        else:
+            with self.engines[index].begin() as conn:
+                conn.execute(self.table.insert().values(**values))
+
+    def add(self, user_id, text):
+        """Store a new message by `user_id`; returns its MessageRow."""
+
+        index = self.shard_index(user_id)
+        for attempt in range(ID_ATTEMPTS):
+            message_id = next_message_id()
+            row = MessageRow(message_id, text, timestamp_of(message_id), user_id)
+            try:
+                self._insert(index, row._asdict())
+                return row
+            except IntegrityError:
+                # Two processes were given the same MESSAGE_ID_WORKER
+                metrics.inc('message_id_collisions_total')
+                if attempt == ID_ATTEMPTS - 1:
+                    raise
+
+    def insert_many(self, rows):
+        """Bulk-load message dicts (id, text, timestamp, user_id), each on
+        its author's shard; for seeding."""
+
+        by_shard = defaultdict(list)
+        for row in rows:
+            by_shard[self.shard_index(row['user_id'])].append(row)
+        for index, shard_rows in by_shard.items():
+            if not self.sharded:
+                db.session.execute(self.table.insert(), shard_rows)
+            else:
+                with self.engines[index].begin() as conn:
+                    conn.execute(self.table.insert(), shard_rows)
+
+    def delete(self, message_id, user_id):
+        """Delete message `message_id` if `user_id` wrote it (hot or archived)."""
+
+        return self.delete_many([message_id], user_id)
+
+    def delete_many(self, message_ids, user_id):
+        """Delete those of `message_ids` that `user_id` wrote (hot or
+        archived) and their likes; returns how many messages went.
+
+        The likes are deleted in db.session, for the caller to commit.
+        """
+
+        def run(execute):
+            deleted = []
+            for table in (self.table, self.archive_table):
+                ids = [row_id for (row_id,) in execute(
+                    select([table.c.id]).where(table.c.id.in_(message_ids)
+                                               & (table.c.user_id == user_id)))]
+                if ids:
+                    execute(table.delete().where(table.c.id.in_(ids)))
+                    deleted += ids
+            return deleted
+
+        if not self.sharded:
+            deleted = run(db.session.execute)
+        else:
+            with self.engines[self.shard_index(user_id)].begin() as conn:
+                deleted = run(conn.execute)
+        if deleted:
+            (Likes.query.filter(Likes.message_id.in_(deleted))
+             .delete(synchronize_session=False))
+        return len(deleted)
+
+    def archive(self, cutoff, batch_size=1000):
+        """Move messages older than `cutoff` to the archive, oldest first.
+
+        One transaction per batch of `batch_size`. Unsharded, liked messages
+        stay hot, since likes.message_id cascades on delete from `messages`.
+        Returns the number of messages moved.
+        """
+
+        hot, cold = self.table, self.archive_table
+        oldest = (select([hot.c.id])
+                  .where(hot.c.timestamp < cutoff)
+                  .order_by(hot.c.id)
+                  .limit(batch_size))
+        if not self.sharded:
+            oldest = oldest.where(~exists().where(Likes.message_id == hot.c.id))
+
+        def move(conn):
+            ids = [row_id for (row_id,) in conn.execute(oldest)]
+            if ids:
+                conn.execute(cold.insert().from_select(
+                    [c.name for c in self._columns(cold)],
+                    select(self._columns(hot)).where(hot.c.id.in_(ids))))
+                conn.execute(hot.delete().where(hot.c.id.in_(ids)))
+            return len(ids)
+
+        moved = 0
+        for engine in self.engines or [None]:
+            while True:
+                if engine is None:
+                    count = move(db.session.connection())
+                    db.session.commit()
+                else:
+                    with engine.begin() as conn:
+                        count = move(conn)
+                moved += count
+                metrics.inc('messages_archived_total', count)
+                if count < batch_size:
+                    break
+        return moved
+
+    ##########################################################################
+    # Reads
+
+    def get(self, message_id):
+        """MessageRow for `message_id`, or None."""
+
+        return self.get_many([message_id]).get(message_id)
+
+    def _get_on(self, index, message_ids):
+        found = {}
+        for table in self._tables():
+            missing = [i for i in message_ids if i not in found]
+            if not missing:
+                break
+            query = select(self._columns(table)).where(table.c.id.in_(missing))
+            found.update((row.id, row) for row in self._rows(index, query))
+        return found
+
+    def get_many(self, message_ids):
+        """{id: MessageRow} for each of `message_ids` that exists.
+
+        One IN query per shard (and table), the shards in parallel, rather
+        than one `get` per id.
+        """
+
+        message_ids = list(set(message_ids))
+        if not message_ids:
+            return {}
+
+        def on_shard(index):
+            return self._get_on(index, message_ids)
+
+        if self._executor:
+            per_shard = list(self._executor.map(on_shard, range(self.count)))
+        else:
+            per_shard = [on_shard(index) for index in range(self.count)]
+        found = {}
+        for rows in per_shard:
+            found.update(rows)
+        return found
+
+    def id_ranges(self, index, table, size):
+        """Split `table` on shard `index` into [start, end) id ranges of
+        about `size` rows each, oldest first."""
+
+        ranges = []
+        start = self.execute(index, select([func.min(table.c.id)]))[0][0]
+        while start is not None:
+            end = self.execute(index, select([table.c.id])
+                               .where(table.c.id >= start)
+                               .order_by(table.c.id)
+                               .offset(size)
+                               .limit(1))
+            if not end:
+                last = self.execute(index, select([func.max(table.c.id)]))[0][0]
+                ranges.append((start, last + 1))
+                break
+            ranges.append((start, end[0][0]))
+            start = end[0][0]
+        return ranges
+
+    def scan(self, index, table, start_id, end_id):
+        """Rows of `table` on shard `index` with start_id <= id < end_id."""
+
+        return self._rows(index, select(self._columns(table))
+                          .where((table.c.id >= start_id) & (table.c.id < end_id))
+                          .order_by(table.c.id))
+
+    def for_user(self, user_id, limit=100, before=None):
+        """Newest `limit` messages by `user_id` (one shard), with ids below
+        `before` if given."""
+
+        return self._newest(self.shard_index(user_id),
+                            lambda table: table.c.user_id == user_id, limit, before)
+
+    def feed(self, user_ids, limit=100, before=None):
+        """Newest `limit` messages by any of `user_ids`, across shards, with
+        ids below `before` if given."""
+
+        by_shard = defaultdict(list)
+        for user_id in user_ids:
+            by_shard[self.shard_index(user_id)].append(user_id)
+
+        def shard_feed(item):
+            index, ids = item
+            return self._newest(index, lambda table: table.c.user_id.in_(ids),
+                                limit, before)
+
+        if self._executor and len(by_shard) > 1:
+            per_shard = list(self._executor.map(shard_feed, by_shard.items()))
+        else:
+            per_shard = [shard_feed(item) for item in by_shard.items()]
+
+        merged = heapq.merge(*per_shard, key=_sort_key, reverse=True)
+        return list(islice(merged, limit))
+
+    def stream_for_user(self, user_id, batch_size=1000):
+        """Every message by `user_id`, hot then archived, oldest first
+        within each; see `stream`."""
+
+        index = self.shard_index(user_id)
+        for table in (self.table, self.archive_table):
+            query = (select(self._columns(table))
+                     .where(table.c.user_id == user_id)
+                     .order_by(table.c.id))
+            for row in self.stream(index, query, batch_size):
+                yield MessageRow(*row)
+
+    def ids_for_user(self, user_id, limit):
+        """Up to `limit` ids of messages by `user_id`, hot then archived."""
+
+        index = self.shard_index(user_id)
+        ids = []
+        for table in (self.table, self.archive_table):
+            if len(ids) >= limit:
+                break
+            ids += [row_id for (row_id,) in self.execute(
+                index, select([table.c.id])
+                .where(table.c.user_id == user_id)
+                .limit(limit - len(ids)))]
+        return ids
+
+    def count_for_user(self, user_id):
+        index = self.shard_index(user_id)
+        return sum(
+            self.execute(index, select([func.count()])
+                         .select_from(table)
+                         .where(table.c.user_id == user_id))[0][0]
+            for table in self._tables())
+
+    ##########################################################################
+    # Schema
+
+    def create_schema(self, months_ahead=3):
+        """Create each shard's messages table (partitioned on Postgres)."""
+
+        for engine in self.engines:
+            if engine.dialect.name == 'postgresql':
+                with engine.begin() as conn:
+                    conn.execute(text(
+                        "CREATE TABLE IF NOT EXISTS messages ("
+                        " id BIGINT NOT NULL,"
+                        " text VARCHAR(140) NOT NULL,"
+                        " timestamp TIMESTAMP NOT NULL,"
+                        " user_id INTEGER NOT NULL,"
+                        " PRIMARY KEY (id, timestamp)"
+                        ") PARTITION BY RANGE (timestamp)"))
+                    conn.execute(text(
+                        "CREATE INDEX IF NOT EXISTS ix_messages_user_id_id"
+                        " ON messages (user_id, id DESC)"))
+                    conn.execute(text(
+                        "CREATE TABLE IF NOT EXISTS messages_default"
+                        " PARTITION OF messages DEFAULT"))
+                shard_messages_archive.create(bind=engine, checkfirst=True)
+                self.add_partitions(engine, months_ahead)
+            else:
+                shard_metadata.create_all(bind=engine)
+
+    def add_partitions(self, engine, months_ahead=3, today=None):
+        """Create monthly partitions from this month to `months_ahead`."""
+
+        today = today or date.today()
+        with engine.begin() as conn:
+            for offset in range(months_ahead + 1):
+                start = _month_start(today, offset)
+                end = _month_start(today, offset + 1)
+                conn.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS messages_{start:%Y_%m}"
+                    f" PARTITION OF messages"
+                    f" FOR VALUES FROM ('{start}') TO ('{end}')"))
+
+
+def fetch_in_batches(result, batch_size):
+    """Yield the rows of `result`, fetching `batch_size` at a time."""
+
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def hydrate(rows):
+    """Attach each row's author: a UserSnapshot from the entity cache (one
+    IN query for those it doesn't have)."""
+
+    users = entity_cache().get_many(User, {row.user_id for row in rows})
+    return [ShardedMessage(*row, users.get(row.user_id))
+            for row in rows if row.user_id in users]
+
+
+def messages_tag(user_id):
+    """Cache tag for anything derived from `user_id`'s messages."""
+
+    return f'messages:{user_id}'
+
+
+def message_shards():
+    """The current app's MessageShards."""
+
+    return current_app.extensions['message_shards']
+
+
+def connect_shards(app):
+    """Build the shard router from MESSAGE_SHARD_URIS and ARCHIVE_AFTER_DAYS,
+    plus its CLI commands and template helper."""
+
+    uris = app.config.get('MESSAGE_SHARD_URIS') or []
+    archive_days = app.config.get('ARCHIVE_AFTER_DAYS')
+    shards = MessageShards(
+        [create_engine(uri, **engine_options(uri, app.config, f'shard{i}'))
+         for i, uri in enumerate(uris)],
+        archive_after=timedelta(days=archive_days) if archive_days else None)
+    app.extensions['message_shards'] = shards
+
+    @app.template_global()
+    def message_count(user):
+        """Number of messages by `user`, counted on its shard (cached)."""
+
+        cache = app.extensions.get('cache')
+        if cache is None:
+            return shards.count_for_user(user.id)
+        with primary_reads(db.session):
+            return cache.get_or_set(f'messages:count:{user.id}',
+                                    lambda: shards.count_for_user(user.id),
+                                    tags=[messages_tag(user.id)])
+
+    @app.cli.command('shards-init')
+    @click.option('--months-ahead', default=3)
+    def shards_init_command(months_ahead):
+        """Create the messages table on every shard."""
+
+        shards.create_schema(months_ahead)
+        if shards.sharded and db.engine.dialect.name == 'postgresql':
+            with db.engine.begin() as conn:
+                conn.execute(drop_likes_message_fk)
+        print(f"Initialized {len(shards.engines)} message shards.")
+
+    @app.cli.command('shards-add-partitions')
+    @click.option('--months-ahead', default=3)
+    def shards_add_partitions_command(months_ahead):
+        """Add upcoming monthly partitions on Postgres shards."""
+
+        for engine in shards.engines:
+            if engine.dialect.name == 'postgresql':
+                shards.add_partitions(engine, months_ahead)
+
+    @app.cli.command('archive-messages')
+    @click.option('--batch-size', default=1000)
+    def archive_messages_command(batch_size):
+        """Move messages older than ARCHIVE_AFTER_DAYS to the archive."""
+
+        if not shards.archive_after:
+            print("ARCHIVE_AFTER_DAYS is not set; nothing to do.")
+            return
+        moved = shards.archive(shards.cutoff(), batch_size)
+        print(f"Archived {moved} messages.")
@@ -0,0 +1,253 @@
+"""Server-sent events for live timeline updates.
+
+`TimelineStreamApp` is a small ASGI app, run next to the Flask app:
+
+    uvicorn --factory stream:create_stream_app --port 5001
+
+A logged-in browser opens GET /stream/timeline (the Flask session cookie
+identifies the user) and receives an SSE `message` event for every new
+warble by someone they follow, or by themselves. Events arrive from the
+pub/sub bus, published by the job worker that handles `messages_add()`'s
+fan-out job; with the in-memory bus that only works when both share a
+process, so point PUBSUB_URL at Redis when they don't.
+
+Every connection is a coroutine with a bounded queue. A reader that falls
+more than `buffer_size` events behind has its queue emptied and gets a
+`resync` event instead, telling the client to refetch the timeline, so slow
+clients cost bounded memory and never hold up the fan-out. Follows made
+after connecting take effect on reconnect.
+"""
+
+import asyncio
+import json
+from collections import defaultdict
+from http.cookies import SimpleCookie
+
+from itsdangerous import BadSignature
+
+from metrics import metrics
+from pubsub import MESSAGES_TOPIC
+
+STREAM_PATH = '/stream/timeline'
+DEFAULT_BUFFER_SIZE = 16
+DEFAULT_HEARTBEAT = 15
+
+RESYNC = object()
+CLOSED = object()
+
+
+def format_event(event):
+    """Encode one bus event as an SSE frame."""
+
+    data = json.dumps(event, separators=(',', ':'))
+    return f"id: {event['id']}\nevent: message\ndata: {data}\n\n".encode('utf-8')
+
+
+class Connection:
+    """One subscriber: the authors it wants and its bounded event buffer."""
+
+    __slots__ = ('author_ids', 'queue')
+
+    def __init__(self, author_ids, buffer_size):
+        self.author_ids = author_ids
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+
+    def offer(self, item):
+        """Buffer `item`; on overflow replace the backlog with RESYNC."""
+
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+            return False
+
+    def close(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(CLOSED)
+
+
+class TimelineHub:
+    """Index of open connections by the author ids they follow."""
+
+    def __init__(self):
+        self.by_author = defaultdict(set)
+        self.connections = set()
+
+    def add(self, conn):
+        self.connections.add(conn)
+        for author_id in conn.author_ids:
+            self.by_author[author_id].add(conn)
+        metrics.set('sse_connections', len(self.connections))
+
+    def remove(self, conn):
+        self.connections.discard(conn)
+        for author_id in conn.author_ids:
+            followers = self.by_author.get(author_id)
+            if followers is not None:
+                followers.discard(conn)
+                if not followers:
+                    del self.by_author[author_id]
+        metrics.set('sse_connections', len(self.connections))
+
+    def dispatch(self, event):
+        """Offer `event` to every connection following its author."""
+
+        for conn in tuple(self.by_author.get(event['user']['id'], ())):
+            if conn.offer(event):
+                metrics.inc('sse_events_queued_total')
+            else:
+                metrics.inc('sse_events_dropped_total')
+
+
+class TimelineStreamApp:
+    """ASGI app serving STREAM_PATH.
+
+    `authenticate(scope)` returns the user id for a request (or None) and
+    `load_following(user_id)` returns the ids that user follows; it is a
+    blocking call and runs in the default executor.
+    """
+
+    def __init__(self, bus, authenticate, load_following,
+                 buffer_size=DEFAULT_BUFFER_SIZE, heartbeat=DEFAULT_HEARTBEAT):
+        self.bus = bus
+        self.authenticate = authenticate
+        self.load_following = load_following
+        self.buffer_size = buffer_size
+        self.heartbeat = heartbeat
+        self.hub = TimelineHub()
+        self._unsubscribe = None
+
+    def subscribe(self, loop):
+        """Forward bus events (from any thread) into this loop's hub."""
+
+        if self._unsubscribe is None:
+            self._unsubscribe = self.bus.subscribe(
+                MESSAGES_TOPIC,
+                lambda event: loop.call_soon_threadsafe(self.hub.dispatch, event))
+
+    def shutdown(self):
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        for conn in tuple(self.hub.connections):
+            conn.close()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.subscribe(asyncio.get_running_loop())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def respond(self, send, status, body):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def handle(self, scope, receive, send):
+        if scope['path'] != STREAM_PATH or scope['method'] != 'GET':
+            await self.respond(send, 404, b'Not Found')
+            return
+
+        user_id = self.authenticate(scope)
+        if user_id is None:
+            await self.respond(send, 401, b'Authentication required.')
+            return
+
+        loop = asyncio.get_running_loop()
+        self.subscribe(loop)
+        following = await loop.run_in_executor(None, self.load_following, user_id)
+
+        conn = Connection(frozenset(following) | {user_id}, self.buffer_size)
+        self.hub.add(conn)
+        watcher = asyncio.ensure_future(self.watch_disconnect(receive, conn))
+
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ]})
+            await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n',
+                        'more_body': True})
+
+            while True:
+                try:
+                    item = await asyncio.wait_for(conn.queue.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    chunk = b': keepalive\n\n'
+                else:
+                    if item is CLOSED:
+                        break
+                    if item is RESYNC:
+                        chunk = b'event: resync\ndata: {}\n\n'
+                    else:
+                        chunk = format_event(item)
+                        metrics.inc('sse_events_sent_total')
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            watcher.cancel()
+            self.hub.remove(conn)
+
+    async def watch_disconnect(self, receive, conn):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                conn.close()
+                return
+
+
+def create_stream_app(flask_app=None):
+    """Build a TimelineStreamApp sharing `flask_app`'s session and database."""
+
+    from app import CURR_USER_KEY
+    from models import db, Follows
+
+    if flask_app is None:
+        from app import app as flask_app
+
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    cookie_name = flask_app.config['SESSION_COOKIE_NAME']
+    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+
+    def authenticate(scope):
+        headers = dict(scope.get('headers', ()))
+        cookie = SimpleCookie(headers.get(b'cookie', b'').decode('latin-1'))
+        if cookie_name not in cookie:
+            return None
+        try:
+            session = serializer.loads(cookie[cookie_name].value, max_age=max_age)
+        except BadSignature:
+            return None
+        return session.get(CURR_USER_KEY)
+
+    def load_following(user_id):
+        with flask_app.app_context():
+            rows = (db.session.query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id))
+            return [followed_id for (followed_id,) in rows]
+
+    return TimelineStreamApp(
+        flask_app.extensions['bus'],
+        authenticate,
+        load_following,
+        buffer_size=flask_app.config.get('SSE_BUFFER_SIZE', DEFAULT_BUFFER_SIZE),
+        heartbeat=flask_app.config.get('SSE_HEARTBEAT', DEFAULT_HEARTBEAT),
+    )
@@ -0,0 +1,169 @@
+"""Background side effects of writes, run by the job queue (see jobs.py).
+
+Views enqueue a job describing what happened; the handlers here do the
+follow-up work off the request path.
+"""
+
+import time
+
+from flask import current_app
+
+from entity_cache import expire
+from exports import delete_exports
+from jobs import job_handler, enqueue
+from metrics import metrics
+from models import (db, User, Message, Follows, Likes, MessageTag,
+                    Mention, Notification, Inbox, Export)
+from pubsub import MESSAGES_TOPIC
+
+MESSAGE_POSTED = 'message.posted'
+
+
+def message_posted(message_id):
+    """Enqueue the side effects of a newly added (flushed) message."""
+
+    return enqueue(MESSAGE_POSTED, {'message_id': message_id},
+                   idempotency_key=f"{MESSAGE_POSTED}:{message_id}")
+
+
+@job_handler(MESSAGE_POSTED)
+def fan_out_message(payload):
+    """Publish a new message to live timelines."""
+
+    row = current_app.extensions['message_shards'].get(payload['message_id'])
+    author = row and User.visible().filter_by(id=row.user_id).first()
+    if author is None:
+        # Deleted (or its author was) before we got to it; nothing to announce.
+        return
+
+    current_app.extensions['bus'].publish(MESSAGES_TOPIC, {
+        'id': row.id,
+        'text': row.text,
+        'timestamp': row.timestamp.isoformat(),
+        'user': {
+            'id': author.id,
+            'username': author.username,
+            'image_url': author.image_url,
+        },
+    })
+
+
+##############################################################################
+# Account deletion
+
+USER_PURGE = 'user.purge'
+PURGE_BATCH_SIZE = 1000
+PURGE_TIME_BUDGET = 30
+
+
+def user_deleted(user_id):
+    """Enqueue the background purge of a tombstoned user's rows."""
+
+    return enqueue(USER_PURGE, {'user_id': user_id, 'deleted': {}},
+                   idempotency_key=f"{USER_PURGE}:{user_id}")
+
+
+def purge_stages(user_id):
+    """(name, select-ids function, delete-by-ids function) in dependency
+    order; the select function takes the batch size."""
+
+    def first(query):
+        return lambda limit: [row_id for (row_id,) in query.limit(limit)]
+
+    def by_id(model, column):
+        return lambda ids: (model.query
+                            .filter(column.in_(ids))
+                            .delete(synchronize_session=False))
+
+    shards = current_app.extensions['message_shards']
+
+    def delete_messages(ids):
+        expire(Message, ids)
+        # Their likes go too, in the same batch
+        return shards.delete_many(ids, user_id)
+
+    return [
+        ('likes',
+         first(db.session.query(Likes.id).filter(Likes.user_id == user_id)),
+         by_id(Likes, Likes.id)),
+        ('following',
+         first(db.session.query(Follows.user_being_followed_id)
+               .filter(Follows.user_following_id == user_id)),
+         lambda ids: (Follows.query
+                      .filter(Follows.user_following_id == user_id,
+                              Follows.user_being_followed_id.in_(ids))
+                      .delete(synchronize_session=False))),
+        ('followers',
+         first(db.session.query(Follows.user_following_id)
+               .filter(Follows.user_being_followed_id == user_id)),
+         lambda ids: (Follows.query
+                      .filter(Follows.user_being_followed_id == user_id,
+                              Follows.user_following_id.in_(ids))
+                      .delete(synchronize_session=False))),
+        ('message_tags',
+         first(db.session.query(MessageTag.message_id)
+               .filter(MessageTag.author_id == user_id)),
+         by_id(MessageTag, MessageTag.message_id)),
+        ('mentions_made',
+         first(db.session.query(Mention.message_id).filter(Mention.author_id == user_id)),
+         by_id(Mention, Mention.message_id)),
+        ('mentions_received',
+         first(db.session.query(Mention.message_id).filter(Mention.user_id == user_id)),
+         lambda ids: (Mention.query
+                      .filter(Mention.user_id == user_id, Mention.message_id.in_(ids))
+                      .delete(synchronize_session=False))),
+        ('notifications',
+         first(db.session.query(Notification.id).filter(Notification.user_id == user_id)),
+         by_id(Notification, Notification.id)),
+        ('exports',
+         first(db.session.query(Export.id).filter(Export.user_id == user_id)),
+         lambda ids: delete_exports(Export.query.filter(Export.id.in_(ids)).all())),
+        ('inbox',
+         first(db.session.query(Inbox.user_id).filter(Inbox.user_id == user_id)),
+         by_id(Inbox, Inbox.user_id)),
+        ('messages', lambda limit: shards.ids_for_user(user_id, limit), delete_messages),
+    ]
+
+
+@job_handler(USER_PURGE)
+def purge_user(payload, batch_size=None, time_budget=None):
+    """Delete a tombstoned user's likes, follows and messages, then the user.
+
+    Rows go in batches of PURGE_BATCH_SIZE, one transaction per batch, so no
+    lock is held for long. Running totals are kept in the job payload; if
+    the time budget runs out, a continuation job carrying them is enqueued,
+    keeping each run well inside the job lease.
+    """
+
+    batch_size = batch_size or PURGE_BATCH_SIZE
+    time_budget = time_budget if time_budget is not None else PURGE_TIME_BUDGET
+    user_id = payload['user_id']
+    deleted = dict(payload.get('deleted', {}))
+    started = time.monotonic()
+
+    user = User.query.get(user_id)
+    if user is None:
+        return
+    if user.deleted_at is None:
+        raise RuntimeError(f"User #{user_id} is not marked deleted.")
+
+    for name, select_ids, delete_ids in purge_stages(user_id):
+        while True:
+            ids = select_ids(batch_size)
+            if not ids:
+                break
+            count = delete_ids(ids)
+            db.session.commit()
+            deleted[name] = deleted.get(name, 0) + count
+            metrics.inc('user_purge_rows_deleted_total', count, table=name)
+
+            if time.monotonic() - started > time_budget:
+                enqueue(USER_PURGE, {'user_id': user_id, 'deleted': deleted})
+                db.session.commit()
+                return
+
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+    expire(User, [user_id])
+    db.session.commit()
+    metrics.inc('user_purges_completed_total')
+    current_app.logger.info("Purged user #%s: %s", user_id, deleted)
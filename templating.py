@@ -0,0 +1,61 @@
+"""Compiled-template caching for Warbler.
+
+Jinja compiles each template to Python bytecode the first time a process
+renders it. `connect_templates` gives the app's Jinja environment an on-disk
+bytecode cache (JINJA_CACHE_DIR, default .jinja_cache/ in the project) so
+compiled templates survive restarts and are shared by every worker, and,
+unless TEMPLATES_WARM_UP is off, compiles every template at boot so no
+request pays for it.
+
+Auto-reload (re-checking template files on every render) follows
+TEMPLATES_AUTO_RELOAD, and when that is unset is only on in debug mode.
+
+Precompile without starting the app with:
+
+    FLASK_APP=app.py flask warm-templates
+"""
+
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 '.jinja_cache')
+
+
+def warm_templates(app):
+    """Load (and so compile) each of the app's own .html templates.
+
+    Returns how many there were.
+    """
+
+    names = [name for name in app.jinja_loader.list_templates()
+             if name.endswith('.html')]
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def connect_templates(app):
+    """Configure the bytecode cache and auto-reload, then warm up."""
+
+    cache_dir = app.config.get('JINJA_CACHE_DIR') or DEFAULT_CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+
+    env = app.jinja_env
+    env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    auto_reload = app.config.get('TEMPLATES_AUTO_RELOAD')
+    env.auto_reload = app.debug if auto_reload is None else auto_reload
+
+    @app.cli.command('warm-templates')
+    def warm_templates_command():
+        """Compile every template into the bytecode cache."""
+
+        started = time.perf_counter()
+        count = warm_templates(app)
+        print(f"Compiled {count} templates in "
+              f"{(time.perf_counter() - started) * 1000:.0f}ms.")
+
+    if app.config.get('TEMPLATES_WARM_UP', not app.debug):
+        warm_templates(app)
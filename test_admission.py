@@ -0,0 +1,167 @@
+"""Admission control tests."""
+
+# run these tests like:
+#
+# python -m unittest test_admission.py
+
+from unittest import TestCase
+
+from flask import Flask, session
+from flask_wtf.csrf import generate_csrf
+
+from admission import AdaptiveLimiter, connect_admission
+from cache import connect_cache
+from metrics import metrics
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class AdaptiveLimiterTestCase(TestCase):
+    """Test the limit's AIMD adjustments and priority shares."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = AdaptiveLimiter(initial=10, minimum=2, maximum=12,
+                                       target_latency=0.5, clock=self.clock)
+
+    def fill(self, priority, count):
+        for _ in range(count):
+            self.assertTrue(self.limiter.try_acquire(priority))
+
+    def test_priorities_shed_anonymous_first(self):
+        """Are anonymous requests refused while writes are still admitted?"""
+        self.fill('anonymous', 5)
+        self.assertFalse(self.limiter.try_acquire('anonymous'))
+        self.fill('user', 3)
+        self.assertFalse(self.limiter.try_acquire('user'))
+        self.fill('write', 2)
+        self.assertFalse(self.limiter.try_acquire('write'))
+
+        self.limiter.release('anonymous', 0.01)
+        self.assertFalse(self.limiter.try_acquire('anonymous'))
+        self.assertTrue(self.limiter.try_acquire('write'))
+
+    def test_slow_requests_lower_the_limit_once_per_window(self):
+        """Does a burst of slow requests cut the limit once, not per request?"""
+        self.fill('user', 8)
+        for _ in range(8):
+            self.limiter.release('user', 2.0)
+        self.assertEqual(self.limiter.limit, 7.5)
+
+        self.clock.now += 1
+        self.fill('user', 1)
+        self.limiter.release('user', 2.0)
+        self.assertLess(self.limiter.limit, 7.5)
+
+        for _ in range(10):
+            self.clock.now += 1
+            self.fill('write', 1)
+            self.limiter.release('write', 2.0)
+        self.assertEqual(self.limiter.limit, 2)
+
+    def test_fast_requests_raise_the_limit_when_busy(self):
+        """Does the limit grow under load, but not while idle?"""
+        self.fill('write', 1)
+        self.limiter.release('write', 0.01)
+        self.assertEqual(self.limiter.limit, 10)
+
+        for _ in range(50):
+            self.fill('write', 6)
+            for _ in range(6):
+                self.limiter.release('write', 0.01)
+        self.assertEqual(self.limiter.limit, 12)
+
+
+def make_app():
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY='test', ADMISSION_INITIAL_LIMIT=4,
+                      ADMISSION_MIN_LIMIT=4, ADMISSION_RETRY_AFTER=3)
+    connect_cache(app)
+    connect_admission(app, 'curr_user')
+
+    @app.route('/users')
+    def list_users():
+        return '<p>everyone</p>'
+
+    @app.route('/')
+    def homepage():
+        return f'<input name="csrf_token" value="{generate_csrf()}">'
+
+    @app.route('/signup')
+    def signup():
+        return '<p>join</p>'
+
+    @app.route('/login')
+    def login():
+        session['curr_user'] = 1
+        return 'ok'
+
+    @app.route('/messages/new', methods=['POST'])
+    def post():
+        return 'posted'
+
+    return app
+
+
+class AdmissionViewsTestCase(TestCase):
+    """Test shedding, Retry-After and stale pages through a Flask app."""
+
+    def setUp(self):
+        metrics.reset()
+        self.app = make_app()
+        self.limiter = self.app.extensions['admission']
+        self.client = self.app.test_client()
+
+    def overload(self):
+        # Two in flight: the anonymous share (half of 4) is used up.
+        for _ in range(2):
+            self.limiter.try_acquire('user')
+
+    def test_rejects_with_retry_after(self):
+        """Is an anonymous request over its share refused with a 503?"""
+        self.overload()
+        res = self.client.get('/users?q=new')
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '3')
+        self.assertEqual(metrics.value('admission_requests_total',
+                                       priority='anonymous', result='rejected'), 1)
+
+    def test_serves_stale_page(self):
+        """Does an anonymous page rendered earlier come back, marked stale?"""
+        self.assertEqual(self.client.get('/users').status_code, 200)
+        self.overload()
+        res = self.client.get('/users')
+        self.assertEqual((res.status_code, res.data), (200, b'<p>everyone</p>'))
+        self.assertIn('Stale', res.headers['Warning'])
+        self.assertEqual(metrics.value('admission_requests_total',
+                                       priority='anonymous', result='stale'), 1)
+
+    def test_stale_only_for_public_listings(self):
+        """Are pages outside the listings, with a query string or with a
+        CSRF token never served stale?"""
+        for path in ('/signup', '/users?q=new', '/users?cachebust=1', '/'):
+            self.assertEqual(self.client.get(path).status_code, 200)
+        self.overload()
+        for path in ('/signup', '/users?q=new', '/users', '/'):
+            self.assertEqual(self.client.get(path).status_code, 503, path)
+
+    def test_logged_in_and_writes_still_admitted(self):
+        """Are logged-in GETs and writes admitted while anonymous ones are shed?"""
+        self.client.get('/login')
+        self.overload()
+        self.assertEqual(self.client.get('/users').status_code, 200)
+        self.assertEqual(self.client.post('/messages/new').status_code, 200)
+        self.assertEqual(sum(self.limiter.inflight.values()), 2)
+
+    def test_metrics(self):
+        """Is the limiter's state rendered at scrape time?"""
+        self.overload()
+        text = metrics.render()
+        self.assertIn('admission_limit 4', text)
+        self.assertIn('admission_inflight{priority="user"} 2', text)
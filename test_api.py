@@ -0,0 +1,214 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+# FLASK_ENV=production python -m unittest test_api.py
+
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from testing import DatabaseTestCase  # before app: picks the test database
+from models import db, User, Message, MessageArchive, Follows, Likes, Notification
+
+from app import app, CURR_USER_KEY
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ApiTestCase(DatabaseTestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        super().setUp()
+        app.extensions['cache'].clear()
+
+        self.client = app.test_client()
+
+        self.u1 = User.signup(username='apiuser1', email='api1@test.com', password='password1', image_url=None)
+        self.u1.id = 1111
+        self.u2 = User.signup(username='apiuser2', email='api2@test.com', password='password2', image_url=None)
+        self.u2.id = 2222
+        self.u3 = User.signup(username='other3', email='api3@test.com', password='password3', image_url=None)
+        self.u3.id = 3333
+        db.session.commit()
+
+        start = datetime(2020, 1, 1)
+        for i in range(5):
+            db.session.add(Message(id=100 + i, text=f'u2 warble {i}', user_id=2222,
+                                   timestamp=start + timedelta(minutes=i)))
+        db.session.add(Message(id=200, text='u3 warble', user_id=3333, timestamp=start))
+        db.session.add(Follows(user_being_followed_id=2222, user_following_id=1111))
+        db.session.commit()
+
+    def login(self, client, user_id=1111):
+        with client.session_transaction() as session:
+            session[CURR_USER_KEY] = user_id
+
+    def test_timeline_requires_login(self):
+        """Is the timeline closed to anonymous users?"""
+        res = self.client.get('/api/v1/timeline')
+        self.assertEqual(res.status_code, 401)
+        self.assertIn('error', res.get_json())
+
+    def test_timeline_pagination(self):
+        """Does the timeline page through followed users' messages?"""
+        with self.client as client:
+            self.login(client)
+
+            res = client.get('/api/v1/timeline?limit=3')
+            self.assertEqual(res.status_code, 200)
+            data = res.get_json()
+            self.assertEqual([m['id'] for m in data['messages']], [104, 103, 102])
+            self.assertEqual(data['messages'][0]['user']['username'], 'apiuser2')
+            self.assertIsNotNone(data['next_cursor'])
+
+            res = client.get(f"/api/v1/timeline?limit=3&cursor={data['next_cursor']}")
+            data = res.get_json()
+            self.assertEqual([m['id'] for m in data['messages']], [101, 100])
+            self.assertIsNone(data['next_cursor'])
+
+    def test_pagination_reads_archive(self):
+        """Does deep pagination continue into archived messages?"""
+        shards = app.extensions['message_shards']
+        shards.archive_after = timedelta(days=30)
+        try:
+            moved = shards.archive(datetime(2020, 1, 1, 0, 3))
+            self.assertEqual(moved, 4)
+            self.assertEqual(MessageArchive.query.count(), 4)
+
+            res = self.client.get('/api/v1/users/2222/messages?limit=3')
+            data = res.get_json()
+            self.assertEqual([m['id'] for m in data['messages']], [104, 103, 102])
+
+            res = self.client.get(
+                f"/api/v1/users/2222/messages?limit=3&cursor={data['next_cursor']}")
+            self.assertEqual([m['id'] for m in res.get_json()['messages']], [101, 100])
+
+            res = self.client.get('/api/v1/messages/101')
+            self.assertEqual(res.get_json()['text'], 'u2 warble 1')
+        finally:
+            shards.archive_after = None
+
+    def test_conditional_get(self):
+        """Does an unchanged resource answer If-None-Match with 304?"""
+        res = self.client.get('/api/v1/messages/100')
+        self.assertEqual(res.status_code, 200)
+        etag = res.headers['ETag']
+
+        res = self.client.get('/api/v1/messages/100', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+    def test_user_profile(self):
+        """Does the profile include counts?"""
+        res = self.client.get('/api/v1/users/2222')
+        data = res.get_json()
+        self.assertEqual(data['username'], 'apiuser2')
+        self.assertEqual(data['counts'], {'messages': 5, 'following': 0,
+                                          'followers': 1, 'likes': 0})
+
+        self.assertEqual(self.client.get('/api/v1/users/9999').status_code, 404)
+
+    def test_search(self):
+        """Does search filter by username and paginate?"""
+        res = self.client.get('/api/v1/users/search?q=apiuser&limit=1')
+        data = res.get_json()
+        self.assertEqual([u['username'] for u in data['users']], ['apiuser1'])
+
+        res = self.client.get(f"/api/v1/users/search?q=apiuser&cursor={data['next_cursor']}")
+        data = res.get_json()
+        self.assertEqual([u['username'] for u in data['users']], ['apiuser2'])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_follow_unfollow(self):
+        """Can a user follow and unfollow through the API?"""
+        with self.client as client:
+            self.login(client)
+
+            res = client.post('/api/v1/users/3333/follow')
+            self.assertEqual(res.get_json(), {'following': True})
+            self.assertEqual(Follows.query.filter_by(user_following_id=1111).count(), 2)
+
+            res = client.delete('/api/v1/users/3333/follow')
+            self.assertEqual(res.get_json(), {'following': False})
+            self.assertEqual(Follows.query.filter_by(user_following_id=1111).count(), 1)
+
+    def test_like_unlike(self):
+        """Can a user like and unlike through the API?"""
+        with self.client as client:
+            self.login(client)
+
+            res = client.post('/api/v1/messages/200/like')
+            self.assertEqual(res.get_json(), {'liked': True})
+            self.assertEqual(Likes.query.filter_by(user_id=1111, message_id=200).count(), 1)
+
+            res = client.get('/api/v1/messages/200')
+            self.assertTrue(res.get_json()['liked'])
+
+            res = client.delete('/api/v1/messages/200/like')
+            self.assertEqual(res.get_json(), {'liked': False})
+            self.assertEqual(Likes.query.count(), 0)
+
+            self.login(client, 2222)
+            res = client.post('/api/v1/messages/100/like')
+            self.assertEqual(res.status_code, 400)
+
+    def test_concurrent_duplicates(self):
+        """Does a like or follow that raced an identical one get the
+        idempotent answer rather than an error?"""
+        db.session.add(Likes(user_id=1111, message_id=200))
+        db.session.commit()
+
+        with self.client as client:
+            self.login(client)
+
+            # Both existence checks miss the row, as if it were inserted after them
+            with patch.object(Likes, 'query') as likes, \
+                    patch.object(Follows, 'query') as follows:
+                likes.filter_by.return_value.first.return_value = None
+                follows.filter_by.return_value.first.return_value = None
+
+                res = client.post('/api/v1/messages/200/like')
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(res.get_json(), {'liked': True})
+
+                res = client.post('/api/v1/users/2222/follow')
+                self.assertEqual(res.get_json(), {'following': True})
+
+        self.assertEqual(Notification.query.count(), 0)
+
+    def test_batch_lookups(self):
+        """Do the batch endpoints answer for many ids at once?"""
+        db.session.add(Likes(user_id=1111, message_id=101))
+        db.session.commit()
+
+        with self.client as client:
+            self.login(client)
+
+            res = client.get('/api/v1/likes?message_ids=100,101,200')
+            self.assertEqual(res.get_json(), {'liked': [101]})
+
+            res = client.get('/api/v1/following?user_ids=2222,3333,9999')
+            self.assertEqual(res.get_json(), {'following': [2222]})
+
+            res = client.get('/api/v1/messages?ids=200,9999,101')
+            data = res.get_json()
+            self.assertEqual([m['id'] for m in data['messages']], [200, 101])
+            self.assertTrue(data['messages'][1]['liked'])
+
+            ids = ','.join(str(i) for i in range(101))
+            res = client.get(f'/api/v1/messages?ids={ids}')
+            self.assertEqual(res.status_code, 400)
+
+    def test_batch_follow(self):
+        """Does bulk follow skip self, unknown and existing follows?"""
+        with self.client as client:
+            self.login(client)
+
+            res = client.post('/api/v1/following',
+                              json={'user_ids': [1111, 2222, 3333, 9999]})
+            self.assertEqual(res.get_json(), {'followed': 1})
+            self.assertEqual(Follows.query.filter_by(user_following_id=1111).count(), 2)
+
+            res = client.post('/api/v1/following', json={'user_ids': 'nope'})
+            self.assertEqual(res.status_code, 400)
@@ -0,0 +1,40 @@
+"""App factory tests."""
+
+# run these tests like:
+#
+# FLASK_ENV=production python -m unittest test_app_factory.py
+
+from unittest import TestCase
+
+import testing  # noqa: F401 (before app: picks the test database)
+from app import app, create_app
+from models import db
+
+
+class AppFactoryTestCase(TestCase):
+    """Test create_app()."""
+
+    def tearDown(self):
+        # create_app() points the shared `db` at the new app; undo that
+        db.app = app
+
+    def test_config_override(self):
+        """Does `config` override settings read from the environment?"""
+        other = create_app({'SECRET_KEY': 'other', 'COMPRESS_LEVEL': 1})
+        self.assertEqual(other.config['SECRET_KEY'], 'other')
+        self.assertEqual(other.config['COMPRESS_LEVEL'], 1)
+        self.assertEqual(other.config['SQLALCHEMY_DATABASE_URI'],
+                         app.config['SQLALCHEMY_DATABASE_URI'])
+        self.assertIsNot(other, app)
+
+    def test_routes_registered(self):
+        """Does each app get the views under their usual endpoint names?"""
+        other = create_app()
+        endpoints = {rule.endpoint for rule in other.url_map.iter_rules()}
+        self.assertTrue({'homepage', 'users_show', 'messages_show',
+                         'api.timeline'} <= endpoints)
+
+    def test_debug_toolbar_only_in_debug(self):
+        """Is the debug toolbar left out unless the app is in debug mode?"""
+        self.assertNotIn('debugtoolbar', create_app().blueprints)
+        self.assertIn('debugtoolbar', create_app({'DEBUG': True}).blueprints)
@@ -0,0 +1,241 @@
+"""ASGI entry point tests."""
+
+# run these tests like:
+#
+# FLASK_ENV=production python -m unittest test_asgi.py
+
+import asyncio
+import json
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from flask import Flask, Response, request, session
+
+import testing  # noqa: F401 (before app: picks the test database)
+from app import app, create_app, CURR_USER_KEY
+from asgi import async_url, wsgi_environ, WsgiFallback, create_asgi_app
+from models import db, User, Follows
+from sharding import message_shards
+
+
+def call(asgi_app, method, path, query=b'', body=b'', headers=()):
+    """Run one HTTP request through `asgi_app`; returns (status, headers, body)."""
+
+    sent = []
+    chunks = [{'type': 'http.request', 'body': body[:5], 'more_body': True},
+              {'type': 'http.request', 'body': body[5:]}]
+
+    async def receive():
+        return chunks.pop(0) if chunks else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+             'headers': [(name.encode(), value.encode()) for name, value in headers],
+             'server': ('testserver', 80), 'client': ('127.0.0.1', 1234)}
+    asyncio.run(asgi_app(scope, receive, send))
+    start = sent[0]
+    body = b''.join(m.get('body', b'') for m in sent[1:])
+    return start['status'], dict((k.decode(), v.decode()) for k, v in start['headers']), body
+
+
+class AsyncUrlTestCase(TestCase):
+    """Test picking the async driver for a database URL."""
+
+    def test_async_url(self):
+        """Is each URL given its database's async driver?"""
+        self.assertEqual(async_url('postgresql:///warbler'), 'postgresql+asyncpg:///warbler')
+        self.assertEqual(async_url('postgresql+psycopg2://u@db/w'),
+                         'postgresql+asyncpg://u@db/w')
+        self.assertEqual(async_url('sqlite:////tmp/w.db'), 'sqlite+aiosqlite:////tmp/w.db')
+        with self.assertRaises(ValueError):
+            async_url('mysql://db/warbler')
+
+    def test_wsgi_environ(self):
+        """Are headers, query string and body carried over from the scope?"""
+        environ = wsgi_environ({
+            'type': 'http', 'method': 'POST', 'path': '/café', 'query_string': b'a=1',
+            'headers': [(b'content-type', b'text/plain'), (b'x-tag', b'a'),
+                        (b'x-tag', b'b')]}, b'hello')
+        self.assertEqual(environ['PATH_INFO'], '/café'.encode().decode('latin-1'))
+        self.assertEqual(environ['QUERY_STRING'], 'a=1')
+        self.assertEqual(environ['CONTENT_TYPE'], 'text/plain')
+        self.assertEqual(environ['HTTP_X_TAG'], 'a,b')
+        self.assertEqual(environ['wsgi.input'].read(), b'hello')
+
+
+def make_flask_app():
+    flask_app = Flask(__name__)
+    flask_app.config['SECRET_KEY'] = 'test'
+
+    @flask_app.route('/echo', methods=['POST'])
+    def echo():
+        session['posted'] = True
+        return f"{request.args['n']}:{request.get_data(as_text=True)}"
+
+    @flask_app.route('/stream')
+    def stream():
+        return Response(f'{n}\n' for n in range(3))
+
+    return flask_app
+
+
+class WsgiFallbackTestCase(TestCase):
+    """Test serving a Flask app over ASGI from a thread pool."""
+
+    def setUp(self):
+        self.fallback = WsgiFallback(make_flask_app(), threads=2)
+
+    def tearDown(self):
+        self.fallback.shutdown()
+
+    def test_request_and_response(self):
+        """Do the body, query string, status and cookies make the round trip?"""
+        status, headers, body = call(self.fallback, 'POST', '/echo', query=b'n=7',
+                                     body=b'hello world',
+                                     headers=[('content-length', '11')])
+        self.assertEqual((status, body), (200, b'7:hello world'))
+        self.assertIn('session=', headers['set-cookie'])
+
+        status, _, _ = call(self.fallback, 'GET', '/missing')
+        self.assertEqual(status, 404)
+
+    def test_streamed_response(self):
+        """Is a generator response sent as it is produced?"""
+        status, _, body = call(self.fallback, 'GET', '/stream')
+        self.assertEqual((status, body), (200, b'0\n1\n2\n'))
+
+
+class AsgiReadViewsTestCase(TestCase):
+    """Test the async read views against two SQLite message shards."""
+
+    shard_count = 2
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.flask_app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'primary.db')}",
+            'MESSAGE_SHARD_URIS': [f"sqlite:///{os.path.join(tmp, f'shard{i}.db')}"
+                                   for i in range(self.shard_count)],
+            'SQLALCHEMY_REPLICA_URIS': [],
+            'JINJA_CACHE_DIR': tmp,
+            'ADMISSION_ENABLED': False,
+        })
+        with self.flask_app.app_context():
+            db.create_all()
+            shards = message_shards()
+            shards.create_schema()
+            users = [User(username=f'user{i}', email=f'u{i}@test.com', password='x')
+                     for i in range(3)]
+            db.session.add_all(users)
+            db.session.commit()
+            self.user_ids = [user.id for user in users]
+            db.session.add(Follows(user_following_id=self.user_ids[0],
+                                   user_being_followed_id=self.user_ids[1]))
+            db.session.commit()
+            self.message_ids = [shards.add(user_id, f'hello from {n}').id
+                                for n, user_id in enumerate(self.user_ids)]
+        self.asgi_app = create_asgi_app(self.flask_app)
+
+    def tearDown(self):
+        self.asgi_app.wsgi.shutdown()
+        asyncio.run(self.asgi_app.db.dispose())
+        db.app = app
+
+    def login_cookie(self, user_id):
+        client = self.flask_app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        cookie = next(c for c in client.cookie_jar if c.name == 'session')
+        return [('cookie', f'session={cookie.value}')]
+
+    def test_home_feed(self):
+        """Does the home feed show the user's and followed users' messages only?"""
+        status, headers, body = call(self.asgi_app, 'GET', '/',
+                                     headers=self.login_cookie(self.user_ids[0]))
+        self.assertEqual(status, 200)
+        self.assertIn(b'hello from 0', body)
+        self.assertIn(b'hello from 1', body)
+        self.assertNotIn(b'hello from 2', body)
+        self.assertEqual(headers['cache-control'], 'public, max-age=0')
+
+        _, _, anonymous = call(self.asgi_app, 'GET', '/')
+        self.assertNotIn(b'hello from', anonymous)
+
+    def test_profile_and_message_pages(self):
+        """Are profiles and messages rendered, and unknown ones 404?"""
+        status, _, body = call(self.asgi_app, 'GET', f'/users/{self.user_ids[2]}')
+        self.assertEqual(status, 200)
+        self.assertIn(b'@user2', body)
+        self.assertIn(b'hello from 2', body)
+
+        status, _, body = call(self.asgi_app, 'GET', f'/messages/{self.message_ids[1]}',
+                               headers=self.login_cookie(self.user_ids[0]))
+        self.assertEqual(status, 200)
+        self.assertIn(b'hello from 1', body)
+        self.assertIn(b'Unfollow', body)
+
+        self.assertEqual(call(self.asgi_app, 'GET', '/users/999999')[0], 404)
+        self.assertEqual(call(self.asgi_app, 'GET', '/messages/1')[0], 404)
+
+    def test_deleted_users_hidden(self):
+        """Are a deleted user's messages and follows left out, as in the
+        Flask views?"""
+        with self.flask_app.app_context():
+            db.session.add(Follows(user_following_id=self.user_ids[1],
+                                   user_being_followed_id=self.user_ids[0]))
+            User.query.get(self.user_ids[1]).deleted_at = datetime.utcnow()
+            db.session.commit()
+
+        cookie = self.login_cookie(self.user_ids[0])
+        _, _, body = call(self.asgi_app, 'GET', '/', headers=cookie)
+        self.assertIn(b'hello from 0', body)
+        self.assertNotIn(b'hello from 1', body)
+
+        _, _, body = call(self.asgi_app, 'GET', f'/users/{self.user_ids[0]}')
+        self.assertIn(f'/users/{self.user_ids[0]}/following">0<'.encode(), body)
+        self.assertIn(f'/users/{self.user_ids[0]}/followers">0<'.encode(), body)
+
+        status, _, _ = call(self.asgi_app, 'GET', f'/messages/{self.message_ids[1]}')
+        self.assertEqual(status, 404)
+
+    def test_json_api(self):
+        """Do the async API reads match the Flask API's responses?"""
+        cookie = self.login_cookie(self.user_ids[0])
+        client = self.flask_app.test_client()
+        client.set_cookie('localhost', 'session', cookie[0][1].split('=', 1)[1])
+
+        for path in ('/api/v1/timeline', f'/api/v1/users/{self.user_ids[1]}',
+                     f'/api/v1/users/{self.user_ids[1]}/messages',
+                     f'/api/v1/messages/{self.message_ids[0]}'):
+            status, headers, body = call(self.asgi_app, 'GET', path, headers=cookie)
+            expected = client.get(path)
+            self.assertEqual(status, expected.status_code, path)
+            self.assertEqual(json.loads(body), expected.get_json(), path)
+            if status != 200:
+                continue
+
+            etag = headers['etag']
+            status, _, _ = call(self.asgi_app, 'GET', path,
+                                headers=cookie + [('if-none-match', etag)])
+            self.assertEqual(status, 304)
+
+        _, _, body = call(self.asgi_app, 'GET', '/api/v1/timeline', headers=cookie)
+        self.assertEqual([m['text'] for m in json.loads(body)['messages']],
+                         ['hello from 1', 'hello from 0'])
+        self.assertEqual(call(self.asgi_app, 'GET', '/api/v1/timeline')[0], 401)
+
+    def test_other_routes_use_flask(self):
+        """Are pages without an async view served by the Flask app?"""
+        status, _, body = call(self.asgi_app, 'GET', '/login')
+        self.assertEqual(status, 200)
+        self.assertIn(b'Welcome back', body)
+
+
+class AsgiUnshardedReadViewsTestCase(AsgiReadViewsTestCase):
+    """The same, with messages in the primary database."""
+
+    shard_count = 0
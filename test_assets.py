@@ -0,0 +1,85 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+# python -m unittest test_assets.py
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from flask import Flask, render_template_string
+
+from assets import build_assets, connect_assets, IMMUTABLE_CACHE_CONTROL
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+
+class AssetPipelineTestCase(TestCase):
+    """Test building and serving hashed assets."""
+
+    def setUp(self):
+        """Build assets from a copy of static/ into a scratch directory."""
+
+        self.tmp = tempfile.mkdtemp()
+        self.static = os.path.join(self.tmp, 'static')
+        shutil.copytree(STATIC_FOLDER, self.static,
+                        ignore=shutil.ignore_patterns('dist'))
+        self.manifest = build_assets(self.static)
+
+        self.app = Flask(__name__, static_folder=self.static)
+        connect_assets(self.app)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_manifest(self):
+        """Are files fingerprinted, and stylesheet urls rewritten?"""
+
+        css = self.manifest['stylesheets/style.css']
+        self.assertRegex(css, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+
+        with open(os.path.join(self.static, 'dist', css)) as f:
+            content = f.read()
+        self.assertNotIn('/static/images/nav-bg.png', content)
+        self.assertIn(f"/assets/{self.manifest['images/nav-bg.png']}", content)
+
+        self.assertTrue(os.path.isfile(os.path.join(self.static, 'dist', css + '.gz')))
+        self.assertFalse(os.path.isfile(os.path.join(
+            self.static, 'dist', self.manifest['images/warbler-hero.jpg'] + '.gz')))
+
+    def test_asset_url(self):
+        """Does asset_url resolve through the manifest?"""
+
+        with self.app.test_request_context():
+            url = render_template_string("{{ asset_url('stylesheets/style.css') }}")
+            self.assertEqual(url, f"/assets/{self.manifest['stylesheets/style.css']}")
+
+            url = render_template_string("{{ asset_url('not-built.css') }}")
+            self.assertEqual(url, "/static/not-built.css")
+
+    def test_serve_gzip(self):
+        """Is the gzip variant served to clients that accept it?"""
+
+        css = self.manifest['stylesheets/style.css']
+        res = self.client.get(f'/assets/{css}',
+                              headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(res.headers['Cache-Control'], IMMUTABLE_CACHE_CONTROL)
+        self.assertIn('text/css', res.headers['Content-Type'])
+        self.assertIn(b'body', gzip.decompress(res.data))
+        res.close()
+
+    def test_serve_identity(self):
+        """Is the raw file served to clients that don't accept gzip?"""
+
+        css = self.manifest['stylesheets/style.css']
+        res = self.client.get(f'/assets/{css}')
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn(b'body', res.data)
+        res.close()
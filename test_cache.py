@@ -0,0 +1,175 @@
+"""Cache backend tests."""
+
+# run these tests like:
+#
+# python -m unittest test_cache.py
+
+import threading
+import time
+from unittest import TestCase
+
+from cache import Cache, Entry, LRUCache, RedisTier
+from metrics import metrics
+
+
+class FakeRedis:
+    """Just enough of the Redis client API for RedisTier, in a dict."""
+
+    def __init__(self):
+        self.data = {}
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs)
+                for name, args, kwargs in self.calls]
+
+
+class LocalCacheTestCase(TestCase):
+    """Test the in-process tier on its own."""
+
+    def setUp(self):
+        metrics.reset()
+        self.cache = Cache(local=LRUCache(max_entries=2))
+
+    def test_get_set_delete_many(self):
+        """Do the basic operations round-trip?"""
+        self.cache.set('a', 1)
+        self.cache.set_many({'b': 2})
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']), {'a': 1, 'b': 2})
+
+        self.cache.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('a', 'default'), 'default')
+
+    def test_lru_bound_and_ttl(self):
+        """Is the least recently used entry evicted, and do TTLs expire?"""
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']), {'a': 1, 'c': 3})
+
+        self.cache.set('short', 1, ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(self.cache.get('short'))
+
+    def test_tags(self):
+        """Does invalidating a tag drop just the entries carrying it?"""
+        self.cache.set('tagged', 1, tags=['t'])
+        self.cache.set('other', 2, tags=['u'])
+        self.cache.invalidate_tags('t')
+        self.assertEqual(self.cache.get_many(['tagged', 'other']), {'other': 2})
+
+    def test_hit_metrics(self):
+        """Are hits and misses counted?"""
+        self.cache.get('missing')
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.assertEqual(metrics.value('cache_requests_total', tier='local', result='hit'), 1)
+        self.assertEqual(metrics.value('cache_requests_total', tier='local', result='miss'), 1)
+
+
+class SharedCacheTestCase(TestCase):
+    """Test two workers' caches sharing one Redis-protocol tier."""
+
+    def setUp(self):
+        metrics.reset()
+        redis = FakeRedis()
+        self.worker1 = Cache(shared=RedisTier(redis), local_ttl=0.01)
+        self.worker2 = Cache(shared=RedisTier(redis), local_ttl=0.01)
+
+    def test_shared_between_workers(self):
+        """Does one worker see what another cached?"""
+        self.worker1.set('k', {'v': 1})
+        self.assertEqual(self.worker2.get('k'), {'v': 1})
+        self.assertEqual(metrics.value('cache_requests_total', tier='shared', result='hit'), 1)
+
+    def test_tag_invalidation_across_workers(self):
+        """Does invalidating on one worker reach the other once its LRU lapses?"""
+        self.worker1.set('k', 1, tags=['t'])
+        self.assertEqual(self.worker2.get('k'), 1)
+
+        self.worker1.invalidate_tags('t')
+        time.sleep(0.02)
+        self.assertIsNone(self.worker2.get('k'))
+        self.assertIsNone(self.worker1.get('k'))
+
+
+class StampedeTestCase(TestCase):
+    """Test single-flight computation and early refresh."""
+
+    def setUp(self):
+        metrics.reset()
+        self.cache = Cache()
+        self.calls = 0
+
+    def slow_compute(self):
+        self.calls += 1
+        time.sleep(0.05)
+        return self.calls
+
+    def test_single_flight(self):
+        """Do concurrent misses for one key compute it only once?"""
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.cache.get_or_set('k', self.slow_compute)))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [1] * 8)
+
+    def test_early_refresh(self):
+        """Is an entry near expiry refreshed while it is still served?"""
+        # A 10s entry with 0.5s left, inside the last 10% of its TTL
+        expires_at = time.time() + 0.5
+        self.cache.local.set('k', Entry('old', expires_at, 10, {}), expires_at)
+
+        self.assertEqual(self.cache.get_or_set('k', self.slow_compute), 1)
+        self.assertEqual(self.cache.get('k'), 1)
+        self.assertEqual(metrics.value('cache_early_refreshes_total'), 1)
+
+    def test_none_not_cached(self):
+        """Are None results recomputed rather than cached?"""
+        self.cache.get_or_set('k', lambda: None)
+        self.assertEqual(self.cache.get_or_set('k', lambda: 'found'), 'found')
+
+    def test_invalidated_while_computing(self):
+        """Is a value invalidated mid-computation left uncached?"""
+        def compute():
+            self.cache.invalidate_tags('t')
+            return 'stale'
+
+        self.assertEqual(self.cache.get_or_set('k', compute, tags=['t']), 'stale')
+        self.assertIsNone(self.cache.get('k'))
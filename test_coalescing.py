@@ -0,0 +1,113 @@
+"""Request coalescing tests."""
+
+# run these tests like:
+#
+# python -m unittest test_coalescing.py
+
+import threading
+import time
+from unittest import TestCase
+
+from flask import Flask, g, request
+
+from cache import Cache, RedisTier
+from coalescing import Coalescer, coalesced, connect_coalescing
+from metrics import metrics
+from test_cache import FakeRedis
+
+
+def make_app(max_wait=2.0, delay=0.1):
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    app.config['COALESCE_MAX_WAIT'] = max_wait
+    connect_coalescing(app)
+    app.calls = 0
+
+    @app.before_request
+    def add_user_to_g():
+        g.user = request.headers.get('X-User')
+
+    @app.route('/pages/<int:page_id>')
+    @coalesced
+    def page(page_id):
+        app.calls += 1
+        time.sleep(delay)
+        return f'page {page_id}'
+
+    return app
+
+
+def fetch_concurrently(app, paths, headers=None):
+    results = [None] * len(paths)
+
+    def fetch(i, path):
+        res = app.test_client().get(path, headers=headers or {})
+        results[i] = (res.status_code, res.get_data(as_text=True))
+
+    threads = [threading.Thread(target=fetch, args=(i, path))
+               for i, path in enumerate(paths)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class CoalescingTestCase(TestCase):
+    """Test that identical anonymous GETs share one rendering."""
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_identical_requests_share_one_run(self):
+        """Do concurrent requests for one page render it once?"""
+        app = make_app()
+        results = fetch_concurrently(app, ['/pages/1'] * 6)
+        self.assertEqual(app.calls, 1)
+        self.assertEqual(results, [(200, 'page 1')] * 6)
+        self.assertEqual(metrics.value('coalesced_requests_total', result='follower'), 5)
+
+    def test_different_pages_not_shared(self):
+        """Are different URLs rendered separately?"""
+        app = make_app()
+        results = fetch_concurrently(app, ['/pages/1', '/pages/2'])
+        self.assertEqual(app.calls, 2)
+        self.assertEqual(sorted(results), [(200, 'page 1'), (200, 'page 2')])
+
+    def test_logged_in_not_coalesced(self):
+        """Do logged-in users always get their own rendering?"""
+        app = make_app()
+        fetch_concurrently(app, ['/pages/1'] * 3, headers={'X-User': 'someone'})
+        self.assertEqual(app.calls, 3)
+
+    def test_max_wait(self):
+        """Does a follower stop waiting after COALESCE_MAX_WAIT?"""
+        app = make_app(max_wait=0.01, delay=0.2)
+        results = fetch_concurrently(app, ['/pages/1'] * 2)
+        self.assertEqual(app.calls, 2)
+        self.assertEqual(results, [(200, 'page 1')] * 2)
+        self.assertEqual(metrics.value('coalesced_requests_total', result='timeout'), 1)
+
+    def test_across_workers(self):
+        """Do leaders in two workers share one computation via the cache?"""
+        redis = FakeRedis()
+        workers = [Coalescer(max_wait=2, cache=Cache(shared=RedisTier(redis)))
+                   for _ in range(2)]
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'result'
+
+        results = []
+        threads = [threading.Thread(target=lambda w=w: results.append(w.run('k', compute)))
+                   for w in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result', 'result'])
+        self.assertEqual(metrics.value('coalesced_requests_total', result='shared'), 1)
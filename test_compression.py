@@ -0,0 +1,106 @@
+"""Response compression and metrics tests."""
+
+# run these tests like:
+#
+# python -m unittest test_compression.py
+
+import gzip
+from unittest import TestCase
+
+from flask import Flask, Response
+
+from compression import CompressionMiddleware
+from metrics import metrics, connect_metrics
+
+PAGE = '<li class="list-group-item">warble</li>' * 100
+
+
+def make_app():
+    app = Flask(__name__)
+    connect_metrics(app)
+
+    @app.route('/page')
+    def page():
+        return PAGE
+
+    @app.route('/tiny')
+    def tiny():
+        return 'hi'
+
+    @app.route('/json')
+    def json():
+        return Response('[1, 2, 3]' * 100, mimetype='application/json')
+
+    @app.route('/png')
+    def png():
+        return Response(b'\x89PNG' * 500, mimetype='image/png')
+
+    @app.route('/stream')
+    def stream():
+        return Response((f'<p>{i}</p>' for i in range(500)), mimetype='text/html')
+
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app, min_size=500)
+    return app
+
+
+class CompressionTestCase(TestCase):
+    """Test the gzip middleware."""
+
+    def setUp(self):
+        metrics.reset()
+        self.client = make_app().test_client()
+
+    def get(self, path, encoding='gzip'):
+        return self.client.get(path, headers={'Accept-Encoding': encoding})
+
+    def test_compresses_html(self):
+        """Are large HTML pages gzipped and reported?"""
+
+        res = self.get('/page')
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        self.assertNotIn('Content-Length', res.headers)
+        self.assertEqual(gzip.decompress(res.data).decode(), PAGE)
+
+        count, ratio_sum = metrics.histogram('http_compression_ratio')
+        self.assertEqual(count, 1)
+        self.assertLess(ratio_sum, 0.1)
+        self.assertEqual(metrics.value('http_compression_bytes_in_total'), len(PAGE))
+        self.assertEqual(metrics.histogram('http_compression_cpu_seconds')[0], 1)
+
+    def test_streamed_body(self):
+        """Are streamed responses compressed without a known length?"""
+
+        res = self.get('/stream')
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        expected = ''.join(f'<p>{i}</p>' for i in range(500))
+        self.assertEqual(gzip.decompress(res.data).decode(), expected)
+
+    def test_skips_small_and_disallowed(self):
+        """Are small bodies and non-allowlisted types left alone?"""
+
+        for path in ('/tiny', '/png'):
+            res = self.get(path)
+            self.assertNotIn('Content-Encoding', res.headers)
+
+        self.assertEqual(self.get('/json').headers['Content-Encoding'], 'gzip')
+
+    def test_client_without_gzip(self):
+        """Do clients that don't accept gzip get identity responses?"""
+
+        for encoding in ('identity', 'gzip;q=0'):
+            res = self.get('/page', encoding=encoding)
+            self.assertNotIn('Content-Encoding', res.headers)
+            self.assertEqual(res.data.decode(), PAGE)
+
+    def test_request_timing(self):
+        """Is request timing recorded on the same metrics surface?"""
+
+        self.get('/page').data
+        self.assertEqual(metrics.histogram('http_request_duration_seconds',
+                                           endpoint='page', method='GET')[0], 1)
+
+        res = self.get('/metrics', encoding='identity')
+        self.assertIn('http_request_duration_seconds_count{endpoint="page",method="GET"} 1',
+                      res.data.decode())
+        self.assertIn('http_compression_ratio_count 1', res.data.decode())
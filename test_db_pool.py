@@ -0,0 +1,101 @@
+"""Connection pool configuration and metrics tests."""
+
+# run these tests like:
+#
+# python -m unittest test_db_pool.py
+
+import gc
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+import db_pool
+from db_pool import (engine_options, instrumented_pool, InstrumentedQueuePool,
+                     dispose_pools_before_fork)
+from metrics import metrics
+
+
+class PoolTestCase(TestCase):
+    """Test pool options and instrumentation."""
+
+    def setUp(self):
+        metrics.reset()
+        path = os.path.join(tempfile.mkdtemp(), 'pool.db')
+        self.engine = create_engine(
+            f'sqlite:///{path}', poolclass=instrumented_pool('test'),
+            pool_size=1, max_overflow=1, pool_timeout=0.05,
+            connect_args={'check_same_thread': False})
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_engine_options(self):
+        """Are pool settings read from config, and skipped for SQLite?"""
+        options = engine_options('postgresql:///warbler',
+                                 {'DB_POOL_SIZE': 3, 'DB_MAX_OVERFLOW': 0})
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertTrue(issubclass(options['poolclass'], InstrumentedQueuePool))
+
+        options = engine_options('sqlite:///x.db', {'DB_POOL_SIZE': 3})
+        self.assertNotIn('pool_size', options)
+
+    def test_wait_overflow_and_timeout(self):
+        """Are checkout waits, overflow connections and timeouts counted?"""
+        first = self.engine.connect()
+        second = self.engine.connect()
+        self.assertEqual(metrics.value('db_pool_overflow_total', pool='test'), 1)
+
+        with self.assertRaises(PoolTimeoutError):
+            self.engine.connect()
+        self.assertEqual(metrics.value('db_pool_timeouts_total', pool='test'), 1)
+
+        count, _ = metrics.histogram('db_pool_checkout_wait_seconds', pool='test')
+        self.assertEqual(count, 3)
+
+        second.close()
+        first.close()
+
+    def test_label_survives_dispose(self):
+        """Does the pool keep its metrics label after engine.dispose()?"""
+        self.engine.dispose()
+        self.assertEqual(self.engine.pool.metrics_name, 'test')
+
+
+class DisposeBeforeForkTestCase(TestCase):
+    """Test emptying the apps' pools before a fork."""
+
+    def make_app(self, tmp):
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(tmp, 'fork.db')}"
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        SQLAlchemy(app)
+        return app
+
+    @skipUnless(hasattr(os, 'register_at_fork'), "needs os.register_at_fork")
+    def test_apps_held_weakly(self):
+        """Is the fork hook registered once, with apps held only weakly?"""
+        tmp = tempfile.mkdtemp()
+        with patch('os.register_at_fork') as register:
+            apps = [self.make_app(tmp) for _ in range(3)]
+            for app in apps:
+                dispose_pools_before_fork(app)
+        register.assert_not_called()
+        self.assertTrue(all(app in db_pool._fork_apps for app in apps))
+
+        engine = apps[0].extensions['sqlalchemy'].db.get_engine(apps[0])
+        engine.connect().close()
+        pool = engine.pool
+        db_pool._dispose_before_fork()
+        self.assertIsNot(engine.pool, pool)
+
+        del apps, app
+        gc.collect()
+        self.assertFalse([app for app in db_pool._fork_apps if app.import_name == __name__])
@@ -0,0 +1,93 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+# python -m unittest test_db_routing.py
+#
+# Two SQLite files stand in for the primary and its replica. Replication
+# is simulated by copying rows by hand, so reads can tell which one they hit.
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from flask import Flask, jsonify
+
+from db_routing import connect_replicas, LAST_WRITE_KEY
+from models import db, User
+
+
+def make_app(primary, replica):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{primary}'
+    app.config['SQLALCHEMY_REPLICA_URIS'] = [f'sqlite:///{replica}']
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SECRET_KEY'] = 'test'
+    db.init_app(app)
+    connect_replicas(app, db)
+
+    @app.route('/users')
+    def usernames():
+        return jsonify(sorted(u.username for u in User.query.all()))
+
+    @app.route('/users', methods=['POST'])
+    def add_user():
+        db.session.add(User(username='written', email='w@test.com', password='x'))
+        db.session.commit()
+        return jsonify(sorted(u.username for u in User.query.all()))
+
+    return app
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test that GETs read from the replica and writes stick to the primary."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.app = make_app(os.path.join(self.tmp, 'primary.db'),
+                            os.path.join(self.tmp, 'replica.db'))
+        self.client = self.app.test_client()
+
+        with self.app.app_context():
+            replica = self.app.extensions['db_replicas'][0]
+            db.create_all()
+            db.metadata.create_all(bind=replica)
+
+            db.session.add(User(username='on-primary', email='p@test.com', password='x'))
+            db.session.commit()
+            replica.execute(User.__table__.insert(),
+                            username='on-replica', email='r@test.com', password='x')
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            for engine in self.app.extensions['db_replicas'] + [db.engine]:
+                engine.dispose()
+
+    def test_get_reads_replica(self):
+        """Do GET requests read from the replica?"""
+        res = self.client.get('/users')
+        self.assertEqual(res.get_json(), ['on-replica'])
+
+    def test_write_goes_to_primary(self):
+        """Do POSTs write to (and read from) the primary?"""
+        res = self.client.post('/users')
+        self.assertEqual(res.get_json(), ['on-primary', 'written'])
+
+    def test_read_your_writes(self):
+        """After writing, does the same user read from the primary for a while?"""
+        with self.client as client:
+            client.post('/users')
+            res = client.get('/users')
+            self.assertEqual(res.get_json(), ['on-primary', 'written'])
+
+            # Once the sticky window passes, reads go back to the replica
+            with client.session_transaction() as session:
+                session[LAST_WRITE_KEY] = time.time() - 60
+            res = client.get('/users')
+            self.assertEqual(res.get_json(), ['on-replica'])
+
+        # Other users aren't affected by someone else's write
+        res = self.app.test_client().get('/users')
+        self.assertEqual(res.get_json(), ['on-replica'])
@@ -0,0 +1,206 @@
+"""Entity cache tests."""
+
+# run these tests like:
+#
+# FLASK_ENV=production python -m unittest test_entity_cache.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from testing import DatabaseTestCase  # before app: picks the test database
+from models import db, User, Message, Follows, Likes
+
+from app import app, CURR_USER_KEY
+from cache import Cache, LRUCache
+from entity_cache import EntityCache, UserSnapshot, entity_cache, expire
+from metrics import metrics
+from sharding import message_shards
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class EntityCacheTestCase(TestCase):
+    """Test read-through lookups with a stand-in loader."""
+
+    def setUp(self):
+        self.loads = []
+
+        def load(ids):
+            self.loads.append(sorted(ids))
+            return {i: f'entity {i}' for i in ids if i < 100}
+
+        self.cache = EntityCache(Cache(local=LRUCache(100)), {User: load})
+
+    def test_loads_only_misses(self):
+        """Are cached ids served from the cache, and the rest loaded at once?"""
+        self.assertEqual(self.cache.get(User, 1), 'entity 1')
+        self.assertEqual(self.cache.get_many(User, [1, 2, 3]),
+                         {1: 'entity 1', 2: 'entity 2', 3: 'entity 3'})
+        self.assertEqual(self.loads, [[1], [2, 3]])
+
+        self.cache.get_many(User, [1, 2, 3])
+        self.assertEqual(len(self.loads), 2)
+        self.assertEqual(self.cache.get_many(User, []), {})
+
+    def test_missing_rows_arent_cached(self):
+        """Is an id that doesn't exist looked up again next time?"""
+        self.assertIsNone(self.cache.get(User, 500))
+        self.assertIsNone(self.cache.get(User, 500))
+        self.assertEqual(self.loads, [[500], [500]])
+
+    def test_forget(self):
+        """Does forget() make the next lookup load the row again?"""
+        self.cache.get(User, 1)
+        self.cache.forget(User, [1])
+        self.cache.get(User, 1)
+        self.assertEqual(self.loads, [[1], [1]])
+
+
+class EntityCacheAppTestCase(DatabaseTestCase):
+    """Test snapshots of real rows, invalidation on commit and the views."""
+
+    def setUp(self):
+        super().setUp()
+        app.extensions['cache'].clear()
+        metrics.reset()
+        self.client = app.test_client()
+
+        users = [User.signup(f'snap{i}', f'snap{i}@test.com', 'password', None)
+                 for i in range(3)]
+        for i, user in enumerate(users):
+            user.id = 3000 + i
+        db.session.commit()
+        self.user_ids = [user.id for user in users]
+
+    def loads(self, model):
+        return metrics.value('entity_cache_loads_total', model=model.__name__)
+
+    def login(self, user_id):
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = user_id
+
+    def test_snapshots(self):
+        """Are users cached as immutable snapshots, fetched in one query?"""
+        with app.app_context():
+            users = entity_cache().get_many(User, self.user_ids + [999999])
+            again = entity_cache().get_many(User, self.user_ids)
+
+        self.assertEqual(sorted(users), self.user_ids)
+        self.assertIsInstance(users[3000], UserSnapshot)
+        self.assertEqual(users[3000].username, 'snap0')
+        self.assertEqual(again, users)
+        self.assertEqual(self.loads(User), len(self.user_ids) + 1)
+        with self.assertRaises(AttributeError):
+            users[3000].username = 'changed'
+
+    def test_invalidated_on_commit(self):
+        """Does a change reach the cache when it commits, and not before?"""
+        with app.app_context():
+            entity_cache().get(User, 3000)
+            user = User.query.get(3000)
+            user.username = 'renamed'
+            db.session.flush()
+            self.assertEqual(entity_cache().get(User, 3000).username, 'snap0')
+
+            db.session.rollback()
+            user = User.query.get(3000)
+            self.assertEqual(entity_cache().get(User, 3000).username, 'snap0')
+
+            user.username = 'renamed'
+            db.session.commit()
+            self.assertEqual(entity_cache().get(User, 3000).username, 'renamed')
+
+    def test_expire_messages(self):
+        """Is a message deleted outside the ORM dropped when the delete commits?"""
+        with app.app_context():
+            row = message_shards().add(3000, 'cached warble')
+            db.session.commit()
+            self.assertEqual(entity_cache().get(Message, row.id).text, 'cached warble')
+
+            message_shards().delete(row.id, 3000)
+            expire(Message, [row.id])
+            db.session.commit()
+            self.assertIsNone(entity_cache().get(Message, row.id))
+
+    def test_profile_page(self):
+        """Does the profile page show the cached user and live counts?"""
+        db.session.add_all([
+            Follows(user_following_id=3000, user_being_followed_id=3001),
+            Follows(user_following_id=3000, user_being_followed_id=3002),
+            Follows(user_following_id=3001, user_being_followed_id=3000)])
+        message = Message(text='likeable', user_id=3001)
+        db.session.add(message)
+        db.session.commit()
+        db.session.add(Likes(user_id=3000, message_id=message.id))
+        db.session.commit()
+
+        self.login(3001)
+        res = self.client.get('/users/3000')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'@snap0', res.data)
+        self.assertIn(b'/users/3000/following">2</a>', res.data)
+        self.assertIn(b'/users/3000/followers">1</a>', res.data)
+        self.assertIn(b'/users/3000/likes">1</a>', res.data)
+        self.assertIn(b'Unfollow', res.data)
+
+        User.query.get(3000).bio = 'fresh bio'
+        db.session.commit()
+        self.assertIn(b'fresh bio', self.client.get('/users/3000').data)
+
+        User.query.get(3000).deleted_at = db.func.now()
+        db.session.commit()
+        self.assertEqual(self.client.get('/users/3000').status_code, 404)
+
+    def test_timeline_authors(self):
+        """Are a feed's authors loaded once, then served from the cache?"""
+        db.session.add(Follows(user_following_id=3000, user_being_followed_id=3001))
+        db.session.commit()
+        with app.app_context():
+            for user_id in self.user_ids[:2]:
+                message_shards().add(user_id, f'warble by {user_id}')
+            db.session.commit()
+
+        self.login(3000)
+        for _ in range(3):
+            res = self.client.get('/')
+            self.assertIn(b'@snap1', res.data)
+        self.assertEqual(self.loads(User), 2)
+
+    def test_misses_load_from_primary(self):
+        """During a GET routed to a replica, are misses still loaded from
+        the primary, so a lagging replica's rows aren't cached?"""
+        # An empty replica: as far behind as a replica can be
+        replica = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'r.db')}")
+        db.metadata.create_all(bind=replica)
+        app.extensions['db_replicas'] = [replica]
+        db.session.remove()    # forget setUp's writes, which pin the primary
+        try:
+            res = self.client.get('/users/3000')
+        finally:
+            app.extensions['db_replicas'] = []
+            replica.dispose()
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'@snap0', res.data)
+
+    def test_cached_messages_load_from_primary(self):
+        """During a GET routed to a replica, are a profile's messages and
+        message count, which are cached, read from the primary?"""
+        with app.app_context():
+            message_shards().add(3000, 'fresh warble')
+            db.session.commit()
+        replica = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'r.db')}")
+        db.metadata.create_all(bind=replica)
+        app.extensions['db_replicas'] = [replica]
+        db.session.remove()
+        try:
+            res = self.client.get('/users/3000')
+        finally:
+            app.extensions['db_replicas'] = []
+            replica.dispose()
+        self.assertIn(b'fresh warble', res.data)
+        self.assertIn(b'<a href="/users/3000">1</a>', res.data)
+        # and what was cached is what the primary holds
+        self.assertIn(b'fresh warble', self.client.get('/users/3000').data)
@@ -0,0 +1,171 @@
+"""Data export tests."""
+
+# run these tests like:
+#
+# FLASK_ENV=production python -m unittest test_exports.py
+
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import zipfile
+from unittest import TestCase
+
+from testing import DatabaseTestCase  # before app: picks the test database
+from models import db, User, Message, Follows, Likes, Export
+
+from app import app, CURR_USER_KEY
+from exports import write_rows, dump_site
+from jobs import run_pending
+from sharding import message_shards
+from test_sharding import make_app as make_sharded_app
+
+
+def read_csv(archive, name):
+    with archive.open(name) as member:
+        return list(csv.DictReader(io.TextIOWrapper(member, encoding='utf-8')))
+
+
+class UserExportTestCase(DatabaseTestCase):
+    """Test requesting, building and downloading an account export."""
+
+    def setUp(self):
+        super().setUp()
+        app.config['EXPORT_DIR'] = tempfile.mkdtemp()
+        self.client = app.test_client()
+
+        for i, name in enumerate(('exporter', 'friend', 'fan')):
+            user = User.signup(name, f'{name}@test.com', 'password', None)
+            user.id = 3000 + i
+        db.session.commit()
+        messages = [Message(text=f'warble, "{n}"', user_id=3000) for n in range(3)]
+        liked = Message(text='liked', user_id=3001)
+        db.session.add_all(messages + [liked])
+        db.session.add_all([Follows(user_following_id=3000, user_being_followed_id=3001),
+                            Follows(user_following_id=3002, user_being_followed_id=3000)])
+        db.session.commit()
+        db.session.add(Likes(user_id=3000, message_id=liked.id))
+        db.session.commit()
+        self.message_ids = [m.id for m in messages]
+        self.liked_id = liked.id
+
+    def tearDown(self):
+        del app.config['EXPORT_DIR']
+        super().tearDown()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = user_id
+
+    def export(self, fmt):
+        self.login(3000)
+        self.client.post('/users/exports', data={'format': fmt})
+        with app.app_context():
+            self.assertEqual(run_pending(), 1)
+        export = Export.query.filter_by(user_id=3000).one()
+        self.assertEqual(export.status, 'done')
+        res = self.client.get(f'/users/exports/{export.id}/download')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('attachment', res.headers['Content-Disposition'])
+        return export, zipfile.ZipFile(io.BytesIO(res.data))
+
+    def test_csv_export(self):
+        """Does the archive hold the user's messages, likes and follows?"""
+        export, archive = self.export('csv')
+        self.assertEqual(sorted(archive.namelist()),
+                         ['followers.csv', 'following.csv', 'likes.csv', 'messages.csv',
+                          'profile.json'])
+
+        profile = json.loads(archive.read('profile.json'))
+        self.assertEqual(profile['username'], 'exporter')
+        self.assertNotIn('password', profile)
+
+        messages = read_csv(archive, 'messages.csv')
+        self.assertEqual([int(m['id']) for m in messages], self.message_ids)
+        self.assertEqual(messages[0]['text'], 'warble, "0"')
+        self.assertEqual(read_csv(archive, 'likes.csv'),
+                         [{'message_id': str(self.liked_id)}])
+        self.assertEqual(read_csv(archive, 'following.csv'),
+                         [{'id': '3001', 'username': 'friend'}])
+        self.assertEqual(read_csv(archive, 'followers.csv'),
+                         [{'id': '3002', 'username': 'fan'}])
+
+        page = self.client.get('/users/exports')
+        self.assertIn(f'/users/exports/{export.id}/download'.encode(), page.data)
+
+    def test_ndjson_export(self):
+        """Are tables written one JSON object per line?"""
+        _, archive = self.export('ndjson')
+        lines = archive.read('messages.jsonl').decode().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], self.message_ids)
+
+    def test_pending_export_reused(self):
+        """Does asking twice while one is pending enqueue only one?"""
+        self.login(3000)
+        self.client.post('/users/exports', data={'format': 'csv'})
+        self.client.post('/users/exports', data={'format': 'csv'})
+        self.assertEqual(Export.query.count(), 1)
+        self.assertIn(b'Preparing', self.client.get('/users/exports').data)
+
+    def test_filename_from_ids(self):
+        """Is the archive named by ids, whatever the username holds?"""
+        User.query.get(3000).username = '../../x"\u00fc'
+        db.session.commit()
+        export, _ = self.export('csv')
+        self.assertEqual(export.filename, f'warbler-3000-{export.id}.zip')
+        self.assertEqual(os.listdir(app.config['EXPORT_DIR']), [export.filename])
+
+    def test_download_is_private(self):
+        """Can only the owner download an export?"""
+        export, _ = self.export('csv')
+        self.login(3001)
+        res = self.client.get(f'/users/exports/{export.id}/download')
+        self.assertEqual(res.status_code, 404)
+
+
+class WriteRowsTestCase(TestCase):
+    """Test the row writers on their own."""
+
+    def test_streams_any_iterable(self):
+        """Are rows consumed lazily from a generator?"""
+        out = io.BytesIO()
+        rows = ((n, f'row {n}') for n in range(5000))
+        self.assertEqual(write_rows(out, 'csv', ('id', 'text'), rows), 5000)
+        lines = out.getvalue().decode().splitlines()
+        self.assertEqual((lines[0], lines[-1]), ('id,text', '4999,row 4999'))
+
+
+class SiteDumpTestCase(TestCase):
+    """Test full-site dumps, with messages on two shards."""
+
+    def test_dump_site(self):
+        """Is every table, and each shard's messages, dumped with counts?"""
+        tmp = tempfile.mkdtemp()
+        shard_app = make_sharded_app(tmp, shard_count=2)
+        with shard_app.app_context():
+            db.create_all()
+            shards = message_shards()
+            shards.create_schema()
+            users = [User(username=f'u{i}', email=f'u{i}@test.com', password='secret')
+                     for i in range(4)]
+            db.session.add_all(users)
+            db.session.commit()
+            for user in users:
+                shards.add(user.id, f'by {user.username}')
+
+            out = os.path.join(tmp, 'dump')
+            rows = dump_site(out, 'csv', workers=3)
+            db.session.remove()
+            for engine in shards.engines + [db.engine]:
+                engine.dispose()
+
+        self.assertEqual(rows['users'], 4)
+        self.assertEqual(rows['messages-shard0'] + rows['messages-shard1'], 4)
+        self.assertEqual(json.load(open(os.path.join(out, 'manifest.json')))['rows'], rows)
+
+        with gzip.open(os.path.join(out, 'users.csv.gz'), 'rt') as f:
+            dumped = list(csv.DictReader(f))
+        self.assertEqual(len(dumped), 4)
+        self.assertNotIn('password', dumped[0])
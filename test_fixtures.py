@@ -0,0 +1,85 @@
+"""Tests for the shared test fixtures in testing.py."""
+
+# run these tests like:
+#
+# FLASK_ENV=production python -m unittest test_fixtures.py
+
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from testing import DatabaseTestCase, snapshot_database, suffixed_url
+from models import db, User
+
+from app import app
+
+
+def add_user(username):
+    db.session.add(User(username=username, email=f'{username}@test.com',
+                        password='x'))
+    db.session.commit()
+
+
+class DatabaseTestCaseTestCase(DatabaseTestCase):
+    """Test that each test's changes are rolled back."""
+
+    # Both tests commit the same user; whichever runs second would fail on
+    # the unique username if the first one's commit had leaked.
+
+    def test_commit_is_rolled_back(self):
+        """Does a committed row disappear after the test?"""
+        self.assertEqual(User.query.count(), 0)
+        add_user('fixture')
+        self.assertEqual(User.query.count(), 1)
+
+    def test_commit_is_rolled_back_again(self):
+        """Does a committed row disappear after the test?"""
+        self.assertEqual(User.query.count(), 0)
+        add_user('fixture')
+        self.assertEqual(User.query.count(), 1)
+
+    def test_rollback_keeps_earlier_commits(self):
+        """Does rolling back (e.g. after an IntegrityError) keep committed rows?"""
+        add_user('kept')
+        db.session.add(User(username='kept', email='dupe@test.com', password='x'))
+        with self.assertRaises(Exception):
+            db.session.commit()
+        db.session.rollback()
+        self.assertEqual([u.username for u in User.query.all()], ['kept'])
+
+    def test_requests_share_the_transaction(self):
+        """Do views see the test's data, and the test the views' commits?"""
+        add_user('viewer')
+        with app.test_client() as client:
+            res = client.get('/users')
+        self.assertIn(b'@viewer', res.data)
+
+
+def seed_users(conn):
+    conn.execute(User.__table__.insert(), [
+        {'username': f'seed{i}', 'email': f'seed{i}@test.com', 'password': 'x'}
+        for i in range(50)])
+
+
+class SnapshotTestCase(TestCase):
+    """Test pre-seeded database snapshots."""
+
+    def test_copies_are_independent(self):
+        """Does each call hand back its own copy of the seeded data?"""
+        first = create_engine(snapshot_database('users', seed_users))
+        second = create_engine(snapshot_database('users', seed_users))
+        try:
+            first.execute(User.__table__.delete())
+            self.assertEqual(first.execute('SELECT count(*) FROM users').scalar(), 0)
+            self.assertEqual(second.execute('SELECT count(*) FROM users').scalar(), 50)
+        finally:
+            first.dispose()
+            second.dispose()
+
+    def test_suffixed_url(self):
+        """Does each worker get its own database name?"""
+        self.assertEqual(suffixed_url('postgresql:///warbler', 'gw1'),
+                         'postgresql:///warbler-gw1')
+        self.assertEqual(suffixed_url('sqlite:////tmp/t.db', 'gw1'),
+                         'sqlite:////tmp/t-gw1.db')
+        self.assertEqual(suffixed_url('sqlite:////tmp/t.db', ''), 'sqlite:////tmp/t.db')
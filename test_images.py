@@ -0,0 +1,268 @@
+"""Image proxy and thumbnail cache tests."""
+
+# run these tests like:
+#
+# python -m unittest test_images.py
+
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+from flask import Flask, render_template_string
+from werkzeug.datastructures import FileStorage
+
+import testing  # noqa: F401 (before app: picks the test database)
+from app import app, create_app
+
+from assets import IMMUTABLE_CACHE_CONTROL
+from images import (connect_images, save_upload, thumbnail_url, ImageError,
+                    ThumbnailStore, FALLBACK_CACHE_CONTROL, Image)
+from models import db
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def png_bytes(width, height, color=(200, 30, 30)):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(out, 'PNG')
+    return out.getvalue()
+
+
+class StandInServer:
+    """Local HTTP server for the proxy to fetch from; counts requests."""
+
+    def __init__(self, files, redirects=None):
+        self.files = files
+        self.redirects = redirects or {}
+        self.hits = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.hits.append(self.path)
+                if self.path in stand_in.redirects:
+                    self.send_response(302)
+                    self.send_header('Location', stand_in.redirects[self.path])
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if self.path not in stand_in.files:
+                    self.send_error(404)
+                    return
+                content = stand_in.files[self.path]
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def url(self, path, host='127.0.0.1'):
+        return f'http://{host}:{self.server.server_port}{path}'
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_app(**config):
+    app = Flask(__name__, static_folder=os.path.join(ROOT, 'static'))
+    app.config.update(SECRET_KEY='test', IMAGE_PROXY_ALLOW_PRIVATE=True,
+                      IMAGE_CACHE_DIR=tempfile.mkdtemp(),
+                      IMAGE_UPLOAD_DIR=tempfile.mkdtemp())
+    app.config.update(config)
+    connect_images(app)
+    return app
+
+
+@skipIf(Image is None, "needs Pillow")
+class ImageProxyTestCase(TestCase):
+    """Test fetching, resizing and serving thumbnails."""
+
+    def setUp(self):
+        self.remote = StandInServer({'/big.png': png_bytes(1200, 900),
+                                     '/page.html': b'<script>alert(1)</script>'})
+        self.app = make_app()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.remote.close()
+
+    def thumbnail(self, url, size):
+        with self.app.test_request_context():
+            return self.client.get(thumbnail_url(url, size))
+
+    def test_resizes_and_caches(self):
+        """Is the source fetched once and served at the thumbnail size?"""
+        res = self.thumbnail(self.remote.url('/big.png'), 'timeline')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Cache-Control'], IMMUTABLE_CACHE_CONTROL)
+        self.assertEqual(Image.open(io.BytesIO(res.data)).size, (96, 96))
+
+        again = self.thumbnail(self.remote.url('/big.png'), 'timeline')
+        self.assertEqual(again.data, res.data)
+        self.assertEqual(self.remote.hits, ['/big.png'])
+
+        header = self.thumbnail(self.remote.url('/big.png'), 'header')
+        self.assertEqual(Image.open(io.BytesIO(header.data)).size, (1500, 500))
+
+    def test_static_sources(self):
+        """Are /static/ images (the defaults) resized without HTTP?"""
+        res = self.thumbnail(None, 'avatar')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Image.open(io.BytesIO(res.data)).size, (400, 400))
+
+    def test_unusable_source_gets_default(self):
+        """Do broken or non-image sources fall back, briefly cached?"""
+        for path in ('/missing.png', '/page.html'):
+            res = self.thumbnail(self.remote.url(path), 'avatar')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.headers['Cache-Control'], FALLBACK_CACHE_CONTROL)
+            self.assertEqual(res.mimetype, 'image/png')
+
+    def test_rejects_unsigned_urls(self):
+        """Can the route only fetch URLs the app signed?"""
+        self.assertEqual(self.client.get('/images/avatar/not-a-token').status_code, 404)
+        with self.app.test_request_context():
+            url = thumbnail_url(self.remote.url('/big.png'), 'avatar')
+        self.assertEqual(self.client.get(url.replace('avatar', 'huge')).status_code, 404)
+
+    def test_private_hosts_refused(self):
+        """Are loopback/private addresses off limits by default?"""
+        app = make_app(IMAGE_PROXY_ALLOW_PRIVATE=False)
+        with app.test_request_context():
+            res = app.test_client().get(thumbnail_url(self.remote.url('/big.png'), 'avatar'))
+        self.assertEqual(res.headers['Cache-Control'], FALLBACK_CACHE_CONTROL)
+        self.assertEqual(self.remote.hits, [])
+
+    def public_app(self, answers):
+        """An app refusing private hosts, where only the stand-in counts as
+        public and images.test resolves to each of `answers` in turn."""
+
+        getaddrinfo = socket.getaddrinfo
+
+        def resolve(host, port, *args, **kwargs):
+            if host == 'images.test':
+                host = answers.pop(0) if len(answers) > 1 else answers[0]
+            return getaddrinfo(host, port, *args, **kwargs)
+
+        loopback = ipaddress.ip_address('127.0.0.1')
+        for patcher in (patch('images.socket.getaddrinfo', resolve),
+                        patch('images._is_public', lambda ip: ip == loopback)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return make_app(IMAGE_PROXY_ALLOW_PRIVATE=False)
+
+    def test_connects_to_checked_address(self):
+        """Is the address that passed the check the one fetched from, even
+        if the name resolves elsewhere by then?"""
+        app = self.public_app(['127.0.0.1', '10.255.255.1'])
+        with app.test_request_context():
+            url = thumbnail_url(self.remote.url('/big.png', host='images.test'), 'avatar')
+        res = app.test_client().get(url)
+        self.assertEqual(res.headers['Cache-Control'], IMMUTABLE_CACHE_CONTROL)
+        self.assertEqual(self.remote.hits, ['/big.png'])
+
+    def test_redirects_checked(self):
+        """Is every redirect hop checked, so a public URL can't bounce the
+        proxy to a private address?"""
+        self.remote.redirects.update({
+            '/moved.png': '/big.png',
+            '/metadata.png': 'http://169.254.169.254/latest/meta-data/',
+        })
+        app = self.public_app(['127.0.0.1'])
+        with app.test_request_context():
+            moved = thumbnail_url(self.remote.url('/moved.png'), 'avatar')
+            metadata = thumbnail_url(self.remote.url('/metadata.png'), 'avatar')
+        client = app.test_client()
+
+        self.assertEqual(client.get(moved).headers['Cache-Control'],
+                         IMMUTABLE_CACHE_CONTROL)
+        self.assertEqual(client.get(metadata).headers['Cache-Control'],
+                         FALLBACK_CACHE_CONTROL)
+        self.assertEqual(self.remote.hits, ['/moved.png', '/big.png', '/metadata.png'])
+
+    def test_uploads(self):
+        """Are uploads stored by content and usable as thumbnail sources?"""
+        content = png_bytes(50, 80)
+        with self.app.test_request_context():
+            url = save_upload(FileStorage(io.BytesIO(content), 'me.png'))
+            self.assertEqual(url, save_upload(FileStorage(io.BytesIO(content), 'x.png')))
+            with self.assertRaises(ImageError):
+                save_upload(FileStorage(io.BytesIO(b'<html>'), 'me.png'))
+
+        res = self.client.get(url)
+        self.assertEqual(res.data, content)
+        self.assertEqual(res.headers['Cache-Control'], IMMUTABLE_CACHE_CONTROL)
+        self.assertEqual(Image.open(io.BytesIO(self.thumbnail(url, 'avatar').data)).size,
+                         (400, 400))
+
+    def test_templates_use_thumbnails(self):
+        """Does thumbnail_url give templates a proxied URL?"""
+        with self.app.test_request_context():
+            html = render_template_string(
+                "<img src=\"{{ thumbnail_url(url, 'timeline') }}\">",
+                url=self.remote.url('/big.png'))
+        self.assertIn('src="/images/timeline/', html)
+        self.assertNotIn('127.0.0.1', html)
+
+
+class ThumbnailStoreTestCase(TestCase):
+    """Test the content-addressed store and its eviction."""
+
+    def setUp(self):
+        self.store = ThumbnailStore(tempfile.mkdtemp(), max_bytes=3000)
+
+    def test_shares_identical_content(self):
+        """Do two keys with the same thumbnail share one blob?"""
+        self.assertEqual(self.store.put('a', b'x' * 10, 'png'),
+                         self.store.put('b', b'x' * 10, 'png'))
+
+    def test_evicts_least_recently_used(self):
+        """Does going over max_bytes drop the least recently served blobs?"""
+        first = self.store.put('first', b'1' * 1000, 'png')
+        second = self.store.put('second', b'2' * 1000, 'png')
+        os.utime(first, (1, 1))
+        os.utime(second, (2, 2))
+        self.assertEqual(self.store.get('first'), first)   # touches it
+
+        self.store.put('third', b'3' * 1500, 'png')
+        self.assertIsNone(self.store.get('second'))
+        self.assertIsNotNone(self.store.get('first'))
+        self.assertIsNotNone(self.store.get('third'))
+
+
+@skipIf(Image is None, "needs Pillow")
+class ImageHeadersInAppTestCase(TestCase):
+    """Test the image routes' caching headers in the full app."""
+
+    def tearDown(self):
+        # create_app() points the shared `db` at the new app; undo that
+        db.app = app
+
+    def test_immutable_caching_survives(self):
+        """Do thumbnails and uploads keep their immutable caching headers?"""
+        warbler = create_app({'IMAGE_CACHE_DIR': tempfile.mkdtemp(),
+                              'IMAGE_UPLOAD_DIR': tempfile.mkdtemp(),
+                              'ADMISSION_ENABLED': False})
+        client = warbler.test_client()
+        with warbler.test_request_context():
+            thumbnail = thumbnail_url(None, 'avatar')
+            original = save_upload(FileStorage(io.BytesIO(png_bytes(20, 20)), 'a.png'))
+
+        for url in (thumbnail, original):
+            res = client.get(url)
+            self.assertEqual(res.status_code, 200, url)
+            self.assertEqual(res.headers['Cache-Control'], IMMUTABLE_CACHE_CONTROL, url)
+            self.assertNotIn('Pragma', res.headers)
+            self.assertNotEqual(res.headers.get('Expires'), '0')
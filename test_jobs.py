@@ -0,0 +1,99 @@
+"""Job queue tests."""
+
+# run these tests like:
+#
+# FLASK_ENV=production python -m unittest test_jobs.py
+
+from datetime import datetime, timedelta
+
+from testing import DatabaseTestCase  # before app: picks the test database
+from models import db, Job
+
+from app import app
+from jobs import enqueue, claim, run_pending, job_handler
+from metrics import metrics
+
+calls = []
+
+
+@job_handler('test.record')
+def record(payload):
+    calls.append(payload['n'])
+
+
+@job_handler('test.explode')
+def explode(payload):
+    raise ValueError("boom")
+
+
+class JobQueueTestCase(DatabaseTestCase):
+    """Test enqueueing, running and retrying jobs."""
+
+    def setUp(self):
+        super().setUp()
+        calls.clear()
+
+    def test_run_pending(self):
+        """Are queued jobs run once and marked done?"""
+        enqueue('test.record', {'n': 1})
+        enqueue('test.record', {'n': 2})
+        db.session.commit()
+
+        self.assertEqual(run_pending(), 2)
+        self.assertEqual(sorted(calls), [1, 2])
+        self.assertEqual(Job.query.filter_by(status='done').count(), 2)
+
+        self.assertEqual(run_pending(), 0)
+        self.assertEqual(len(calls), 2)
+
+    def test_idempotency_key(self):
+        """Is a job with a repeated idempotency key stored only once?"""
+        self.assertIsNotNone(enqueue('test.record', {'n': 1}, idempotency_key='k'))
+        db.session.commit()
+        self.assertIsNone(enqueue('test.record', {'n': 1}, idempotency_key='k'))
+        db.session.commit()
+
+        self.assertEqual(Job.query.count(), 1)
+
+    def test_retry_then_fail(self):
+        """Are failing jobs retried with backoff, then marked failed?"""
+        job = enqueue('test.explode', max_attempts=2)
+        db.session.commit()
+        job_id = job.id
+
+        run_pending()
+        job = Job.query.get(job_id)
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('boom', job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        # Not due yet
+        self.assertEqual(run_pending(), 0)
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        run_pending()
+        self.assertEqual(Job.query.get(job_id).status, 'failed')
+
+    def test_expired_lease_is_reclaimed(self):
+        """Does a job whose worker vanished become claimable again?"""
+        enqueue('test.record', {'n': 7})
+        db.session.commit()
+
+        [job] = claim('dead-worker', lease=timedelta(seconds=-1))
+        self.assertEqual(job.status, 'running')
+
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(calls, [7])
+        self.assertEqual(Job.query.get(job.id).attempts, 2)
+
+    def test_queue_metrics(self):
+        """Are queue depth and lag exposed at /metrics?"""
+        enqueue('test.record', {'n': 1}, run_at=datetime.utcnow() - timedelta(seconds=30))
+        db.session.commit()
+
+        res = app.test_client().get('/metrics', headers={'Accept-Encoding': 'identity'})
+        body = res.data.decode()
+        self.assertIn('jobs_queue_depth{status="queued"} 1', body)
+        self.assertGreaterEqual(metrics.value('jobs_lag_seconds'), 30)
@@ -0,0 +1,153 @@
+"""Message id generator tests."""
+
+# run these tests like:
+#
+# python -m unittest test_message_ids.py
+
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, event, select
+
+from message_ids import (IdGenerator, WorkerLeases, timestamp_of, lowest_id, EPOCH,
+                         MAX_SEQUENCE, SEQUENCE_BITS)
+from models import MessageIdWorker
+
+
+class SteppingClock:
+    """Returns the given times in turn, then keeps returning the last."""
+
+    def __init__(self, *times):
+        self.times = list(times)
+
+    def __call__(self):
+        return self.times.pop(0) if len(self.times) > 1 else self.times[0]
+
+
+class IdGeneratorTestCase(TestCase):
+    """Test id layout, ordering and uniqueness."""
+
+    def test_layout_round_trips(self):
+        """Does an id carry its worker and issue time?"""
+        moment = datetime(2024, 5, 6, 7, 8, 9, 123000)
+        clock = SteppingClock((moment - datetime(1970, 1, 1)).total_seconds())
+        message_id = IdGenerator(worker_id=5, clock=clock).next_id()
+
+        self.assertEqual(timestamp_of(message_id), moment)
+        self.assertEqual((message_id >> SEQUENCE_BITS) & 1023, 5)
+        self.assertEqual(lowest_id(moment), message_id - (5 << SEQUENCE_BITS))
+        self.assertEqual(lowest_id(EPOCH), 0)
+        self.assertLess(message_id, 1 << 63)
+
+    def test_ids_increase(self):
+        """Are a process's ids unique and increasing?"""
+        generator = IdGenerator(worker_id=1)
+        ids = [generator.next_id() for _ in range(20000)]
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_sequence_overflow_waits_for_next_millisecond(self):
+        """After 4096 ids in one millisecond, does it move to the next one?"""
+        start = time.time()
+        clock = SteppingClock(*[start] * (MAX_SEQUENCE + 3), start + 0.002)
+        generator = IdGenerator(worker_id=1, clock=clock)
+        ids = [generator.next_id() for _ in range(MAX_SEQUENCE + 2)]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertGreater(timestamp_of(ids[-1]), timestamp_of(ids[0]))
+
+    def test_clock_stepping_back(self):
+        """Do ids keep increasing if the clock goes backwards?"""
+        start = time.time()
+        generator = IdGenerator(worker_id=1, clock=SteppingClock(start, start - 5))
+        first, second = generator.next_id(), generator.next_id()
+        self.assertGreater(second, first)
+
+    def test_forked_process_gets_new_worker(self):
+        """Is a derived worker id re-derived in a forked child, and a
+        configured one kept?"""
+        derived, configured = IdGenerator(), IdGenerator(worker_id=3)
+        for generator in (derived, configured):
+            generator.next_id()
+            generator._pid = -1    # as if this were a forked child
+
+        with patch('message_ids.default_worker_id', return_value=7):
+            self.assertEqual((derived.next_id() >> SEQUENCE_BITS) & 1023, 7)
+            self.assertEqual((configured.next_id() >> SEQUENCE_BITS) & 1023, 3)
+
+        with self.assertRaises(ValueError):
+            IdGenerator(worker_id=1024)
+
+
+class WorkerLeasesTestCase(TestCase):
+    """Test leasing worker ids so no two processes share one."""
+
+    def setUp(self):
+        path = os.path.join(tempfile.mkdtemp(), 'leases.db')
+        self.engine = create_engine(f'sqlite:///{path}')
+        MessageIdWorker.__table__.create(bind=self.engine)
+        self.leases = WorkerLeases(lambda: self.engine, MessageIdWorker.__table__)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def expire(self, worker_id):
+        table = MessageIdWorker.__table__
+        self.engine.execute(table.update()
+                            .where(table.c.worker_id == worker_id)
+                            .values(locked_until=datetime.utcnow() - timedelta(seconds=1)))
+
+    def test_distinct_ids(self):
+        """Does each owner get its own id, and keep it when renewing?"""
+        first = self.leases.acquire('host:1')
+        second = self.leases.acquire('host:2')
+        self.assertEqual((first, second), (0, 1))
+        self.assertEqual(self.leases.acquire('host:1', first), first)
+
+    def test_expired_lease_taken_over(self):
+        """Is an expired id leased again, and its old holder moved to
+        another one?"""
+        first = self.leases.acquire('host:1')
+        self.expire(first)
+        self.assertEqual(self.leases.acquire('host:2'), first)
+        self.assertNotEqual(self.leases.acquire('host:1', first), first)
+
+    def test_lease_taken_between_statements(self):
+        """If another process leases the id this one picked after it looked,
+        is that lease kept, and another id taken here?"""
+        table = MessageIdWorker.__table__
+        other = create_engine(self.engine.url)
+        self.addCleanup(other.dispose)
+
+        def take_first(conn, cursor, statement, *args):
+            if statement.startswith('DELETE') and not taken:
+                taken.append(True)
+                other.execute(table.insert().values(
+                    worker_id=0, locked_by='host:other',
+                    locked_until=datetime.utcnow() + timedelta(minutes=5)))
+
+        taken = []
+        event.listen(self.engine, 'before_cursor_execute', take_first)
+        self.assertEqual(self.leases.acquire('host:1'), 1)
+        self.assertTrue(taken)
+        owners = {row.worker_id: row.locked_by
+                  for row in self.engine.execute(select([table]))}
+        self.assertEqual(owners, {0: 'host:other', 1: 'host:1'})
+
+    def test_generator_leases_per_process(self):
+        """Does a generator issue ids under its leased worker, and keep them
+        increasing when the lease is lost?"""
+        generator = IdGenerator(leases=self.leases)
+        other = IdGenerator(leases=self.leases)
+        first, other_id = generator.next_id(), other.next_id()
+        self.assertEqual((first >> SEQUENCE_BITS) & 1023, 0)
+        self.assertEqual((other_id >> SEQUENCE_BITS) & 1023, 1)
+
+        self.expire(0)
+        self.leases.acquire('host:3')    # takes worker 0
+        generator._renew_at = 0
+        second = generator.next_id()
+        self.assertEqual((second >> SEQUENCE_BITS) & 1023, 2)
+        self.assertGreater(second, first)
@@ -0,0 +1,115 @@
+"""Hashtag and mention index tests."""
+
+# run these tests like:
+#
+# FLASK_ENV=production python -m unittest test_message_index.py
+
+from datetime import datetime, timedelta
+
+from testing import DatabaseTestCase  # before app: picks the test database
+from models import db, User, Message, MessageTag, Mention, Tag
+
+from app import app, CURR_USER_KEY
+from jobs import run_pending
+from message_index import parse, tag_feed, mention_feed, enqueue_backfill, link_tags
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class MessageIndexTestCase(DatabaseTestCase):
+    """Test indexing tags and mentions and reading their feeds."""
+
+    def setUp(self):
+        super().setUp()
+        app.extensions['cache'].clear()
+        self.client = app.test_client()
+
+        self.alice = User.signup('alice', 'alice@test.com', 'password', None)
+        self.bob = User.signup('bob.smith', 'bob@test.com', 'password', None)
+        self.alice.id, self.bob.id = 1001, 1002
+        db.session.commit()
+
+    def post(self, text, user_id=1001):
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = user_id
+        return self.client.post('/messages/new', data={'text': text})
+
+    def test_parse(self):
+        """Are tags lowercased and mentions stripped of trailing dots?"""
+        self.assertEqual(parse('#Flask and #flask, ##x, a#b @bob.smith. x@y.com'),
+                         (['flask'], ['bob.smith']))
+
+    def test_post_indexes_message(self):
+        """Does posting a message record its tags and mentions?"""
+        self.post('Hi @bob.smith, try #Python and #sql @nobody')
+        message = Message.query.one()
+
+        self.assertEqual(sorted(name for (name,) in db.session.query(Tag.name)),
+                         ['python', 'sql'])
+        self.assertEqual({(m.user_id, m.message_id, m.author_id) for m in Mention.query},
+                         {(1002, message.id, 1001)})
+
+        res = self.client.get('/tags/PYTHON')
+        self.assertIn(b'try <a href="/tags/python">#Python</a>', res.data)
+        res = self.client.get('/users/1002/mentions')
+        self.assertIn(b'Mentioning @bob.smith', res.data)
+        self.assertIn(b'/messages/%d' % message.id, res.data)
+
+    def test_delete_unindexes_message(self):
+        """Are a deleted message's index entries removed?"""
+        self.post('bye #gone @bob.smith')
+        message = Message.query.one()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = 1001
+        self.client.post(f'/messages/{message.id}/delete')
+
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(Mention.query.count(), 0)
+        with app.app_context():
+            self.assertEqual(tag_feed('gone'), ([], None))
+
+    def test_feeds_keyset_paginated(self):
+        """Do the feeds page newest first with a cursor?"""
+        start = datetime(2020, 1, 1)
+        for n in range(5):
+            db.session.add(Message(id=500 + n, text=f'#news {n} @alice', user_id=1002,
+                                   timestamp=start + timedelta(minutes=n)))
+        db.session.commit()
+        with app.app_context():
+            enqueue_backfill()
+            db.session.commit()
+            run_pending()
+
+            first, cursor = tag_feed('news', limit=3)
+            self.assertEqual([m.id for m in first], [504, 503, 502])
+            rest, cursor = tag_feed('news', cursor=cursor, limit=3)
+            self.assertEqual([m.id for m in rest], [501, 500])
+            self.assertIsNone(cursor)
+
+            mentions, _ = mention_feed(1001, limit=10)
+            self.assertEqual([m.id for m in mentions], [504, 503, 502, 501, 500])
+            self.assertEqual(mentions[0].user.username, 'bob.smith')
+
+        res = self.client.get('/tags/news')
+        self.assertIn(b'<a href="/tags/news">#news</a> 4', res.data)
+        self.assertNotIn(b'id="older"', res.data)
+
+    def test_backfill_chunks_and_reruns(self):
+        """Is the backfill split into jobs, and safe to run twice?"""
+        for n in range(7):
+            db.session.add(Message(id=600 + n, text=f'#old {n}', user_id=1001))
+        db.session.commit()
+
+        with app.app_context():
+            self.assertEqual(enqueue_backfill(chunk_size=3), 3)
+            self.assertEqual(enqueue_backfill(chunk_size=3), 3)
+            db.session.commit()
+            run_pending(batch_size=10)
+
+        self.assertEqual(MessageTag.query.count(), 7)
+
+    def test_link_tags_escapes(self):
+        """Is the rest of the text still escaped?"""
+        with app.test_request_context():
+            html = str(link_tags("<b>it's</b> #Tag"))
+        self.assertEqual(html, '&lt;b&gt;it&#39;s&lt;/b&gt; <a href="/tags/tag">#Tag</a>')
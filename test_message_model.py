@@ -3,26 +3,22 @@
 #
 # FLASK_ENV=production python -m unittest test_message_model.py
 
-import os
-from unittest import TestCase
+import time
+
 from sqlalchemy import exc
 
+from testing import DatabaseTestCase  # before app: picks the test database
 from models import db, User, Message, Follows, Likes
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
 from app import app
 
-db.create_all()
 
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(DatabaseTestCase):
     """Test view for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
-
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         self.uid = 98765
         u = User.signup('message_test', 'messages@test.com', 'password', None)
@@ -32,11 +28,6 @@ class MessageModelTestCase(TestCase):
         self.u = User.query.get(self.uid)
         self.client = app.test_client()
     
-    def tearDown(self):
-        res = super().tearDown()
-        db.session.rollback()
-        return res
-    
     def test_message_model(self):
         """Does the basic model work?"""
         
@@ -81,3 +72,16 @@ class MessageModelTestCase(TestCase):
     
     
 
+
+    def test_timestamp_set_per_row(self):
+        """Does each message get its own timestamp, in id order?"""
+        m1 = Message(text='first', user_id=self.uid)
+        db.session.add(m1)
+        db.session.commit()
+        time.sleep(0.002)
+        m2 = Message(text='second', user_id=self.uid)
+        db.session.add(m2)
+        db.session.commit()
+
+        self.assertLess(m1.timestamp, m2.timestamp)
+        self.assertLess(m1.id, m2.id)
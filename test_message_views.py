@@ -4,43 +4,25 @@
 #
 # FLASK_ENV=production python -m unittest test_message_views.py
 
-
-import os
-from unittest import TestCase
-
-from models import db, connect_db, Message, User
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
+from testing import DatabaseTestCase  # before app: picks the test database
+from jobs import run_pending
+from models import db, connect_db, Message, User, Job
+from pubsub import MESSAGES_TOPIC
 
 from app import app, CURR_USER_KEY
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
-
-        db.drop_all()
-        db.create_all()
+        super().setUp()
+        app.extensions['cache'].clear()
 
         self.client = app.test_client()
 
@@ -71,6 +53,30 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
+
+    def test_add_message_fan_out(self):
+        """Does posting a message queue its fan-out to live timelines?"""
+
+        events = []
+        unsubscribe = app.extensions['bus'].subscribe(MESSAGES_TOPIC, events.append)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Hello"})
+
+        # Fan-out happens in the job workers, not in the request
+        self.assertEqual(events, [])
+        self.assertEqual(Job.query.filter_by(kind='message.posted').count(), 1)
+
+        with app.app_context():
+            run_pending()
+        unsubscribe()
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['text'], "Hello")
+        self.assertEqual(events[0]['user']['id'], self.testuser_id)
     
     def test_unauthorized_add(self):
         """Test for unauthorized (or logged-out) message adding."""
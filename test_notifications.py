@@ -0,0 +1,150 @@
+"""Notifications inbox tests."""
+
+# run these tests like:
+#
+# FLASK_ENV=production python -m unittest test_notifications.py
+
+from unittest.mock import patch
+
+from testing import DatabaseTestCase  # before app: picks the test database
+from models import db, User, Message, Likes, Notification, Inbox
+
+from app import app, CURR_USER_KEY
+from notifications import notify, inbox_page, unread_count, mark_all_read
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class NotificationsTestCase(DatabaseTestCase):
+    """Test coalescing, counters, trimming and the inbox page."""
+
+    def setUp(self):
+        super().setUp()
+        app.extensions['cache'].clear()
+        self.client = app.test_client()
+
+        for i in range(6):
+            user = User.signup(f'user{i}', f'user{i}@test.com', 'password', None)
+            user.id = 2000 + i
+        message = Message(text='warble', user_id=2000)
+        db.session.add(message)
+        db.session.commit()
+        self.owner_id, self.message_id = 2000, message.id
+
+    def login(self, user_id):
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = user_id
+
+    def test_likes_coalesce(self):
+        """Do likes of one message within a bucket share one notification?"""
+        for user_id in range(2001, 2005):
+            self.login(user_id)
+            res = self.client.post(f'/messages/{self.message_id}/like')
+            self.assertEqual(res.status_code, 302)
+        self.login(2005)
+        res = self.client.post(f'/api/v1/messages/{self.message_id}/like')
+        self.assertEqual(res.get_json(), {'liked': True})
+
+        self.assertEqual(Likes.query.filter_by(message_id=self.message_id).count(), 5)
+        note = Notification.query.one()
+        self.assertEqual((note.kind, note.subject_id, note.actor_count),
+                         ('like', self.message_id, 5))
+        self.assertEqual(unread_count(self.owner_id), 1)
+
+        self.login(self.owner_id)
+        res = self.client.get('/notifications')
+        self.assertIn(b'@user5</a>', res.data)
+        self.assertIn(b'and 4 others', res.data)
+        self.assertIn(b'liked your warble', res.data)
+
+    def test_own_actions_are_skipped(self):
+        """Does liking your own message notify nobody?"""
+        with app.app_context():
+            notify(self.owner_id, 'like', self.owner_id, self.message_id)
+        self.assertEqual(Notification.query.count(), 0)
+
+    def test_follow_notifies(self):
+        """Does following someone notify them, once per follower?"""
+        self.login(2001)
+        self.client.post(f'/users/follow/{self.owner_id}')
+        self.login(2002)
+        self.client.post('/users/follow', data={'follow_id': [self.owner_id]})
+
+        note = Notification.query.one()
+        self.assertEqual((note.kind, note.actor_count), ('follow', 2))
+
+    def test_mention_notifies(self):
+        """Does posting a message that mentions someone notify them?"""
+        self.login(2001)
+        self.client.post('/messages/new', data={'text': 'hi @user0 and @user1'})
+        note = Notification.query.one()
+        self.assertEqual((note.user_id, note.kind), (self.owner_id, 'mention'))
+
+    def test_read_and_unread_again(self):
+        """Does viewing the inbox clear the counter, and a new actor re-raise it?"""
+        with app.app_context():
+            notify(self.owner_id, 'like', 2001, self.message_id)
+            notify(self.owner_id, 'follow', 2001)
+            db.session.commit()
+        self.assertEqual(unread_count(self.owner_id), 2)
+
+        self.login(self.owner_id)
+        self.assertIn(b'id="unread">2<', self.client.get('/').data)
+        self.client.get('/notifications')
+        self.assertEqual(unread_count(self.owner_id), 0)
+        self.assertNotIn(b'id="unread"', self.client.get('/').data)
+
+        with app.app_context():
+            notify(self.owner_id, 'like', 2001, self.message_id)   # same actor
+            db.session.commit()
+        self.assertEqual(unread_count(self.owner_id), 0)
+        with app.app_context():
+            notify(self.owner_id, 'like', 2002, self.message_id)
+            db.session.commit()
+        self.assertEqual(unread_count(self.owner_id), 1)
+
+    def test_repeat_actor_counted_once(self):
+        """Is an actor who repeats an action counted once, even after
+        dropping out of the recent actors shown?"""
+        with app.app_context(), patch('notifications.RECENT_ACTORS', 2):
+            for actor_id in (2001, 2002, 2003, 2001):
+                notify(self.owner_id, 'like', actor_id, self.message_id)
+            db.session.commit()
+
+        note = Notification.query.one()
+        self.assertEqual((note.actor_count, note.actor_ids), (3, '2003,2002'))
+
+    def test_inbox_is_capped(self):
+        """Are the oldest notifications trimmed once past the cap?"""
+        app.config['NOTIFICATION_INBOX_CAP'] = 5
+        try:
+            with app.app_context():
+                for subject_id in range(1, 31):
+                    notify(self.owner_id, 'like', 2001, subject_id)
+                db.session.commit()
+        finally:
+            del app.config['NOTIFICATION_INBOX_CAP']
+
+        count = Notification.query.filter_by(user_id=self.owner_id).count()
+        self.assertLessEqual(count, 5 + 20)
+        inbox = Inbox.query.get(self.owner_id)
+        self.assertEqual((inbox.total, inbox.unread), (count, count))
+        # The newest survive.
+        self.assertIn(30, {n.subject_id for n in Notification.query})
+
+    def test_inbox_pagination(self):
+        """Does the inbox page through every notification, newest first?"""
+        with app.app_context():
+            for subject_id in range(1, 8):
+                notify(self.owner_id, 'like', 2001, subject_id)
+            db.session.commit()
+
+            seen, cursor = [], None
+            while True:
+                entries, cursor = inbox_page(self.owner_id, cursor, limit=3)
+                seen += [entry.notification.subject_id for entry in entries]
+                if cursor is None:
+                    break
+            mark_all_read(self.owner_id)
+        self.assertEqual(sorted(seen, reverse=True), seen)
+        self.assertEqual(sorted(seen), list(range(1, 8)))
@@ -0,0 +1,171 @@
+"""Sampling profiler tests."""
+
+# run these tests like:
+#
+# python -m unittest test_profiling.py
+
+import json
+import os
+import signal
+import tempfile
+import threading
+import time
+from unittest import TestCase, skipUnless
+
+from flask import Flask
+
+from metrics import metrics
+from profiling import SamplingProfiler, connect_profiler
+
+
+def spin(seconds):
+    """Burn CPU in a frame the profiler can see."""
+
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+class SamplingProfilerTestCase(TestCase):
+    """Test sampling, selection, the overhead budget and output files."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = SamplingProfiler(self.directory, interval=0.001, max_overhead=0.5)
+
+    def tearDown(self):
+        self.profiler.stop()
+
+    def profile_thread(self, endpoint, seconds):
+        def work():
+            self.profiler.enter(endpoint)
+            spin(seconds)
+            self.profiler.leave()
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+
+    def test_samples_registered_threads_per_endpoint(self):
+        """Are only registered threads sampled, under their endpoint?"""
+        self.profiler.start(endpoints=['slow'])
+        self.profile_thread('slow', 0.2)
+        spin(0.05)      # this thread isn't registered
+        paths = self.profiler.stop()
+
+        self.assertEqual(list(self.profiler.stacks), ['slow'])
+        collapsed = open(next(p for p in paths if p.endswith('.collapsed'))).read()
+        self.assertIn('work (test_profiling.py', collapsed)
+        self.assertIn(';spin (test_profiling.py', collapsed)
+        self.assertNotIn('test_samples_registered_threads', collapsed)
+
+        profile = json.load(open(next(p for p in paths if p.endswith('.json'))))
+        self.assertEqual(profile['profiles'][0]['name'], 'slow')
+        names = {frame['name'] for frame in profile['shared']['frames']}
+        self.assertIn('spin', names)
+        self.assertAlmostEqual(profile['profiles'][0]['endValue'], 200, delta=100)
+
+    def test_selection(self):
+        """Are requests picked by endpoint or rate, and none when stopped?"""
+        self.assertFalse(self.profiler.wants('homepage'))
+        self.profiler.start(rate=0, endpoints=['homepage'])
+        self.assertTrue(self.profiler.wants('homepage'))
+        self.assertFalse(self.profiler.wants('list_users'))
+        self.assertFalse(self.profiler.start(rate=1))
+        self.profiler.stop()
+
+        self.profiler.start(rate=1)
+        self.assertTrue(self.profiler.wants('list_users'))
+
+    def test_overhead_budget(self):
+        """Does the sampler slow down to keep its cost under budget?"""
+        profiler = SamplingProfiler(self.directory, interval=0.001, max_overhead=1e-4)
+        profiler.start(rate=1)
+        self.profile_thread('busy', 0.1)
+        self.assertGreater(profiler.interval, 0.001)
+        profiler.stop()
+        self.assertLess(profiler.overhead(), 0.01)
+
+    def test_duration(self):
+        """Does a timed profile stop and write its files on its own?"""
+        self.profiler.start(rate=1, duration=0.2)
+        self.profile_thread('timed', 0.1)
+        time.sleep(0.3)
+        self.assertFalse(self.profiler.running)
+        self.assertTrue(self.profiler.written)
+        self.assertEqual(metrics.value('profiler_running'), 0)
+
+
+def make_app(directory):
+    app = Flask(__name__)
+    app.config.update(PROFILE_DIR=directory, PROFILER_TOKEN='sekrit',
+                      PROFILER_INTERVAL_MS=1, PROFILER_MAX_OVERHEAD=0.5)
+    connect_profiler(app)
+
+    @app.route('/slow')
+    def slow():
+        spin(0.1)
+        return 'done'
+
+    return app
+
+
+class ProfilerRouteTestCase(TestCase):
+    """Test the admin route and request hooks."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = make_app(self.directory)
+        self.client = self.app.test_client()
+        self.auth = {'Authorization': 'Bearer sekrit'}
+
+    def tearDown(self):
+        self.app.extensions['profiler'].stop()
+
+    def test_requires_token(self):
+        """Is the route hidden without the right token?"""
+        self.assertEqual(self.client.get('/admin/profiler').status_code, 404)
+        res = self.client.get('/admin/profiler', headers={'Authorization': 'Bearer no'})
+        self.assertEqual(res.status_code, 404)
+
+    def test_profile_an_endpoint(self):
+        """Can a profile of one endpoint be started, inspected and stopped?"""
+        res = self.client.post('/admin/profiler', data={'endpoints': 'slow'},
+                               headers=self.auth)
+        self.assertEqual(res.get_json()['endpoints'], ['slow'])
+        self.assertEqual(self.client.post('/admin/profiler', data={'rate': '1'},
+                                          headers=self.auth).status_code, 409)
+
+        self.client.get('/slow')
+        status = self.client.get('/admin/profiler', headers=self.auth).get_json()
+        self.assertTrue(status['running'])
+        self.assertGreater(status['samples']['slow'], 10)
+
+        written = self.client.post('/admin/profiler', data={'action': 'stop'},
+                                   headers=self.auth).get_json()['written']
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted(os.path.basename(p) for p in written))
+        self.assertTrue(any(name.startswith('slow-') for name in os.listdir(self.directory)))
+
+    @skipUnless(hasattr(signal, 'SIGUSR2'), "needs SIGUSR2")
+    def test_signal_toggle(self):
+        """Does SIGUSR2 only flag a toggle, which the next request (start)
+        or the sampler thread (stop) carries out?"""
+        profiler = self.app.extensions['profiler']
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertFalse(profiler.running)
+        self.client.get('/slow')
+        self.assertTrue(profiler.running)
+
+        os.kill(os.getpid(), signal.SIGUSR2)
+        for _ in range(100):
+            if not profiler.running:
+                break
+            time.sleep(0.01)
+        self.assertFalse(profiler.running)
+        self.assertTrue(any(name.startswith('slow-') for name in os.listdir(self.directory)))
+
+    def test_rejects_bad_rate(self):
+        """Is a rate outside 0..1 refused?"""
+        res = self.client.post('/admin/profiler', data={'rate': '5'}, headers=self.auth)
+        self.assertEqual(res.status_code, 400)
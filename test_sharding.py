@@ -0,0 +1,320 @@
+"""Message shard router tests."""
+
+# run these tests like:
+#
+# python -m unittest test_sharding.py
+#
+# Three SQLite files stand in for the message shards; a fourth is the
+# primary holding users.
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from flask import Flask
+from sqlalchemy import create_mock_engine
+
+import testing  # noqa: F401 (before app: picks the test database)
+from app import app, create_app, CURR_USER_KEY
+from cache import connect_cache
+from entity_cache import connect_entity_cache
+from message_ids import lowest_id, timestamp_of
+from models import db, User, Message, Likes, Follows
+from sharding import (connect_shards, message_shards, hydrate, shard_messages,
+                      shard_messages_archive)
+from tasks import purge_user
+
+
+def likes_ddl(flask_app):
+    """The DDL that creates `likes` on a Postgres primary for `flask_app`."""
+
+    statements = []
+    engine = create_mock_engine(
+        'postgresql://',
+        lambda sql, *args, **kw: statements.append(str(sql.compile(dialect=engine.dialect))))
+    with flask_app.app_context():
+        Likes.__table__.create(bind=engine)
+    return [statement.strip() for statement in statements]
+
+
+def make_app(tmp, shard_count=3, archive_after_days=None):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(tmp, 'primary.db')}"
+    app.config['MESSAGE_SHARD_URIS'] = [
+        f"sqlite:///{os.path.join(tmp, f'shard{i}.db')}" for i in range(shard_count)]
+    app.config['ARCHIVE_AFTER_DAYS'] = archive_after_days
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    connect_cache(app)
+    connect_entity_cache(app)
+    connect_shards(app)
+    return app
+
+
+class ShardRouterTestCase(TestCase):
+    """Test routing, id allocation and cross-shard feed merging."""
+
+    def setUp(self):
+        self.app = make_app(tempfile.mkdtemp())
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        db.create_all()
+        self.shards = message_shards()
+        self.shards.create_schema()
+
+        self.users = []
+        for i in range(6):
+            user = User(username=f'user{i}', email=f'u{i}@test.com', password='x')
+            db.session.add(user)
+            self.users.append(user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        for engine in self.shards.engines + [db.engine]:
+            engine.dispose()
+        self.ctx.pop()
+
+    def shard_rows(self, index):
+        return self.shards.engines[index].execute(shard_messages.select()).fetchall()
+
+    def test_messages_live_on_authors_shard(self):
+        """Is each message stored only on its author's shard?"""
+        for user in self.users:
+            self.shards.add(user.id, f'by {user.username}')
+
+        for user in self.users:
+            index = self.shards.shard_index(user.id)
+            self.assertIn(user.id, [r.user_id for r in self.shard_rows(index)])
+            self.assertEqual(self.shards.count_for_user(user.id), 1)
+
+        total = sum(len(self.shard_rows(i)) for i in range(self.shards.count))
+        self.assertEqual(total, len(self.users))
+
+    def test_ids_unique_and_locatable(self):
+        """Are ids unique and time-ordered across shards, and can each be
+        found again?"""
+        rows = [self.shards.add(user.id, 'hi') for user in self.users for _ in range(3)]
+        ids = [row.id for row in rows]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertTrue(all(row.timestamp == timestamp_of(row.id) for row in rows))
+
+        for row in rows:
+            self.assertEqual(self.shards.get(row.id).user_id, row.user_id)
+        self.assertIsNone(self.shards.get(max(ids) + 1000))
+
+        found = self.shards.get_many(ids + [max(ids) + 1000])
+        self.assertEqual(sorted(found), sorted(ids))
+        self.assertEqual({row.id: row.user_id for row in rows},
+                         {i: row.user_id for i, row in found.items()})
+
+    def test_feed_merges_shards_newest_first(self):
+        """Does the feed k-way merge every shard's newest messages?"""
+        start = datetime(2020, 1, 1)
+        for n in range(30):
+            user = self.users[n % len(self.users)]
+            index = self.shards.shard_index(user.id)
+            self.shards.engines[index].execute(
+                shard_messages.insert(), id=n + 1, text=str(n), user_id=user.id,
+                timestamp=start + timedelta(minutes=n))
+
+        feed = self.shards.feed([u.id for u in self.users], limit=10)
+        self.assertEqual([row.text for row in feed], [str(n) for n in range(29, 19, -1)])
+
+        feed = self.shards.feed([self.users[0].id], limit=100)
+        self.assertEqual([row.text for row in feed], [str(n) for n in range(24, -1, -6)])
+
+    def test_delete_and_hydrate(self):
+        """Are deletes limited to the author, and authors attached in bulk?"""
+        user, other = self.users[:2]
+        row = self.shards.add(user.id, 'mine')
+
+        self.assertEqual(self.shards.delete(row.id, other.id), 0)
+        [message] = hydrate([self.shards.get(row.id)])
+        self.assertEqual(message.user.username, user.username)
+
+        self.assertEqual(self.shards.delete(row.id, user.id), 1)
+        self.assertIsNone(self.shards.get(row.id))
+
+
+class ArchiveTestCase(TestCase):
+    """Test moving old messages to the archive and reading them back."""
+
+    def make(self, shard_count):
+        self.app = make_app(tempfile.mkdtemp(), shard_count, archive_after_days=30)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.shards = message_shards()
+        self.shards.create_schema()
+
+        self.user = User(username='old', email='old@test.com', password='x')
+        self.fan = User(username='fan', email='fan@test.com', password='x')
+        db.session.add_all([self.user, self.fan])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        for engine in self.shards.engines + [db.engine]:
+            engine.dispose()
+        self.ctx.pop()
+
+    def post(self, days_ago):
+        """Add a message as if posted `days_ago`; returns its id."""
+        row = self.shards.add(self.user.id, f'{days_ago} days ago')
+        timestamp = datetime.utcnow() - timedelta(days=days_ago)
+        message_id = lowest_id(timestamp) + row.id % 4096
+        update = (self.shards.table.update()
+                  .where(self.shards.table.c.id == row.id)
+                  .values(id=message_id, timestamp=timestamp))
+        if self.shards.sharded:
+            self.shards.engines[self.shards.shard_index(self.user.id)].execute(update)
+        else:
+            db.session.execute(update)
+            db.session.commit()
+        return message_id
+
+    def test_archive_and_read_through(self):
+        """Do archived messages leave the hot table but stay readable?"""
+        self.make(shard_count=2)
+        ids = [self.post(days) for days in (1, 10, 100, 200)]
+
+        self.assertEqual(self.shards.archive(self.shards.cutoff(), batch_size=1), 2)
+
+        engine = self.shards.engines[self.shards.shard_index(self.user.id)]
+        hot = [row.id for row in engine.execute(shard_messages.select())]
+        cold = [row.id for row in engine.execute(shard_messages_archive.select())]
+        self.assertEqual(sorted(hot, reverse=True), ids[:2])
+        self.assertEqual(sorted(cold, reverse=True), ids[2:])
+
+        self.assertEqual([row.id for row in self.shards.for_user(self.user.id)], ids)
+        self.assertEqual([row.id for row in self.shards.for_user(self.user.id, 1)], ids[:1])
+        self.assertEqual(self.shards.get(ids[3]).text, '200 days ago')
+        self.assertEqual(self.shards.count_for_user(self.user.id), 4)
+
+        # Ids keep increasing even if every hot row has been archived
+        self.shards.archive(datetime.utcnow(), batch_size=10)
+        self.assertGreater(self.shards.add(self.user.id, 'new').id, max(ids))
+
+    def test_liked_messages_stay_hot(self):
+        """Unsharded, are liked messages kept out of the archive?"""
+        self.make(shard_count=0)
+        liked, unliked = self.post(100), self.post(100)
+        db.session.add(Likes(user_id=self.fan.id, message_id=liked))
+        db.session.commit()
+
+        self.assertEqual(self.shards.archive(self.shards.cutoff()), 1)
+        self.assertEqual([m.id for m in Message.query.all()], [liked])
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual([row.id for row in self.shards.for_user(self.user.id)],
+                         sorted([liked, unliked], reverse=True))
+
+
+class ShardedAppTestCase(TestCase):
+    """Test that the JSON API, likes and account purge use the shards."""
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'primary.db')}",
+            'MESSAGE_SHARD_URIS': [f"sqlite:///{os.path.join(tmp, f'shard{i}.db')}"
+                                   for i in range(3)],
+            'SQLALCHEMY_REPLICA_URIS': [],
+            'JINJA_CACHE_DIR': tmp,
+            'ADMISSION_ENABLED': False,
+            'WTF_CSRF_ENABLED': False,
+        })
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.create_all()
+            self.shards = message_shards()
+            self.shards.create_schema()
+            users = [User(username=f'user{i}', email=f'u{i}@test.com', password='x')
+                     for i in range(3)]
+            db.session.add_all(users)
+            db.session.commit()
+            self.user_ids = [user.id for user in users]
+            db.session.add(Follows(user_following_id=self.user_ids[0],
+                                   user_being_followed_id=self.user_ids[1]))
+            db.session.commit()
+            self.message_ids = [self.shards.add(user_id, f'hello from {n}').id
+                                for n, user_id in enumerate(self.user_ids)]
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            for engine in self.shards.engines + [db.engine]:
+                engine.dispose()
+        db.app = app
+
+    def login(self, user_id):
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = user_id
+
+    def test_api_reads(self):
+        """Do the API's timeline, message and profile reads find sharded
+        messages?"""
+        self.login(self.user_ids[0])
+        data = self.client.get('/api/v1/timeline').get_json()
+        self.assertEqual([m['text'] for m in data['messages']],
+                         ['hello from 1', 'hello from 0'])
+        self.assertEqual(data['messages'][0]['user']['username'], 'user1')
+
+        data = self.client.get('/api/v1/timeline?limit=1').get_json()
+        data = self.client.get(f"/api/v1/timeline?limit=1&cursor={data['next_cursor']}")
+        self.assertEqual([m['text'] for m in data.get_json()['messages']],
+                         ['hello from 0'])
+
+        data = self.client.get(f'/api/v1/users/{self.user_ids[2]}/messages').get_json()
+        self.assertEqual([m['text'] for m in data['messages']], ['hello from 2'])
+        data = self.client.get(f'/api/v1/messages/{self.message_ids[2]}').get_json()
+        self.assertEqual(data['text'], 'hello from 2')
+        ids = ','.join(str(i) for i in reversed(self.message_ids))
+        data = self.client.get(f'/api/v1/messages?ids={ids}').get_json()
+        self.assertEqual([m['id'] for m in data['messages']], self.message_ids[::-1])
+        data = self.client.get(f'/api/v1/users/{self.user_ids[2]}').get_json()
+        self.assertEqual(data['counts']['messages'], 1)
+
+    def test_likes(self):
+        """Can sharded messages be liked, listed and counted, in the pages
+        and the API?"""
+        self.login(self.user_ids[0])
+        self.client.post(f'/messages/{self.message_ids[1]}/like')
+        res = self.client.post(f'/api/v1/messages/{self.message_ids[2]}/like')
+        self.assertEqual(res.get_json(), {'liked': True})
+
+        res = self.client.get(f'/users/{self.user_ids[0]}/likes')
+        self.assertIn(b'hello from 1', res.data)
+        self.assertIn(b'hello from 2', res.data)
+        res = self.client.get(f'/users/{self.user_ids[0]}')
+        self.assertIn(f'/users/{self.user_ids[0]}/likes">2</a>'.encode(), res.data)
+
+        self.client.post(f'/messages/{self.message_ids[1]}/like')
+        with self.app.app_context():
+            self.assertEqual(Likes.liked_among(self.user_ids[0], self.message_ids),
+                             {self.message_ids[2]})
+
+    def test_likes_message_fk(self):
+        """On a Postgres primary, is the likes foreign key to messages, which
+        can't reach sharded messages, dropped, and kept when unsharded?"""
+        sharded = likes_ddl(self.app)
+        self.assertIn('REFERENCES messages (id)', sharded[0])
+        self.assertEqual(sharded[1:], ['ALTER TABLE likes DROP CONSTRAINT IF EXISTS '
+                                       'likes_message_id_fkey'])
+        self.assertEqual(len(likes_ddl(app)), 1)
+
+    def test_purge(self):
+        """Does purging a user delete their sharded messages and those
+        messages' likes?"""
+        with self.app.app_context():
+            db.session.add(Likes(user_id=self.user_ids[0],
+                                 message_id=self.message_ids[1]))
+            User.query.get(self.user_ids[1]).deleted_at = datetime.utcnow()
+            db.session.commit()
+            purge_user({'user_id': self.user_ids[1]}, batch_size=1)
+
+            self.assertEqual(self.shards.count_for_user(self.user_ids[1]), 0)
+            self.assertEqual(self.shards.count_for_user(self.user_ids[2]), 1)
+            self.assertEqual(Likes.query.count(), 0)
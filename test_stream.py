@@ -0,0 +1,107 @@
+"""Timeline SSE stream tests."""
+
+# run these tests like:
+#
+# python -m unittest test_stream.py
+
+import asyncio
+import json
+import threading
+from unittest import TestCase
+
+from pubsub import InMemoryBus, MESSAGES_TOPIC
+from stream import TimelineStreamApp, Connection, RESYNC, STREAM_PATH
+
+
+def make_event(msg_id, author_id):
+    return {'id': msg_id, 'text': 'hi', 'timestamp': '2020-01-01T00:00:00',
+            'user': {'id': author_id, 'username': f'u{author_id}', 'image_url': ''}}
+
+
+class StreamTestCase(TestCase):
+    """Test fan-out from the bus to SSE connections."""
+
+    def setUp(self):
+        self.bus = InMemoryBus()
+        self.app = TimelineStreamApp(
+            self.bus,
+            authenticate=lambda scope: 1 if scope.get('user') else None,
+            load_following=lambda user_id: [2],
+            buffer_size=2,
+            heartbeat=5,
+        )
+
+    def run_stream(self, publish, user=True):
+        """Open a stream, call `publish()` once it's connected, then disconnect.
+
+        Returns (status, body).
+        """
+
+        sent = []
+        disconnect = None
+
+        async def receive():
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def publish_then_disconnect():
+            # Publish from another thread, like a WSGI worker would.
+            thread = threading.Thread(target=publish)
+            thread.start()
+            await asyncio.get_running_loop().run_in_executor(None, thread.join)
+            await asyncio.sleep(0.1)
+            disconnect.set()
+
+        async def send(message):
+            sent.append(message)
+            if message.get('body', b'').startswith(b'retry'):
+                asyncio.ensure_future(publish_then_disconnect())
+
+        async def main():
+            nonlocal disconnect
+            disconnect = asyncio.Event()
+            scope = {'type': 'http', 'method': 'GET', 'path': STREAM_PATH,
+                     'headers': [], 'user': user}
+            await asyncio.wait_for(self.app(scope, receive, send), 5)
+
+        asyncio.run(main())
+        body = b''.join(m.get('body', b'') for m in sent
+                        if m['type'] == 'http.response.body')
+        return sent[0]['status'], body.decode()
+
+    def test_requires_login(self):
+        """Are anonymous streams rejected?"""
+        status, _ = self.run_stream(lambda: None, user=False)
+        self.assertEqual(status, 401)
+
+    def test_fan_out_to_followers(self):
+        """Does a connection get events only from authors it follows?"""
+
+        def publish():
+            self.bus.publish(MESSAGES_TOPIC, make_event(10, 2))
+            self.bus.publish(MESSAGES_TOPIC, make_event(11, 3))
+            self.bus.publish(MESSAGES_TOPIC, make_event(12, 1))
+
+        status, body = self.run_stream(publish)
+        self.assertEqual(status, 200)
+        self.assertIn('id: 10\nevent: message\n', body)
+        self.assertNotIn('id: 11', body)
+        self.assertIn('id: 12\n', body)
+        data = json.loads(body.split('data: ')[1].split('\n')[0])
+        self.assertEqual(data['user']['username'], 'u2')
+
+        self.assertEqual(len(self.app.hub.connections), 0)
+        self.assertEqual(dict(self.app.hub.by_author), {})
+
+    def test_slow_reader_resyncs(self):
+        """Does overflowing the buffer drop the backlog for a resync?"""
+
+        async def main():
+            conn = Connection({2}, buffer_size=2)
+            self.assertTrue(conn.offer(make_event(20, 2)))
+            self.assertTrue(conn.offer(make_event(21, 2)))
+            self.assertFalse(conn.offer(make_event(22, 2)))
+            self.assertEqual(conn.queue.qsize(), 1)
+            self.assertIs(conn.queue.get_nowait(), RESYNC)
+
+        asyncio.run(main())
@@ -0,0 +1,53 @@
+"""Template bytecode cache and warm-up tests."""
+
+# run these tests like:
+#
+# python -m unittest test_templating.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from flask import Flask
+
+from templating import connect_templates, warm_templates
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_app(**config):
+    app = Flask(__name__, template_folder=os.path.join(ROOT, 'templates'))
+    app.config['JINJA_CACHE_DIR'] = tempfile.mkdtemp()
+    app.config.update(config)
+    connect_templates(app)
+    return app
+
+
+class TemplatingTestCase(TestCase):
+    """Test that templates are precompiled into the on-disk cache."""
+
+    def test_warm_up_fills_bytecode_cache(self):
+        """Does boot compile every template into JINJA_CACHE_DIR?"""
+        app = make_app()
+        templates = app.jinja_loader.list_templates()
+        self.assertIn('home.html', templates)
+        self.assertEqual(len(os.listdir(app.config['JINJA_CACHE_DIR'])), len(templates))
+        self.assertFalse(app.jinja_env.auto_reload)
+
+    def test_second_boot_loads_from_cache(self):
+        """Does a new process reuse the compiled templates?"""
+        first = make_app()
+        second = make_app(JINJA_CACHE_DIR=first.config['JINJA_CACHE_DIR'],
+                          TEMPLATES_WARM_UP=False)
+
+        compiled = []
+        original = second.jinja_env.compile
+        second.jinja_env.compile = lambda *args, **kwargs: (
+            compiled.append(1) or original(*args, **kwargs))
+        warm_templates(second)
+        self.assertEqual(compiled, [])
+
+    def test_auto_reload_setting(self):
+        """Is auto-reload on only when asked for (or in debug)?"""
+        self.assertTrue(make_app(TEMPLATES_AUTO_RELOAD=True,
+                                 TEMPLATES_WARM_UP=False).jinja_env.auto_reload)
@@ -4,45 +4,24 @@
 #
 # FLASK_ENV=production python -m unittest test_user_model.py
 
-
-import os
-from unittest import TestCase
 from sqlalchemy import exc
 
+from testing import DatabaseTestCase  # before app: picks the test database
 from models import db, User, Message, Follows
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
-
 from app import app
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
 
-db.create_all()
-
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Test views for users."""
 
     def setUp(self):
         """Create test client, add sample data."""
-
+        super().setUp()
         # User.query.delete()
         # Message.query.delete()
         # Follows.query.delete()
 
-        db.drop_all()
-        db.create_all()
-
         u1 = User.signup('test1', 'test1@yahoo.com', 'password', None)
         u1d = 11111
         u1.id = u1d
@@ -64,11 +43,6 @@ class UserModelTestCase(TestCase):
 
         self.client = app.test_client()
     
-    def tearDown(self):
-        res = super().tearDown()
-        db.session.rollback()
-        return res
-
     def test_user_model(self):
         """Does basic model work?"""
 
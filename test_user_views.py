@@ -4,27 +4,26 @@
 #
 # FLASK_ENV=production python -m unittest test_user_views.py
 
-import os
-from unittest import TestCase
+import json
+from datetime import datetime
 from sqlalchemy import exc
 
-from models import db, connect_db,User, Message, Follows, Likes
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from testing import DatabaseTestCase  # before app: picks the test database
+from models import db, connect_db,User, Message, Follows, Likes, Job
 
 from app import app, CURR_USER_KEY
-
-db.create_all()
+from jobs import run_pending
+from tasks import purge_user
 
 app.config['WTF_CSRF_ENABLED'] = False
 
-class UserViewTestCase(TestCase):
+class UserViewTestCase(DatabaseTestCase):
     """Test views for users."""
 
     def setUp(self):
         """Create test client, add sample data."""
-        db.drop_all()
-        db.create_all()
+        super().setUp()
+        app.extensions['cache'].clear()
 
         self.client = app.test_client()
 
@@ -46,11 +45,6 @@ class UserViewTestCase(TestCase):
         
         db.session.commit()
     
-    def tearDown(self):
-        res = super().tearDown()
-        db.session.rollback()
-        return res
-    
     def test_index_page(self):
         """Test for users list."""
         with app.test_client() as client:
@@ -203,4 +197,68 @@ class UserViewTestCase(TestCase):
             res = client.get(f'/users/{self.testuser_id}/followers', follow_redirects=True)
             self.assertEqual(res.status_code, 200)
             self.assertNotIn('testuser1', str(res.data))
-            self.assertIn('Access unauthorized', str(res.data))
\ No newline at end of file
+            self.assertIn('Access unauthorized', str(res.data))
+    def test_add_follows(self):
+        """Test following several users in one form post."""
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            res = client.post('/users/follow',
+                              data={'follow_id': [self.u1_id, self.u2_id]},
+                              follow_redirects=True)
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('testuser1', str(res.data))
+            self.assertIn('testuser2', str(res.data))
+
+            follows = Follows.query.filter(Follows.user_following_id == self.testuser_id).all()
+            self.assertEqual(len(follows), 2)
+
+    def test_delete_user(self):
+        """Test that deleting hides the user at once and purges in batches."""
+        self.setup_follows()
+        self.setup_likes()
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.testuser_id
+
+            res = client.post('/users/delete')
+            self.assertEqual(res.status_code, 302)
+
+        # Tombstoned: still in the table, but hidden everywhere
+        self.assertIsNotNone(User.query.get(self.testuser_id).deleted_at)
+        res = self.client.get(f'/users/{self.testuser_id}')
+        self.assertEqual(res.status_code, 404)
+        res = self.client.get('/users')
+        self.assertNotIn('@testuser<', str(res.data))
+        self.assertIn('@testuser1<', str(res.data))
+        self.assertEqual(User.query.get(self.u1_id).following, [])
+        self.assertFalse(User.authenticate('testuser', 'password0'))
+
+        with app.app_context():
+            job = Job.query.filter_by(kind='user.purge').one()
+            purge_user(json.loads(job.payload), batch_size=1)
+
+        self.assertIsNone(User.query.get(self.testuser_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.testuser_id).count(), 0)
+        self.assertEqual(Follows.query.filter((Follows.user_following_id == self.testuser_id) |
+                                              (Follows.user_being_followed_id == self.testuser_id)).count(), 0)
+        self.assertEqual(Likes.query.filter_by(user_id=self.testuser_id).count(), 0)
+
+    def test_delete_user_resumes(self):
+        """Test that a purge out of time budget continues in a new job."""
+        self.setup_follows()
+
+        self.testuser.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        with app.app_context():
+            purge_user({'user_id': self.testuser_id}, batch_size=1, time_budget=0)
+            job = Job.query.filter_by(kind='user.purge').one()
+            self.assertEqual(json.loads(job.payload)['deleted'], {'following': 1})
+
+            run_pending()
+
+        self.assertIsNone(User.query.get(self.testuser_id))
+        self.assertEqual(Follows.query.count(), 0)
@@ -0,0 +1,226 @@
+"""Shared fixtures for Warbler's database tests.
+
+Import this before `app` in a test module:
+
+    from testing import DatabaseTestCase
+
+    from app import app
+
+Importing it points DATABASE_URL at this test worker's database, turns
+bcrypt down to its minimum cost and sets MESSAGE_ID_WORKER.
+`DatabaseTestCase` creates the schema once per process (instead of
+drop_all/create_all in every setUp) and runs each test inside a
+transaction on one connection that is rolled back afterwards.
+The test's (and its requests') session works in a SAVEPOINT that is renewed
+after every commit or rollback, so code under test can commit freely.
+
+The base URL is TEST_DATABASE_URL (default postgresql:///warbler-test).
+Under pytest-xdist (`pytest -n 4`) each worker gets its own database or
+SQLite file, suffixed with the worker id; Postgres databases are created
+on demand.
+
+`snapshot_database(name, build)` gives performance tests a pre-seeded
+database: `build(connection)` runs once to fill a snapshot (a template
+database on Postgres, a file on SQLite) and each call returns the URL of a
+fresh copy.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import warnings
+from unittest import TestCase
+
+from flask import _app_ctx_stack
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine.url import make_url
+
+from models import db
+
+DEFAULT_TEST_DATABASE_URL = 'postgresql:///warbler-test'
+WORKER = os.environ.get('PYTEST_XDIST_WORKER', '')
+
+
+def suffixed_url(url, suffix):
+    """`url` with `-suffix` added to its database name (or file name)."""
+
+    if not suffix:
+        return url
+    url = make_url(url)
+    if url.drivername.startswith('sqlite'):
+        stem, ext = os.path.splitext(url.database)
+        url = url.set(database=f'{stem}-{suffix}{ext}')
+    else:
+        url = url.set(database=f'{url.database}-{suffix}')
+    return url.render_as_string(hide_password=False)
+
+
+def ensure_database(url, template=None):
+    """Create the Postgres database for `url` if it doesn't exist."""
+
+    url = make_url(url)
+    if url.drivername.startswith('sqlite'):
+        return
+    admin_url = url.set(database='postgres')
+    engine = create_engine(admin_url, isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as conn:
+            exists = conn.execute('SELECT 1 FROM pg_database WHERE datname = %s',
+                                  url.database).scalar()
+            if not exists:
+                clause = f' TEMPLATE "{template}"' if template else ''
+                conn.execute(f'CREATE DATABASE "{url.database}"{clause}')
+    finally:
+        engine.dispose()
+
+
+TEST_DATABASE_URL = suffixed_url(
+    os.environ.get('TEST_DATABASE_URL', DEFAULT_TEST_DATABASE_URL), WORKER)
+os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+os.environ.setdefault('BCRYPT_LOG_ROUNDS', '4')
+# One process: no need to lease message id workers (see message_ids.py)
+os.environ.setdefault('MESSAGE_ID_WORKER', '1')
+
+
+def _fix_sqlite_savepoints(engine):
+    """Let pysqlite run SAVEPOINTs (it otherwise manages BEGIN itself)."""
+
+    @event.listens_for(engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def do_begin(conn):
+        conn.exec_driver_sql('BEGIN')
+
+    engine.dispose()
+
+
+_schema_ready = False
+
+
+def ensure_schema():
+    """Create the tables once per process, on an empty database."""
+
+    global _schema_ready
+    if _schema_ready:
+        return
+    ensure_database(TEST_DATABASE_URL)
+    if db.engine.dialect.name == 'sqlite':
+        _fix_sqlite_savepoints(db.engine)
+    db.drop_all()
+    db.create_all()
+    db.session.remove()
+    _schema_ready = True
+
+
+class DatabaseTestCase(TestCase):
+    """TestCase whose database changes are rolled back after each test."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        ensure_schema()
+
+    def setUp(self):
+        super().setUp()
+        self._connection = db.engine.connect()
+        self._transaction = self._connection.begin()
+        self._savepoint = self._connection.begin_nested()
+
+        # Sessions join the connection's SAVEPOINT; once a commit or
+        # rollback ends it, the next one starts.
+        factory = db.create_session({'bind': self._connection, 'binds': {}})
+        event.listen(factory, 'after_transaction_end', self._restart_savepoint)
+
+        self._app_session = db.session
+        db.session = orm.scoped_session(factory,
+                                        scopefunc=_app_ctx_stack.__ident_func__)
+
+    def _restart_savepoint(self, session, transaction):
+        if not self._savepoint.is_active:
+            session.expire_all()
+            self._savepoint = self._connection.begin_nested()
+
+    def tearDown(self):
+        db.session.remove()
+        db.session = self._app_session
+        self._transaction.rollback()
+        with warnings.catch_warnings():
+            # SQLAlchemy warns when the outer transaction is rolled back
+            # with a SAVEPOINT still open; everything was rolled back anyway.
+            warnings.filterwarnings('ignore', 'Reset agent is not active')
+            self._connection.close()
+        super().tearDown()
+
+
+##############################################################################
+# Dataset snapshots
+
+
+def snapshot_database(name, build):
+    """URL of a fresh database seeded by `build(connection)`.
+
+    The snapshot is built once (per base database and schema) and copied
+    for each call, so seeding cost isn't paid per test.
+    """
+
+    name = f'{name}-{schema_fingerprint()}'
+    base = make_url(TEST_DATABASE_URL)
+    copy_url = suffixed_url(TEST_DATABASE_URL, f'{name}-{next(_copies)}')
+
+    if base.drivername.startswith('sqlite'):
+        directory = os.path.dirname(base.database) or tempfile.gettempdir()
+        snapshot = os.path.join(directory, f'snapshot-{name}.db')
+        if not os.path.exists(snapshot):
+            building = f'{snapshot}.{os.getpid()}'
+            _build_snapshot(f'sqlite:///{building}', build)
+            os.replace(building, snapshot)
+        shutil.copyfile(snapshot, make_url(copy_url).database)
+        return copy_url
+
+    snapshot_url = suffixed_url(TEST_DATABASE_URL, f'snapshot-{name}')
+    snapshot_name = make_url(snapshot_url).database
+    admin = base.set(database='postgres')
+    engine = create_engine(admin, isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as conn:
+            if not conn.execute('SELECT 1 FROM pg_database WHERE datname = %s',
+                                snapshot_name).scalar():
+                conn.execute(f'CREATE DATABASE "{snapshot_name}"')
+                _build_snapshot(snapshot_url, build)
+            conn.execute(f'DROP DATABASE IF EXISTS "{make_url(copy_url).database}"')
+    finally:
+        engine.dispose()
+    ensure_database(copy_url, template=snapshot_name)
+    return copy_url
+
+
+def schema_fingerprint():
+    """Short hash of the tables and columns, so snapshots of an older
+    schema aren't reused."""
+
+    schema = [(table.name, [(column.name, str(column.type)) for column in table.columns])
+              for table in db.metadata.sorted_tables]
+    return hashlib.sha1(repr(schema).encode()).hexdigest()[:8]
+
+
+def _copy_counter():
+    n = 0
+    while True:
+        n += 1
+        yield n
+
+
+_copies = _copy_counter()
+
+
+def _build_snapshot(url, build):
+    engine = create_engine(url)
+    try:
+        db.metadata.create_all(bind=engine)
+        with engine.begin() as conn:
+            build(conn)
+    finally:
+        engine.dispose()